@@ -0,0 +1,186 @@
+import io
+import sys
+import json
+import glob
+import time
+import argparse
+import platform
+import numpy as np
+import torch
+from PIL import Image
+
+'''
+End-to-end inference latency benchmark.
+
+Runs the inference path of `SCSAF.test` stage by stage on encoded PNG
+inputs: decode, preprocess (to tensor, host-to-device, masking), mask
+pyramid, generator, compositing, metrics (PSNR and L1 against the input)
+and encode. Every batch size / thread count combination is warmed up first,
+then p50/p90/p99 of every stage and of the whole iteration plus the
+throughput are reported over `--iterations` warm iterations. Run from the
+repo root:
+
+    python -m benchmarks.inference --weights XXX/InpaintingModel_gen.tensors --batch-sizes 1 4 --threads 1 4
+
+Without --images random images with a random rectangular hole are used.
+'''
+
+
+def encode_png(array):
+    buffer = io.BytesIO()
+    Image.fromarray(array).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def decode_png(data):
+    return np.array(Image.open(io.BytesIO(data)))
+
+
+def synthetic_inputs(count, size, seed):
+    rng = np.random.RandomState(seed)
+    images, masks = [], []
+    for _ in range(count):
+        image = rng.randint(0, 256, (size, size, 3), dtype=np.uint8)
+        mask = np.zeros((size, size), np.uint8)
+        y, x = rng.randint(0, size // 2, 2)
+        mask[y:y + size // 2, x:x + size // 2] = 255
+        images.append(encode_png(image))
+        masks.append(encode_png(mask))
+    return images, masks
+
+
+def file_inputs(images_path, masks_path, size, seed=0):
+    # image / mask files are paired in sorted order and resized to `size`, synthetic masks without `masks_path`
+    def load(path, mode):
+        if path.endswith('.flist'):
+            files = np.genfromtxt(path, dtype=str, ndmin=1).tolist()
+        else:
+            files = sorted(glob.glob(path))
+        if not files:
+            raise FileNotFoundError('no files match %s' % path)
+        return [encode_png(np.array(Image.open(name).convert(mode).resize((size, size)))) for name in files]
+
+    images = load(images_path, 'RGB')
+    if masks_path is None:
+        return images, synthetic_inputs(len(images), size, seed)[1]
+    masks = load(masks_path, 'L')
+    return images, [masks[i % len(masks)] for i in range(len(images))]
+
+
+def run_batch(pipeline, timer, psnr, images, masks):
+    from src.models import mask_pyramid
+
+    device = pipeline.device
+    with timer.stage('decode'):
+        image_arrays = [decode_png(data) for data in images]
+        mask_arrays = [decode_png(data) for data in masks]
+
+    with torch.inference_mode():
+        with timer.stage('preprocess'):
+            images = torch.stack([pipeline.image_to_tensor(image) for image in image_arrays])
+            masks = torch.stack([pipeline.mask_to_tensor(mask) for mask in mask_arrays]).repeat(1, 3, 1, 1)
+            images_masked = (images * (1 - masks)) + masks
+
+        with timer.stage('mask_pyramid'):
+            pyramid = mask_pyramid(masks)
+
+        with timer.stage('generator'):
+            outputs_img = pipeline.generator(images_masked, masks, *pyramid)
+
+        with timer.stage('compositing'):
+            outputs_merged = (outputs_img * masks) + (images * (1 - masks))
+
+        with timer.stage('metrics'):
+            metrics = torch.stack([psnr(images * 255.0, outputs_merged * 255.0),
+                                   torch.nn.functional.l1_loss(outputs_merged, images)]).tolist()
+
+        with timer.stage('encode'):
+            results = [encode_png(image) for image in
+                       (outputs_merged.clamp(0, 1) * 255.0).round().byte().permute(0, 2, 3, 1).cpu().numpy()]
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return results, metrics
+
+
+def benchmark(pipeline, images, masks, batch_size, warmup, iterations):
+    from src.metrics import PSNR
+    from src.profiler import StageTimer
+
+    timer = StageTimer(sync=True)
+    psnr = PSNR(255.0).to(pipeline.device)
+
+    def batches():
+        index = 0
+        while True:
+            chunk = [(index + i) % len(images) for i in range(batch_size)]
+            index += batch_size
+            yield [images[i] for i in chunk], [masks[i] for i in chunk]
+
+    source = batches()
+    for _ in range(warmup):
+        run_batch(pipeline, timer, psnr, *next(source))
+    # drop the warmup samples
+    timer.flush(None)
+
+    for _ in range(iterations):
+        start = time.perf_counter()
+        run_batch(pipeline, timer, psnr, *next(source))
+        timer.record('total', time.perf_counter() - start)
+
+    summary = timer.summary()
+    summary['throughput_images_per_s'] = batch_size * iterations / (summary['total']['total_ms'] / 1e3)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='end-to-end inference latency benchmark')
+    parser.add_argument('--weights', type=str, default=None, help='generator weights, random when omitted')
+    parser.add_argument('--images', type=str, default=None, help='image glob or .flist, synthetic when omitted')
+    parser.add_argument('--masks', type=str, default=None,
+                        help='mask glob or .flist, paired with --images (synthetic masks when omitted)')
+    parser.add_argument('--size', type=int, default=256, help='image size, a multiple of 64')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1])
+    parser.add_argument('--threads', type=int, nargs='+', default=[torch.get_num_threads()])
+    parser.add_argument('--device', type=str, default=None)
+    parser.add_argument('--warmup', type=int, default=3, help='untimed iterations per setting')
+    parser.add_argument('--iterations', type=int, default=20, help='timed iterations per setting')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default=None, help='write the results as json')
+    args = parser.parse_args(argv)
+    if args.masks and not args.images:
+        parser.error('--masks needs --images')
+
+    from src.pipeline import InpaintPipeline
+
+    torch.manual_seed(args.seed)
+    pipeline = InpaintPipeline(args.weights, device=args.device)
+    if args.images:
+        images, masks = file_inputs(args.images, args.masks, args.size, args.seed)
+    else:
+        images, masks = synthetic_inputs(max(args.batch_sizes), args.size, args.seed)
+
+    results = {}
+    for threads in args.threads:
+        torch.set_num_threads(threads)
+        for batch_size in args.batch_sizes:
+            key = 'b%d/t%d' % (batch_size, threads)
+            results[key] = summary = benchmark(pipeline, images, masks, batch_size, args.warmup, args.iterations)
+
+            print('\n%s  %.2f images/s' % (key, summary['throughput_images_per_s']))
+            for stage in ['decode', 'preprocess', 'mask_pyramid', 'generator', 'compositing', 'metrics', 'encode',
+                          'total']:
+                row = summary[stage]
+                print('    %-14s p50 %9.2fms  p90 %9.2fms  p99 %9.2fms' % (stage, row['p50_ms'], row['p90_ms'],
+                                                                          row['p99_ms']))
+
+    if args.output:
+        meta = {'torch': torch.__version__, 'python': platform.python_version(), 'machine': platform.machine(),
+                'device': str(pipeline.device), 'size': args.size, 'warmup': args.warmup,
+                'iterations': args.iterations, 'weights': args.weights}
+        with open(args.output, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,235 @@
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import torch
+
+'''
+Module-level microbenchmarks on synthetic inputs.
+
+Times the forward (no grad) and forward+backward of the generator building
+blocks, the full generator, the discriminator and the VGG losses for every
+combination of resolution, batch size and thread count. Blocks get inputs of
+the shape they see inside the generator at the given image resolution. Run
+from the repo root:
+
+    python -m benchmarks.modules --resolutions 64 128 --batch-sizes 1 4 --threads 1 4 --output bench.json
+    python -m benchmarks.modules --output new.json --compare bench.json --tolerance 0.1
+
+With --compare every case whose median is more than `tolerance` slower than
+in the baseline is reported and the exit code is 1.
+'''
+
+DIM = 48
+
+
+def _generator_inputs(batch, size):
+    from src.models import mask_pyramid
+
+    images = torch.rand(batch, 3, size, size)
+    masks = (torch.rand(batch, 1, size, size) > 0.7).float().repeat(1, 3, 1, 1)
+    return [(images * (1 - masks)) + masks, masks] + list(mask_pyramid(masks))
+
+
+def _gated_emb(batch, size):
+    from src.networks import GatedEmb
+    return GatedEmb(in_c=6, dim=DIM), [torch.rand(batch, 6, size, size)]
+
+
+def _oreo(batch, size):
+    from src.networks import Oreo
+    return (Oreo(DIM, num_heads=1, ffn_expansion_factor=2.66, bias=False, LayerNorm_type='WithBias'),
+            [torch.randn(batch, DIM, size, size)])
+
+
+def _oreo_latent(batch, size):
+    from src.networks import Oreo
+    return (Oreo(DIM * 8, num_heads=8, ffn_expansion_factor=2.66, bias=False, LayerNorm_type='WithBias'),
+            [torch.randn(batch, DIM * 8, size // 8, size // 8)])
+
+
+def _scsa(batch, size):
+    from src.networks import SCSA
+    return SCSA(DIM), [torch.randn(batch, DIM, size, size)]
+
+
+def _feed_forward(batch, size):
+    from src.networks import FeedForward
+    return FeedForward(DIM, 2.66, False), [torch.randn(batch, DIM, size, size)]
+
+
+def _downsample(batch, size):
+    # down1_2: level 1 features and the full resolution mask
+    from src.networks import Downsample
+    inputs = _generator_inputs(batch, size)
+    return Downsample(DIM), [torch.randn(batch, DIM, size, size), inputs[1]]
+
+
+def _upsample(batch, size):
+    # up2_1: level 2 features to full resolution
+    from src.networks import Upsample
+    return Upsample(DIM * 2), [torch.randn(batch, DIM * 2, size // 2, size // 2)]
+
+
+def _generator(batch, size):
+    from src.networks import SCSAF
+    return SCSAF(), _generator_inputs(batch, size)
+
+
+def _discriminator(batch, size):
+    from src.networks import Discriminator
+    return Discriminator(in_channels=3), [torch.rand(batch, 3, size, size)]
+
+
+def _perceptual_loss(batch, size):
+    from src.loss import PerceptualLoss
+    return PerceptualLoss(), [torch.rand(batch, 3, size, size), torch.rand(batch, 3, size, size)]
+
+
+def _style_loss(batch, size):
+    from src.loss import StyleLoss
+    return StyleLoss(), [torch.rand(batch, 3, size, size), torch.rand(batch, 3, size, size)]
+
+
+CASES = {
+    'gated_emb': _gated_emb,
+    'oreo': _oreo,
+    'oreo_latent': _oreo_latent,
+    'scsa': _scsa,
+    'feed_forward': _feed_forward,
+    'downsample': _downsample,
+    'upsample': _upsample,
+    'generator': _generator,
+    'discriminator': _discriminator,
+    'perceptual_loss': _perceptual_loss,
+    'style_loss': _style_loss,
+}
+
+MODES = ['forward', 'forward_backward']
+
+
+def _reduce(outputs):
+    # backward needs a scalar, the discriminator also returns its features
+    if isinstance(outputs, torch.Tensor):
+        return outputs.float().sum()
+    return sum(_reduce(output) for output in outputs)
+
+
+def _sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def time_case(module, inputs, mode, device, warmup, repeat):
+    module = module.to(device).train(mode == 'forward_backward')
+    inputs = [x.to(device) for x in inputs]
+
+    if mode == 'forward':
+        def run():
+            with torch.no_grad():
+                module(*inputs)
+    else:
+        # the first input stands in for the generator output of the losses
+        inputs[0].requires_grad_(True)
+
+        def run():
+            module.zero_grad(set_to_none=True)
+            inputs[0].grad = None
+            _reduce(module(*inputs)).backward()
+
+    for _ in range(warmup):
+        run()
+    _sync(device)
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        _sync(device)
+        times.append((time.perf_counter() - start) * 1e3)
+    return times
+
+
+def case_key(name, mode, size, batch, threads):
+    return '%s/%s/r%d/b%d/t%d' % (name, mode, size, batch, threads)
+
+
+def compare(results, baseline, tolerance):
+    # a case regresses when its median is more than `tolerance` above the baseline median
+    regressions = []
+    for key, result in sorted(results.items()):
+        reference = baseline.get(key)
+        if reference is None or 'median_ms' not in result or 'median_ms' not in reference:
+            continue
+        ratio = result['median_ms'] / reference['median_ms']
+        marker = ''
+        if ratio > 1 + tolerance:
+            regressions.append(key)
+            marker = '  REGRESSION'
+        elif ratio < 1 - tolerance:
+            marker = '  faster'
+        print('%-48s %9.2fms -> %9.2fms  %+6.1f%%%s' % (key, reference['median_ms'], result['median_ms'],
+                                                     (ratio - 1) * 100, marker))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='module-level microbenchmarks on synthetic inputs')
+    parser.add_argument('--cases', type=str, nargs='+', default=list(CASES), choices=list(CASES))
+    parser.add_argument('--modes', type=str, nargs='+', default=MODES, choices=MODES)
+    parser.add_argument('--resolutions', type=int, nargs='+', default=[64, 128], help='image sizes, multiples of 64')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1])
+    parser.add_argument('--threads', type=int, nargs='+', default=[torch.get_num_threads()])
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--warmup', type=int, default=2, help='untimed runs per case')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per case')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default=None, help='write the results as json')
+    parser.add_argument('--compare', type=str, default=None, help='baseline json written by --output')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative slowdown of the median')
+    args = parser.parse_args(argv)
+
+    device = torch.device(args.device)
+    results = {}
+    for threads in args.threads:
+        torch.set_num_threads(threads)
+        for name in args.cases:
+            for size in args.resolutions:
+                for batch in args.batch_sizes:
+                    for mode in args.modes:
+                        key = case_key(name, mode, size, batch, threads)
+                        torch.manual_seed(args.seed)
+                        try:
+                            module, inputs = CASES[name](batch, size)
+                            times = time_case(module, inputs, mode, device, args.warmup, args.repeat)
+                        except RuntimeError as e:
+                            # e.g. the VGG weights are not cached on an offline machine
+                            results[key] = {'skipped': str(e).splitlines()[0]}
+                            print('%-48s skipped: %s' % (key, results[key]['skipped']))
+                            continue
+
+                        results[key] = {'min_ms': min(times), 'median_ms': statistics.median(times),
+                                        'mean_ms': statistics.mean(times), 'runs': times}
+                        print('%-48s min %9.2fms  median %9.2fms' % (key, min(times), statistics.median(times)))
+
+    if args.output:
+        meta = {'torch': torch.__version__, 'python': platform.python_version(), 'machine': platform.machine(),
+                'processor': platform.processor(), 'device': str(device), 'warmup': args.warmup,
+                'repeat': args.repeat}
+        with open(args.output, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        print('\ncompared with %s (tolerance %.0f%%)' % (args.compare, args.tolerance * 100))
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('\n%d regression(s): %s' % (len(regressions), ', '.join(regressions)))
+            return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
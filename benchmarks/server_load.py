@@ -0,0 +1,125 @@
+import io
+import sys
+import json
+import time
+import base64
+import argparse
+import threading
+import urllib.request
+import numpy as np
+from PIL import Image
+
+'''
+Load generator for `src.server`.
+
+Sends `--requests` inpainting requests from `--concurrency` client threads
+with random images of the given sizes (mixed sizes exercise the per-shape
+batching) and reports client-side latency percentiles, throughput and the
+server's /metrics afterwards. Start a server first, e.g.
+
+    python -m src.server --port 8080 &
+    python -m benchmarks.server_load --url http://127.0.0.1:8080 --concurrency 16 --requests 500 --sizes 256 512
+'''
+
+
+def encode_png(array):
+    buffer = io.BytesIO()
+    Image.fromarray(array).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def make_payloads(sizes, count, raw, seed):
+    # pre-encoded requests, so the client does not compete with the server for cpu while sending
+    rng = np.random.RandomState(seed)
+    payloads = []
+    for i in range(count):
+        size = sizes[i % len(sizes)]
+        image = rng.randint(0, 256, (size, size, 3), dtype=np.uint8)
+        mask = np.zeros((size, size), np.uint8)
+        y, x = rng.randint(0, size // 2, 2)
+        mask[y:y + size // 2, x:x + size // 2] = 255
+
+        if raw:
+            headers = {'Content-Type': 'application/octet-stream', 'X-Height': str(size), 'X-Width': str(size)}
+            body = image.tobytes() + mask.tobytes()
+        else:
+            headers = {'Content-Type': 'application/json'}
+            body = json.dumps({'image': base64.b64encode(encode_png(image)).decode('ascii'),
+                               'mask': base64.b64encode(encode_png(mask)).decode('ascii')}).encode('utf-8')
+        payloads.append((headers, body))
+    return payloads
+
+
+def send(url, headers, body, timeout):
+    request = urllib.request.Request(url + '/inpaint', data=body, headers=headers, method='POST')
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        response.read()
+        return response.status
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='load generator for the inpainting server')
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:8080')
+    parser.add_argument('--concurrency', type=int, default=8, help='client threads')
+    parser.add_argument('--requests', type=int, default=200, help='total requests')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256])
+    parser.add_argument('--raw', action='store_true', help='send raw arrays instead of base64 PNG json')
+    parser.add_argument('--payloads', type=int, default=16, help='distinct pre-encoded requests')
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default=None, help='write the results as json')
+    args = parser.parse_args(argv)
+
+    payloads = make_payloads(args.sizes, args.payloads, args.raw, args.seed)
+    latencies = []
+    errors = []
+    counter = iter(range(args.requests))
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                index = next(counter, None)
+            if index is None:
+                return
+            headers, body = payloads[index % len(payloads)]
+            start = time.perf_counter()
+            try:
+                send(args.url, headers, body, args.timeout)
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client) for _ in range(args.concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    results = {'requests': args.requests, 'errors': len(errors), 'elapsed_s': elapsed,
+               'throughput_per_s': len(latencies) / elapsed}
+    if latencies:
+        samples = np.array(latencies) * 1e3
+        p50, p90, p99 = np.percentile(samples, [50, 90, 99])
+        results.update({'mean_ms': float(samples.mean()), 'p50_ms': float(p50), 'p90_ms': float(p90),
+                        'p99_ms': float(p99)})
+
+    with urllib.request.urlopen(args.url + '/metrics', timeout=args.timeout) as response:
+        results['server'] = json.loads(response.read())
+
+    print(json.dumps(results, indent=2))
+    if errors:
+        print('first error: %s' % errors[0])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
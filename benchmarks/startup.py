@@ -0,0 +1,85 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import statistics
+
+'''
+Import-time / startup benchmark.
+
+Every target runs in a fresh interpreter so module caches do not hide the
+cost, the reported time includes interpreter startup. Run from the repo root:
+
+    python -m benchmarks.startup --repeat 5 --importtime
+'''
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TARGETS = {
+    'python': 'pass',
+    'import_torch': 'import torch',
+    'import_scsaf': 'import src.SCSAF',
+    'import_pipeline': 'import src.pipeline',
+    'pipeline_init': 'from src.pipeline import InpaintPipeline; InpaintPipeline({weights!r}, device="cpu")',
+    'first_image': 'import numpy as np; from src.pipeline import InpaintPipeline; '
+                   'p = InpaintPipeline({weights!r}, device="cpu"); '
+                   'p(np.zeros(({size}, {size}, 3), np.uint8), np.zeros(({size}, {size}), np.uint8))',
+}
+
+
+def run_once(code, importtime=False):
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', code]
+    start = time.perf_counter()
+    result = subprocess.run(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError('%s failed:\n%s' % (code, result.stderr))
+    return elapsed, result.stderr
+
+
+def slowest_imports(stderr, top=10):
+    # `-X importtime` lines: "import time: self [us] | cumulative | imported package"
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = [part.strip() for part in line[len('import time:'):].split('|')]
+        rows.append((int(cumulative_us), int(self_us), name.strip()))
+    # keep top level packages only, their cumulative time includes the children
+    rows = [row for row in rows if '.' not in row[2]]
+    return [{'module': name, 'cumulative_ms': cumulative / 1e3, 'self_ms': own / 1e3}
+            for cumulative, own, name in sorted(rows, reverse=True)[:top]]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='startup / import time benchmark')
+    parser.add_argument('--targets', type=str, nargs='+', default=list(TARGETS), choices=list(TARGETS))
+    parser.add_argument('--repeat', type=int, default=3, help='fresh interpreters per target')
+    parser.add_argument('--weights', type=str, default=None, help='generator weights for the pipeline targets')
+    parser.add_argument('--size', type=int, default=256, help='image size of the first_image target')
+    parser.add_argument('--importtime', action='store_true', help='also report the slowest top level imports')
+    parser.add_argument('--output', type=str, default=None, help='write the results as json')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name in args.targets:
+        code = TARGETS[name].format(weights=args.weights, size=args.size)
+        times = [run_once(code)[0] for _ in range(args.repeat)]
+        results[name] = {'min_s': min(times), 'median_s': statistics.median(times), 'runs': times}
+        print('%-16s min %7.3fs  median %7.3fs' % (name, min(times), statistics.median(times)))
+
+        if args.importtime:
+            _, stderr = run_once(code, importtime=True)
+            results[name]['slowest_imports'] = slowest_imports(stderr)
+            for row in results[name]['slowest_imports']:
+                print('    %-24s %8.1fms' % (row['module'], row['cumulative_ms']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,47 +1,46 @@
 
 import os
-import cv2
 import random
 import numpy as np
 import torch
 import argparse
-from shutil import copyfile
 from src.config import Config
 from src.SCSAF import SCSAF
-import wandb
+from src.pretrained import set_pretrained_path
+from src.utils import set_threads
 
 
 def main(mode=None):
-    config_path = "XXX/config.yml"
-    config = Config(config_path)
+    config = load_config(mode)
     config.print()
-
-    # Initialize wandb
-    with wandb.init(project='Rstormer', config=config):
-        # Set CUDA visible devices
-        os.environ['CUDA_VISIBLE_DEVICES'] = ','.join(str(e) for e in config.GPU)
-
-        # Init device
-        if torch.cuda.is_available():
-            print('Cuda is available')
-            config.DEVICE = torch.device("cuda")
-            torch.backends.cudnn.benchmark = True  # cudnn auto-tuner
-        else:
-            print('Cuda is unavailable, use cpu')
-            config.DEVICE = torch.device("cpu")
-
-        # Set cv2 running threads to 1 (prevents deadlocks with pytorch dataloader)
-        cv2.setNumThreads(0)
-
-        # Initialize random seed
-        torch.manual_seed(config.SEED)
-        torch.cuda.manual_seed_all(config.SEED)
-        np.random.seed(config.SEED)
-        random.seed(config.SEED)
-
-        # Build the model and initialize
-        
-        model = SCSAF(config)
+    set_pretrained_path(config.PRETRAINED_PATH)
+
+    # Set CUDA visible devices
+    os.environ['CUDA_VISIBLE_DEVICES'] = ','.join(str(e) for e in config.GPU)
+
+    # Init device
+    if torch.cuda.is_available():
+        print('Cuda is available')
+        config = config.replace(DEVICE=torch.device("cuda"))
+        torch.backends.cudnn.benchmark = True  # cudnn auto-tuner
+    else:
+        print('Cuda is unavailable, use cpu')
+        config = config.replace(DEVICE=torch.device("cpu"))
+
+    # cv2 / torch thread pools, CV2_THREADS 0 prevents deadlocks with the pytorch dataloader
+    # (`python -m src.autotune` measures the best values for this machine)
+    set_threads(config)
+
+    # Initialize random seed
+    torch.manual_seed(config.SEED)
+    torch.cuda.manual_seed_all(config.SEED)
+    np.random.seed(config.SEED)
+    random.seed(config.SEED)
+
+    # Build the model and initialize
+    
+    model = SCSAF(config)
+    try:
         model.load()
 
         # Model training
@@ -55,51 +54,49 @@ def main(mode=None):
         # elif mode == 2:
             print('\nstart testing...\n')
             model.test()
+    finally:
+        model.telemetry.close()
 
-def load_config(mode=None):
+def load_config(mode=None, argv=None):
     """loads model config
 
     Args:
         mode (int): 1: train, 2: test, reads from config file if not specified
+        argv (list): command line arguments, sys.argv if not specified
     """
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('--path', '--checkpoints', type=str, default='XXX',
-                        help='model checkpoints path (default: ./checkpoints)')
-    parser.add_argument('--model', type=int, default=2, choices=[2, 3])
+    parser.add_argument('--config', type=str, default='./config.yml', help='path to config.yml (default: ./config.yml)')
+    parser.add_argument('--path', '--checkpoints', type=str, help='model checkpoints path, overrides PATH')
+    parser.add_argument('--set', dest='overrides', metavar='KEY=VALUE', action='append', default=[],
+                        help='override a config value, can be repeated, e.g. --set MAX_ITERS=100000')
 
     if mode == 2:
         parser.add_argument('--input', type=str, help='path to the input images directory or an input image')
         parser.add_argument('--mask', type=str, help='path to the masks directory or a mask file')
         parser.add_argument('--output', type=str, help='path to the output directory')
 
-    args = parser.parse_args()
-    config_path = os.path.join(args.path, 'config.yml')
-    if not os.path.exists(config_path):
-        copyfile('./config.yml', config_path)
-
-    config = Config(config_path)
-    print(f"Config path: {config_path}")
+    args = parser.parse_args(argv)
+    print(f"Config path: {args.config}")
 
-    if mode == 1:
-        config.MODE = 1
-        if args.model:
-            config.MODEL = args.model
+    values = {}
+    if mode is not None:
+        values['MODE'] = mode
 
-    elif mode == 2:
-        config.MODE = 2
-        config.MODEL = args.model if args.model is not None else 3
+    if args.path:
+        values['PATH'] = args.path
 
+    if mode == 2:
         if args.input:
-            config.TEST_INPAINT_IMAGE_FLIST = args.input
+            values['TEST_INPAINT_IMAGE_FLIST'] = args.input
 
         if args.mask:
-            config.TEST_MASK_FLIST = args.mask
+            values['TEST_MASK_FLIST'] = args.mask
 
         if args.output:
-            config.RESULTS = args.output
+            values['RESULTS'] = args.output
 
-    return config
+    return Config(args.config, args.overrides, **values)
 
 if __name__ == "__main__":
     main()
@@ -4,17 +4,13 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.utils.data import DataLoader
-from .dataset import Dataset
+from .dataset import Dataset, ResumableSampler
 from .models import InpaintingModel
 from .utils import Progbar, create_dir, stitch_images, imsave
-from .metrics import PSNR
-from cv2 import circle
-from PIL import Image
-from skimage.metrics import structural_similarity as compare_ssim
-from skimage.metrics import peak_signal_noise_ratio as compare_psnr
-import wandb
-import lpips
-import torchvision
+from .metrics import PSNR, MetricsAccumulator, EvalMetrics
+from .telemetry import create_telemetry
+from .snapshot import SnapshotWriter
+from .profiler import StageTimer, TraceWindow
 import time
 
 '''
@@ -22,7 +18,6 @@ This repo is modified basing on Edge-Connect
 https://github.com/knazeri/edge-connect
 '''
 
-#wandb.init(project='Rstormer',  mode="offline")
 class SCSAF():
     def __init__(self, config):
         self.config = config
@@ -34,10 +29,9 @@ class SCSAF():
         self.model_name = model_name
 
         self.inpaint_model = InpaintingModel(config).to(config.DEVICE)
-        self.transf = torchvision.transforms.Compose(
-            [
-                torchvision.transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])])
-        self.loss_fn_vgg = lpips.LPIPS(net='vgg').to(config.DEVICE)
+        # lpips is only needed by test(), it is built there on first use
+        self.loss_fn_vgg = None
+        self.eval_metrics = None
 
         self.psnr = PSNR(255.0).to(config.DEVICE)
         self.cal_mae = nn.L1Loss(reduction='sum')
@@ -66,43 +60,85 @@ class SCSAF():
             self.debug = True
 
         self.log_file = os.path.join(config.PATH, 'log_' + model_name + '.dat')
+        self.telemetry = create_telemetry(config)
 
     def load(self):#加载模型权重。
 
         if self.config.MODEL == 2:
             self.inpaint_model.load()
 
-    def save(self):
+    def save(self, extra=None):
         if self.config.MODEL == 2:
-            self.inpaint_model.save()
+            self.inpaint_model.save(extra)
 
-    def train(self):
-        wandb.watch(self.inpaint_model, self.psnr, log='all', log_freq=10)
+    def trace_window(self, name):
+        # operator-level trace of TRACE_STEPS steps, opened at TRACE_START or on SIGUSR1
+        config = self.config
+        return TraceWindow(os.path.join(config.PATH, 'traces'), name,
+                           modules=[self.inpaint_model],
+                           start=config.TRACE_START, steps=config.TRACE_STEPS, memory=bool(config.TRACE_MEMORY),
+                           shapes=bool(config.TRACE_SHAPES), signal=bool(config.TRACE_SIGNAL))
 
+    def train(self):
+        # BATCH_SIZE: auto is resolved once per run, a resumed run keeps the batch its checkpoint was trained with
+        resume_state = self.inpaint_model.resume_state
+        if self.config.BATCH_SIZE == 'auto':
+            if 'batch_size' in resume_state:
+                print('BATCH_SIZE auto: %d (from the checkpoint)' % resume_state['batch_size'])
+                self.config = self.config.replace(BATCH_SIZE=resume_state['batch_size'])
+            else:
+                from .memory import auto_batch_size
+                self.config = self.config.replace(BATCH_SIZE=auto_batch_size(self.config))
+
+        sampler = ResumableSampler(self.train_dataset, seed=self.config.SEED)
         train_loader = DataLoader(
             dataset=self.train_dataset,
             batch_size=self.config.BATCH_SIZE,
-            num_workers=4,
+            num_workers=self.config.NUM_WORKERS,
             drop_last=True,
-            shuffle=True
+            sampler=sampler
         )
 
         epoch = 0
+        if 'sampler' in resume_state:
+            sampler.load_state_dict(resume_state['sampler'])
+            epoch = sampler.epoch - 1
         keep_training = True
         model = self.config.MODEL
-        max_iteration = int(float((self.config.MAX_ITERS)))
+        max_iteration = self.config.MAX_ITERS
         total = len(self.train_dataset)
+
+        # per-step metrics stay on the device until the next LOG_INTERVAL
+        train_metrics = self.config.TRAIN_METRICS
+        metrics = MetricsAccumulator(self.log_file, os.path.splitext(self.log_file)[0] + '.jsonl',
+                                     buffer_size=self.config.LOG_BUFFER_SIZE)
+
+        # training samples are encoded and written on a background thread
+        snapshots = SnapshotWriter(os.path.join(self.results_path, self.model_name),
+                                   sample_size=self.config.SAMPLE_SIZE)
+
+        # per-stage wall times, a no-op unless PROFILE_STAGES is set
+        timer = StageTimer(os.path.join(self.config.PATH, 'profile_' + self.model_name + '.jsonl'),
+                           interval=self.config.PROFILE_INTERVAL, sync=bool(self.config.PROFILE_SYNC),
+                           enabled=bool(self.config.PROFILE_STAGES))
+        self.inpaint_model.timer = timer
+        trace = self.trace_window('train')
+        trace.step(self.inpaint_model.iteration)
         while (keep_training):
             epoch += 1
             print('\n\nTraining epoch: %d' % epoch)
 
             progbar = Progbar(total, width=20, stateful_metrics=['epoch', 'iter'])
+            sampler.set_epoch(epoch)
+            consumed = sampler.start
 
-            for items in train_loader:
+            for items in timer.iterate('loader', train_loader):
+                consumed += self.config.BATCH_SIZE
 
                 self.inpaint_model.train()
                 if model == 2:
-                    images, masks = self.cuda(*items)
+                    with timer.stage('host_to_device'):
+                        images, masks = self.cuda(*items)
 
                     if masks.shape[1] == 1:
                         masks = masks.repeat(1, 3, 1, 1)
@@ -110,83 +146,82 @@ class SCSAF():
                         images, masks)
                     outputs_merged = (outputs_img * masks) + (images * (1 - masks))
 
-                    psnr = self.psnr(self.postprocess(images), self.postprocess(outputs_merged))
-                    mae = (torch.sum(torch.abs(images - outputs_merged)) / torch.sum(images)).float()
-
-
-                    if isinstance(psnr, torch.Tensor):
-                        logs.append(('psnr', psnr.item()))
-                    else:
-                        logs.append(('psnr', psnr))
+                    with timer.stage('metrics'):
+                        if 'psnr' in train_metrics:
+                            psnr = self.psnr(self.postprocess(images), self.postprocess(outputs_merged))
+                            logs.append(('psnr', psnr))
 
+                        if 'mae' in train_metrics:
+                            mae = (torch.sum(torch.abs(images - outputs_merged)) / torch.sum(images)).float()
+                            logs.append(('mae', mae))
 
-
-                    logs.append(('mae', mae.item()))
-
+                        metrics.update(logs)
 
                     self.inpaint_model.backward(gen_loss, dis_loss)
                     iteration = self.inpaint_model.iteration
 
+                    with timer.stage('telemetry'):
+                        if self.telemetry.due('scalars', iteration):
+                            self.telemetry.log_scalars({'gen_loss': gen_loss, 'l1_loss': gen_l1_loss,
+                                                        'style_loss': gen_style_loss,
+                                                        'perceptual loss': gen_content_loss,
+                                                        'gen_gan_loss': gen_gan_loss, 'dis_loss': dis_loss},
+                                                       iteration)
+                        if self.telemetry.due('histograms', iteration):
+                            self.telemetry.log_histograms(self.inpaint_model.generator, iteration)
+                        if self.telemetry.due('images', iteration):
+                            self.telemetry.log_images({'train': torch.cat(
+                                [images, images * (1 - masks), outputs_img, outputs_merged], dim=3)}, iteration)
+
                 if iteration >= max_iteration:
                     keep_training = False
                     break
 
                 logs = [
-                           ("epoch", epoch),
-                           ("iter", iteration),
-                       ] + logs
+                    ("epoch", epoch),
+                    ("iter", iteration),
+                ]
 
-                progbar.add(len(images),
-                            values=logs if self.config.VERBOSE else [x for x in logs if not x[0].startswith('l_')])
-                if iteration % 10 == 0:
-                    wandb.log({'gen_loss': gen_loss, 'l1_loss': gen_l1_loss, 'style_loss': gen_style_loss,
-                               'perceptual loss': gen_content_loss, 'gen_gan_loss': gen_gan_loss,
-                               'dis_loss': dis_loss}, step=iteration)
-
-                ###################### visialization
-                if iteration % 40 == 0:
-                    create_dir(self.results_path)
-                    inputs = (images * (1 - masks))
-                    images_joint = stitch_images(
-                        self.postprocess(images),
-                        self.postprocess(inputs),
-                        self.postprocess(outputs_img),
-                        self.postprocess(outputs_merged),
-                        img_per_row=1
-                    )
-
-                    path_masked = os.path.join(self.results_path, self.model_name, 'masked')
-                    path_result = os.path.join(self.results_path, self.model_name, 'result')
-                    path_joint = os.path.join(self.results_path, self.model_name, 'joint')
-                    name = self.train_dataset.load_name(epoch - 1)[:-4] + '.png'
-
-                    create_dir(path_masked)
-                    create_dir(path_result)
-                    create_dir(path_joint)
-
-                    masked_images = self.postprocess(images * (1 - masks) + masks)[0]
-                    images_result = self.postprocess(outputs_merged)[0]
-
-                    print(os.path.join(path_joint, name[:-4] + '.png'))
+                # log model at checkpoints
+                with timer.stage('logging'):
+                    if self.config.LOG_INTERVAL and iteration % self.config.LOG_INTERVAL == 0:
+                        logs += metrics.flush(logs)
 
-                    images_joint.save(os.path.join(path_joint, name[:-4] + '.png'))
-                    imsave(masked_images, os.path.join(path_masked, name))
-                    imsave(images_result, os.path.join(path_result, name))
+                    progbar.add(len(images),
+                                values=logs if self.config.VERBOSE else [x for x in logs if not x[0].startswith('l_')])
 
-                    print(name + ' complete!')
+                ###################### visialization
+                if self.config.SAMPLE_INTERVAL and iteration % self.config.SAMPLE_INTERVAL == 0:
+                    with timer.stage('snapshot'):
+                        snapshots.save('%08d.png' % iteration, images, masks, outputs_img, outputs_merged)
 
                 ##############
 
-                # log model at checkpoints
-                if self.config.LOG_INTERVAL and iteration % self.config.LOG_INTERVAL == 0:
-                    self.log(logs)
-
                 # save model at checkpoints
                 if self.config.SAVE_INTERVAL and iteration % self.config.SAVE_INTERVAL == 0:
-                    self.save()
+                    with timer.stage('save'):
+                        self.save({'sampler': sampler.state_dict(consumed), 'batch_size': self.config.BATCH_SIZE})
+
+                timer.step(iteration)
+                trace.step(iteration)
+
+        # let the last background save finish before returning
+        metrics.flush([("epoch", epoch), ("iter", self.inpaint_model.iteration)])
+        metrics.close()
+        snapshots.close()
+        timer.flush(self.inpaint_model.iteration)
+        trace.close(self.inpaint_model.iteration)
+        self.inpaint_model.checkpoints.wait()
         print('\nEnd training....')
 
     def test(self):
+        if self.loss_fn_vgg is None:
+            import lpips
+
+            self.loss_fn_vgg = lpips.LPIPS(net='vgg').to(self.config.DEVICE)
+            self.eval_metrics = EvalMetrics(self.loss_fn_vgg, gaussian=bool(self.config.SSIM_GAUSSIAN)).to(self.config.DEVICE)
+        eval_metrics = self.eval_metrics
+        eval_metrics.reset()
 
         self.inpaint_model.eval()
         #model = self.config.MODEL
@@ -198,12 +233,9 @@ class SCSAF():
             batch_size=1,
         )
 
-        psnr_list = []
-        ssim_list = []
-        l1_list = []
-        lpips_list = []
-
         print('here')
+        trace = self.trace_window('test')
+        trace.step(0)
         index = 0
         for items in test_loader:
             images, masks = self.cuda(*items)
@@ -218,32 +250,26 @@ class SCSAF():
 
                 inputs = (images * (1 - masks))
                 with torch.no_grad():
-                    tsince = int(round(time.time() * 1000))
+                    tsince = time.perf_counter()
                     outputs_img = self.inpaint_model(images, masks)
-                    ttime_elapsed = int(round(time.time() * 1000)) - tsince
-                    print('test time elaspsed {}ms'.format(ttime_elapsed))
+                    if torch.cuda.is_available():
+                        torch.cuda.synchronize()
+                    # single cold measurement, see benchmarks/inference.py for warm percentiles
+                    print('test time elapsed {:.2f}ms'.format((time.perf_counter() - tsince) * 1e3))
                 outputs_merged = (outputs_img * masks) + (images * (1 - masks))
 
-                psnr, ssim = self.metric(images, outputs_merged)
-                psnr_list.append(psnr)
-                ssim_list.append(ssim)
-
-                if torch.cuda.is_available():
-                    pl = self.loss_fn_vgg(self.transf(outputs_merged[0].cpu()).cuda(),
-                                          self.transf(images[0].cpu()).cuda()).item()
-                    lpips_list.append(pl)
-                else:
-                    pl = self.loss_fn_vgg(self.transf(outputs_merged[0].cpu()), self.transf(images[0].cpu())).item()
-                    lpips_list.append(pl)
-
-                l1_loss = torch.nn.functional.l1_loss(outputs_merged, images, reduction='mean').item()
-                l1_list.append(l1_loss)
-
-                print("psnr:{}/{}  ssim:{}/{} l1:{}/{}  lpips:{}/{}  {}".format(psnr, np.average(psnr_list),
-                                                                                ssim, np.average(ssim_list),
-                                                                                l1_loss, np.average(l1_list),
-                                                                                pl, np.average(lpips_list),
-                                                                                len(ssim_list)))
+                with torch.no_grad():
+                    values = eval_metrics(outputs_merged, images, masks)
+                eval_metrics.update(values)
+
+                # progress line: the image values and the running means, one host copy each
+                current = dict(zip(values, torch.stack([value.mean().double() for value in values.values()]).tolist()))
+                means = eval_metrics.means()
+                print("psnr:{}/{}  ssim:{}/{} l1:{}/{}  lpips:{}/{}  {}".format(current['psnr'], means['psnr'],
+                                                                                current['ssim'], means['ssim'],
+                                                                                current['l1'], means['l1'],
+                                                                                current['lpips'], means['lpips'],
+                                                                                eval_metrics.count))
 
                 images_joint = stitch_images(
                     self.postprocess(images),
@@ -274,47 +300,17 @@ class SCSAF():
 
                 print(name + ' complete!')
 
+            trace.step(index)
 
-
-
-
-        dynamic_axes = {
-            'input': {0: 'batch_size', 2: 'height', 3: 'width'},
-            'output': {0: 'batch_size', 2: 'height', 3: 'width'}
-        }
-
-        dummy_input_images = torch.randn(1, 3, 256, 256, device=self.config.DEVICE)
-        dummy_input_masks = torch.randn(1, 3, 256, 256, device=self.config.DEVICE)
-
-        torch.onnx.export(
-            self.inpaint_model,
-            (dummy_input_images, dummy_input_masks),
-            'model.onnx',
-            input_names=['images','masks'],
-            output_names=['output'],
-
-            dynamic_axes={
-                'images': {0: 'batch_size', 2: 'height', 3: 'width'},
-                'masks': {0: 'batch_size', 2: 'height', 3: 'width'},
-                'output': {0: 'batch_size', 2: 'height', 3: 'width'}
-            },
-            opset_version=11
-        )
-
-        wandb.save('model.onnx')
+        trace.close(index)
 
         print('\nEnd Testing')
 
-        print('edge_psnr_ave:{} edge_ssim_ave:{} l1_ave:{} lpips:{}'.format(np.average(psnr_list),
-                                                                            np.average(ssim_list),
-                                                                            np.average(l1_list),
-                                                                            np.average(lpips_list)))
-
-    def log(self, logs):
-        with open(self.log_file, 'a') as f:
-            print('load the generator:')
-            f.write('%s\n' % ' '.join([str(item[1]) for item in logs]))
-            print('finish load')
+        means = eval_metrics.means()
+        print('edge_psnr_ave:{} edge_ssim_ave:{} l1_ave:{} lpips:{}'.format(means.get('psnr'), means.get('ssim'),
+                                                                            means.get('l1'), means.get('lpips')))
+        print('hole: psnr_ave:{} ssim_ave:{} l1_ave:{}'.format(means.get('psnr_hole'), means.get('ssim_hole'),
+                                                               means.get('l1_hole')))
 
     def cuda(self, *args):
         return (item.to(self.config.DEVICE) for item in args)
@@ -325,23 +321,6 @@ class SCSAF():
         img = img.permute(0, 2, 3, 1)
         return img.int()
 
-    def metric(self, gt, pre):
-        print("GT image size:", gt.shape)
-        print("Predicted image size:", pre.shape)
-
-        pre = pre.clamp_(0, 1) * 255.0
-        pre = pre.permute(0, 2, 3, 1)
-        pre = pre.detach().cpu().numpy().astype(np.uint8)[0]
-
-        gt = gt.clamp_(0, 1) * 255.0
-        gt = gt.permute(0, 2, 3, 1)
-        gt = gt.cpu().detach().numpy().astype(np.uint8)[0]
-
-        psnr = min(100, compare_psnr(gt, pre))
-        ssim = compare_ssim(gt, pre, multichannel=True, data_range=255, win_size=3)
-
-        return psnr, ssim
-
     class cal_mean_nme():
         sum = 0
         amount = 0
@@ -0,0 +1,262 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+'''
+Measures the fastest thread, worker and batch settings on this machine:
+
+    python -m src.autotune --config config.yml --write
+    python -m src.autotune --config config.yml --only inference --batch-sizes 1 4 8 16
+
+Three searches, each trial in a fresh spawned process (torch sizes its
+thread pools once per process):
+
+    train      NUM_THREADS, NUM_INTEROP_THREADS (and BATCH_SIZE with
+               --train-batch-sizes): InpaintingModel.process + backward on
+               random INPUT_SIZE batches, samples/s
+    loader     NUM_WORKERS, CV2_THREADS: the training DataLoader, samples/s;
+               the fewest workers that keep up with the training step win,
+               so the remaining cores are left to torch
+    inference  NUM_THREADS, INFER_BATCH_SIZE: InpaintPipeline.run on random
+               INPUT_SIZE batches, images/s
+
+Dimensions are searched one at a time, each with the best values found so
+far for the others. NUM_THREADS comes from the train search when MODE is 1
+and from the inference search otherwise. `--write` stores the winners in
+the config file, the full table goes to PATH/autotune.json.
+'''
+
+# the loader has to produce this much more than the training step consumes
+LOADER_MARGIN = 1.2
+
+
+def _powers(limit):
+    values = [2 ** i for i in range(limit.bit_length()) if 2 ** i <= limit]
+    return values if values[-1] == limit else values + [limit]
+
+
+def _time_loop(step, steps, warmup, sync):
+    for _ in range(warmup):
+        step()
+    sync()
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    sync()
+    return time.perf_counter() - start
+
+
+def _train_rate(config, steps, warmup, sync):
+    import torch
+    from .models import InpaintingModel
+
+    model = InpaintingModel(config).to(config.DEVICE)
+    model.train()
+    size, batch = config.INPUT_SIZE or 256, config.BATCH_SIZE
+    images = torch.rand(batch, 3, size, size, device=config.DEVICE)
+    masks = torch.zeros(batch, 3, size, size, device=config.DEVICE)
+    masks[:, :, size // 4:size * 3 // 4, size // 4:size * 3 // 4] = 1
+
+    def step():
+        outputs = model.process(images, masks)
+        model.backward(outputs[1], outputs[2])
+
+    return batch * steps / _time_loop(step, steps, warmup, sync)
+
+
+def _inference_rate(config, steps, warmup, sync):
+    import torch
+    from .pipeline import InpaintPipeline
+
+    pipeline = InpaintPipeline(None, device=config.DEVICE, batch_size=config.INFER_BATCH_SIZE)
+    size, batch = config.INPUT_SIZE or 256, config.INFER_BATCH_SIZE
+    images = torch.rand(batch, 3, size, size, device=pipeline.device)
+    masks = torch.zeros(batch, 1, size, size, device=pipeline.device)
+    masks[:, :, size // 4:size * 3 // 4, size // 4:size * 3 // 4] = 1
+
+    return batch * steps / _time_loop(lambda: pipeline.run(images, masks), steps, warmup, sync)
+
+
+def _loader_rate(config, steps, warmup, sync):
+    from torch.utils.data import DataLoader
+    from .dataset import Dataset
+
+    dataset = Dataset(config, config.TRAIN_INPAINT_IMAGE_FLIST, config.TRAIN_MASK_FLIST, augment=True, training=True)
+    loader = DataLoader(dataset, batch_size=config.BATCH_SIZE, num_workers=config.NUM_WORKERS, shuffle=True,
+                        drop_last=True)
+
+    def batches():
+        while True:
+            for items in loader:
+                yield items
+
+    iterator = batches()
+    return config.BATCH_SIZE * steps / _time_loop(lambda: next(iterator), steps, warmup, lambda: None)
+
+
+MEASURES = {'train': _train_rate, 'loader': _loader_rate, 'inference': _inference_rate}
+
+
+def _trial(job, connection):
+    # runs in a fresh process: size the thread pools, then measure
+    from .config import Config
+    from .utils import set_threads
+
+    kind, values, steps, warmup = job
+    try:
+        config = Config(None, **values)
+        set_threads(config)
+
+        import torch
+        cuda = config.DEVICE.type == 'cuda'
+        sync = torch.cuda.synchronize if cuda else (lambda: None)
+        connection.send({'rate': MEASURES[kind](config, steps, warmup, sync)})
+    except Exception as e:
+        connection.send({'error': '%s: %s' % (type(e).__name__, e)})
+
+
+def run_trial(kind, config, settings, steps=10, warmup=2):
+    """Samples per second of `kind` with `settings` (config keys) applied, None when the trial failed."""
+    import multiprocessing
+
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_trial, args=((kind, dict(config.to_dict(), **settings), steps, warmup), sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = {'error': 'trial process exited with code %s' % process.exitcode}
+    process.join()
+
+    label = ', '.join('%s=%s' % item for item in sorted(settings.items()))
+    if 'error' in result:
+        print('  %-9s %-60s failed: %s' % (kind, label, result['error']))
+        return None
+    print('  %-9s %-60s %8.2f samples/s' % (kind, label, result['rate']))
+    return result['rate']
+
+
+def search(kind, config, space, steps=10, warmup=2, choose=None):
+    """Searches the dimensions of `space` (key -> candidates) one at a time.
+
+    Returns:
+        (best settings, list of trials)
+    """
+    best = {key: candidates[0] if getattr(config, key) not in candidates else getattr(config, key)
+            for key, candidates in space.items()}
+    measured = {}
+    for key, candidates in space.items():
+        rates = {}
+        for candidate in candidates:
+            settings = dict(best, **{key: candidate})
+            label = tuple(sorted(settings.items()))
+            if label not in measured:
+                measured[label] = run_trial(kind, config, settings, steps, warmup)
+            if measured[label] is not None:
+                rates[candidate] = measured[label]
+        if rates:
+            best[key] = (choose or {}).get(key, lambda rates: max(rates, key=rates.get))(rates)
+
+    trials = [dict(settings, rate=rate) for settings, rate in measured.items()]
+    return best, trials
+
+
+def autotune(config, only=None, threads=None, interop_threads=(1, 2, 4), workers=None, cv2_threads=(0, 1, 2),
+             batch_sizes=(1, 2, 4, 8, 16), train_batch_sizes=None, steps=10, warmup=2):
+    """Runs the train, loader and inference searches, returns (winning config values, report)."""
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    threads = threads or _powers(cores)
+    workers = workers or [0] + _powers(min(cores, 32))
+    kinds = only or ['train', 'loader', 'inference']
+
+    values, report = {}, {'cores': cores}
+    train_rate = None
+    if 'train' in kinds:
+        print('train step:')
+        space = {'NUM_THREADS': threads, 'NUM_INTEROP_THREADS': list(interop_threads)}
+        if train_batch_sizes:
+            space['BATCH_SIZE'] = list(train_batch_sizes)
+        best, report['train'] = search('train', config, space, steps, warmup)
+        rates = [trial['rate'] for trial in report['train'] if trial['rate'] is not None]
+        train_rate = max(rates) if rates else None
+        if config.MODE == 1:
+            values.update(best)
+        elif 'BATCH_SIZE' in best:
+            values['BATCH_SIZE'] = best['BATCH_SIZE']
+
+    if 'loader' in kinds:
+        print('data loader:')
+        loader_config = config.replace(**{key: values[key] for key in ['BATCH_SIZE'] if key in values})
+
+        def fewest_workers(rates):
+            # fewest workers that keep the training step fed, the fastest when none does
+            enough = [count for count, rate in sorted(rates.items()) if rate >= LOADER_MARGIN * train_rate]
+            return enough[0] if enough else max(rates, key=rates.get)
+
+        best, report['loader'] = search('loader', loader_config,
+                                        {'NUM_WORKERS': list(workers), 'CV2_THREADS': list(cv2_threads)},
+                                        steps, warmup,
+                                        choose={'NUM_WORKERS': fewest_workers} if train_rate else None)
+        values.update(best)
+
+    if 'inference' in kinds:
+        print('inference:')
+        best, report['inference'] = search('inference', config,
+                                           {'NUM_THREADS': threads, 'INFER_BATCH_SIZE': list(batch_sizes)},
+                                           steps, warmup)
+        values['INFER_BATCH_SIZE'] = best['INFER_BATCH_SIZE']
+        if config.MODE != 1:
+            values['NUM_THREADS'] = best['NUM_THREADS']
+
+    report['winners'] = values
+    return values, report
+
+
+def main(argv=None):
+    import torch
+    from .config import Config, update_config_file
+
+    parser = argparse.ArgumentParser(description='find the fastest threads / workers / batch sizes on this machine')
+    parser.add_argument('--config', type=str, default='./config.yml')
+    parser.add_argument('--set', dest='overrides', metavar='KEY=VALUE', action='append', default=[])
+    parser.add_argument('--only', type=str, nargs='+', choices=sorted(MEASURES), default=None)
+    parser.add_argument('--threads', type=int, nargs='+', default=None, help='default: powers of two up to all cores')
+    parser.add_argument('--interop-threads', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--workers', type=int, nargs='+', default=None, help='default: 0 and powers of two')
+    parser.add_argument('--cv2-threads', type=int, nargs='+', default=[0, 1, 2])
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8, 16], help='inference batch sizes')
+    parser.add_argument('--train-batch-sizes', type=int, nargs='+', default=None,
+                        help='also search BATCH_SIZE (changes training dynamics, off by default)')
+    parser.add_argument('--steps', type=int, default=10, help='timed steps per trial')
+    parser.add_argument('--warmup', type=int, default=2, help='untimed steps per trial')
+    parser.add_argument('--write', action='store_true', help='store the winners in the config file')
+    args = parser.parse_args(argv)
+
+    config = Config(args.config, args.overrides)
+    config = config.replace(DEVICE=torch.device('cuda' if torch.cuda.is_available() else 'cpu'))
+    if config.BATCH_SIZE == 'auto':
+        from .memory import auto_batch_size
+        config = config.replace(BATCH_SIZE=auto_batch_size(config))
+
+    values, report = autotune(config, only=args.only, threads=args.threads, interop_threads=args.interop_threads,
+                              workers=args.workers, cv2_threads=args.cv2_threads, batch_sizes=args.batch_sizes,
+                              train_batch_sizes=args.train_batch_sizes, steps=args.steps, warmup=args.warmup)
+
+    os.makedirs(config.PATH, exist_ok=True)
+    with open(os.path.join(config.PATH, 'autotune.json'), 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+
+    print('\nbest settings:')
+    for key, value in values.items():
+        print('%s: %s' % (key, value))
+    if args.write:
+        update_config_file(args.config, values)
+        print('written to %s' % args.config)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
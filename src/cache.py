@@ -0,0 +1,165 @@
+import os
+import hashlib
+import threading
+import collections
+import numpy as np
+import torch
+
+
+def array_digest(array):
+    """sha256 of an array's dtype, shape and bytes (numpy arrays or torch tensors)."""
+    if not isinstance(array, np.ndarray):
+        array = array.detach().cpu()
+        if array.dtype == torch.bfloat16:
+            # numpy has no bfloat16, hash the raw 16 bit patterns
+            array = array.view(torch.int16)
+        array = array.numpy()
+    array = np.ascontiguousarray(array)
+    digest = hashlib.sha256()
+    digest.update(('%s%s' % (array.dtype.str, array.shape)).encode('ascii'))
+    digest.update(memoryview(array).cast('B'))
+    return digest.hexdigest()
+
+
+def state_digest(state_dict):
+    """sha256 over the names and values of a state dict, identifies a set of weights."""
+    digest = hashlib.sha256()
+    for name, tensor in sorted(state_dict.items()):
+        digest.update(name.encode('utf-8'))
+        digest.update(array_digest(tensor).encode('ascii'))
+    return digest.hexdigest()
+
+
+class ResultCache():
+    """Content-addressed cache of inference results.
+
+    Keys are built from the image, mask and weights digests. Results are
+    numpy arrays kept in an in-memory LRU tier and, when `path` is given, in
+    `.npy` files under `path` whose total size is kept below `disk_bytes` by
+    evicting the least recently used files. Disk hits are promoted to the
+    memory tier. All methods are thread-safe.
+
+    Arguments:
+        path: Directory of the on-disk tier, None for memory only.
+        memory_bytes: Size bound of the in-memory tier.
+        disk_bytes: Size bound of the on-disk tier.
+    """
+
+    def __init__(self, path=None, memory_bytes=256 * 2 ** 20, disk_bytes=10 * 2 ** 30):
+        self.path = path
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+
+        self._lock = threading.Lock()
+        self._memory = collections.OrderedDict()
+        self._memory_size = 0
+        self._disk = collections.OrderedDict()
+        self._disk_size = 0
+        self._stats = collections.Counter()
+
+        if path is not None:
+            self._scan()
+
+    @staticmethod
+    def key(image_digest, mask_digest, weights_digest):
+        return hashlib.sha256(('%s:%s:%s' % (image_digest, mask_digest, weights_digest)).encode('ascii')).hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key[:2], key + '.npy')
+
+    def _scan(self):
+        # rebuild the LRU order of the disk tier from the file access times
+        entries = []
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                if name.endswith('.npy'):
+                    stat = os.stat(os.path.join(root, name))
+                    entries.append((stat.st_mtime, name[:-4], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_size += size
+
+    def get(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self._stats['memory_hits'] += 1
+                return self._memory[key]
+
+            if key not in self._disk:
+                self._stats['misses'] += 1
+                return None
+            self._disk.move_to_end(key)
+
+        try:
+            value = np.load(self._file(key))
+            os.utime(self._file(key))
+        except (OSError, ValueError):
+            with self._lock:
+                self._forget_disk(key)
+                self._stats['misses'] += 1
+            return None
+
+        with self._lock:
+            self._stats['disk_hits'] += 1
+            self._put_memory(key, value)
+        return value
+
+    def put(self, key, value):
+        value = np.ascontiguousarray(value)
+        with self._lock:
+            self._put_memory(key, value)
+            if self.path is None or key in self._disk:
+                return
+
+        path = self._file(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '%s.tmp.%d.%d' % (path, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.save(f, value)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        with self._lock:
+            # another thread may have stored the same key meanwhile, count its file once
+            size = os.path.getsize(path)
+            self._disk_size += size - self._disk.pop(key, 0)
+            self._disk[key] = size
+            while self._disk_size > self.disk_bytes and len(self._disk) > 1:
+                evicted, _ = next(iter(self._disk.items()))
+                self._forget_disk(evicted)
+                try:
+                    os.remove(self._file(evicted))
+                except OSError:
+                    pass
+                self._stats['disk_evictions'] += 1
+
+    def _put_memory(self, key, value):
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+        self._memory[key] = value
+        self._memory_size += value.nbytes
+        while self._memory_size > self.memory_bytes and len(self._memory) > 1:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= evicted.nbytes
+            self._stats['memory_evictions'] += 1
+
+    def _forget_disk(self, key):
+        size = self._disk.pop(key, None)
+        if size is not None:
+            self._disk_size -= size
+
+    def stats(self):
+        with self._lock:
+            hits = self._stats['memory_hits'] + self._stats['disk_hits']
+            lookups = hits + self._stats['misses']
+            stats = {name: self._stats[name] for name in
+                     ['memory_hits', 'disk_hits', 'misses', 'memory_evictions', 'disk_evictions']}
+            stats.update(hit_rate=hits / lookups if lookups else None,
+                         memory_entries=len(self._memory), memory_bytes=self._memory_size,
+                         disk_entries=len(self._disk), disk_bytes=self._disk_size)
+            return stats
@@ -0,0 +1,135 @@
+import os
+import re
+import glob
+import random
+import threading
+import numpy as np
+import torch
+
+
+def snapshot(obj):
+    # detached host copy of every tensor in a (nested) state dict, so training
+    # can keep updating the live tensors while the copy is being serialized
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: snapshot(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+
+def get_rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def atomic_save(obj, path):
+    # write to a temp file in the target directory and rename over the final
+    # path, so a crash mid-write never leaves a truncated checkpoint behind
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+
+    tmp_path = '%s.tmp.%d' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            torch.save(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class CheckpointManager():
+    """Writes training checkpoints atomically on a background thread.
+
+    Arguments:
+        path: Directory holding the rotated checkpoints.
+        name: Checkpoint file prefix, files are named `<name>_<iteration>.pth`.
+        keep: Number of most recent checkpoints to keep (0: keep all).
+        async_save: Serialize on a background thread instead of blocking.
+    """
+
+    def __init__(self, path, name, keep=3, async_save=True):
+        self.path = path
+        self.name = name
+        self.keep = keep
+        self.async_save = async_save
+
+        self._thread = None
+        self._error = None
+        self._pattern = re.compile(re.escape(name) + r'_(\d+)\.pth$')
+
+    def checkpoint_path(self, iteration):
+        return os.path.join(self.path, '%s_%08d.pth' % (self.name, iteration))
+
+    def checkpoints(self):
+        found = []
+        for path in glob.glob(os.path.join(self.path, self.name + '_*.pth')):
+            match = self._pattern.search(os.path.basename(path))
+            if match:
+                found.append((int(match.group(1)), path))
+        return [path for _, path in sorted(found)]
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def save(self, state, iteration, extra_files=None):
+        """Queues `state` (already snapshotted) for writing.
+
+        Only one save is in flight at a time; a new save first waits for the
+        previous one to finish. `extra_files` is a list of `(path, obj)` pairs
+        written atomically alongside the checkpoint.
+        """
+        self.wait()
+        files = [(self.checkpoint_path(iteration), state)] + list(extra_files or [])
+
+        if self.async_save:
+            self._thread = threading.Thread(target=self._write, args=(files,), name='checkpoint-writer')
+            self._thread.start()
+        else:
+            self._write(files)
+            self._raise()
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._raise()
+
+    def _write(self, files):
+        try:
+            for path, obj in files:
+                atomic_save(obj, path)
+            self._prune()
+        except Exception as e:
+            self._error = e
+
+    def _prune(self):
+        if self.keep <= 0:
+            return
+        for path in self.checkpoints()[:-self.keep]:
+            os.remove(path)
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
@@ -1,4 +1,6 @@
 import os
+import re
+import sys
 import yaml
 
 DEFAULT_CONFIG = {
@@ -8,15 +10,30 @@ DEFAULT_CONFIG = {
     'NMS': 1,                       # 0: no non-max-suppression, 1: applies non-max-suppression on the external edges by multiplying by Canny
     'SEED': 10,                     # random seed
     'GPU': [0],                     # list of gpu ids
+    'PRETRAINED_PATH': None,        # local cache of the pretrained VGG backbones (None: torch hub default)
     'AUGMENTATION_TRAIN': 0,        # 1: train 0: false use augmentation to train landmark predictor
+    'DEBUG': 0,                     # 1: debug mode
+
+    'PATH': './checkpoints',        # model checkpoints path
+    'RESULTS': None,                # output path of test results (None: <PATH>/results)
+    'TRAIN_INPAINT_IMAGE_FLIST': None,
+    'TRAIN_MASK_FLIST': None,
+    'TEST_INPAINT_IMAGE_FLIST': None,
+    'TEST_MASK_FLIST': None,
 
     'LR': 0.0001,                   # learning rate
     'D2G_LR': 0.1,                  # discriminator/generator learning rate ratio
     'BETA1': 0.0,                   # adam optimizer beta1
     'BETA2': 0.9,                   # adam optimizer beta2
-    'BATCH_SIZE': 2,                # input batch size for training
+    'BATCH_SIZE': 2,                # input batch size for training, auto: largest that fits MEMORY_BUDGET_MB
     'INPUT_SIZE': 256,              # input image size for training 0 for original size
     'MAX_ITERS': 2e6,               # maximum number of iterations to train the model
+    'NUM_WORKERS': 4,               # DataLoader worker processes for training
+    'NUM_THREADS': 0,               # torch intra-op threads (0: torch default)
+    'NUM_INTEROP_THREADS': 0,       # torch inter-op threads (0: torch default)
+    'CV2_THREADS': 0,               # cv2 threads (0: none, avoids deadlocks with DataLoader workers)
+    'INFER_BATCH_SIZE': 8,          # batch size of InpaintPipeline.from_config
+    'MEMORY_BUDGET_MB': 0,          # memory a BATCH_SIZE: auto step may use (0: available at launch)
 
     'L1_LOSS_WEIGHT': 1,            # l1 loss weighthin
     'STYLE_LOSS_WEIGHT': 1,         # style loss weight
@@ -28,24 +45,255 @@ DEFAULT_CONFIG = {
     'GAN_POOL_SIZE': 0,             # fake images pool size
 
     'SAVE_INTERVAL': 1000,          # how many iterations to wait before saving model (0: never)
-    'SAMPLE_INTERVAL': 1000,        # how many iterations to wait before sampling (0: never)
-    'SAMPLE_SIZE': 12,              # number of images to sample
+    'CHECKPOINT_KEEP': 3,           # number of most recent resumable checkpoints to keep (0: keep all)
+    'CHECKPOINT_ASYNC': 1,          # 1: write checkpoints on a background thread, 0: block the training loop
+    'SAMPLE_INTERVAL': 1000,        # how many iterations to wait before saving training samples (0: never)
+    'SAMPLE_SIZE': 12,              # number of images of the batch in each training sample grid
     'EVAL_INTERVAL': 0,             # how many iterations to wait before model evaluation (0: never)
     'LOG_INTERVAL': 10,             # how many iterations to wait before logging training status (0: never)
-    'VERBOSE': True                 # 添加 VERBOSE 属性
+    'LOG_BUFFER_SIZE': 10,          # number of log records buffered before writing log_*.dat / log_*.jsonl
+    'TRAIN_METRICS': ['psnr', 'mae'],  # per-step training metrics (psnr, mae), [] to skip them
+    'SSIM_GAUSSIAN': 0,             # 1: test / sweep SSIM with the standard 11x11 Gaussian window, 0: 3x3 uniform
+    'VERBOSE': True,                # 添加 VERBOSE 属性
+
+    'TELEMETRY': 'local',           # none | local | wandb
+    'TELEMETRY_MODE': 'offline',    # wandb mode: online | offline
+    'TELEMETRY_PROJECT': 'Rstormer',  # wandb project
+    'TELEMETRY_FORMAT': 'jsonl',    # local scalar format: jsonl | csv
+    'TELEMETRY_SCALAR_INTERVAL': 10,  # how many iterations to wait before logging losses (0: never)
+    'TELEMETRY_HISTOGRAM_INTERVAL': 0,  # how many iterations to wait before logging weight/gradient histograms (0: never)
+    'TELEMETRY_IMAGE_INTERVAL': 0,  # how many iterations to wait before logging training images (0: never)
+    'TELEMETRY_FLUSH_INTERVAL': 5.0,  # seconds between flushes of the background writer
+
+    'PROFILE_STAGES': 0,            # 1: record per-stage step times to <PATH>/profile_*.jsonl
+    'PROFILE_INTERVAL': 100,        # number of steps aggregated per profile record
+    'PROFILE_SYNC': 1,              # 1: synchronize cuda around stages so kernels are attributed correctly
+    'TRACE_START': 0,               # first step of the torch.profiler trace window (0: only on SIGUSR1)
+    'TRACE_STEPS': 5,               # number of traced steps
+    'TRACE_MEMORY': 0,              # 1: record tensor allocations in the trace
+    'TRACE_SHAPES': 0,              # 1: record operator input shapes in the trace
+    'TRACE_SIGNAL': 1,              # 1: `kill -USR1 <pid>` opens a trace window in a running process
+}
+
+
+# expected type and valid range (min, max) or choices of every known key,
+# values are coerced and checked once when the config is loaded
+CONFIG_TYPES = {
+    'MODE': (int, [1, 2, 3]),
+    'MODEL': (int, [1, 2, 3, 4]),
+    'MASK': (int, [0, 1, 2, 3, 4, 5, 6]),
+    'NMS': (int, [0, 1]),
+    'SEED': (int, None),
+    'GPU': (list, None),
+    'PRETRAINED_PATH': (str, None),
+    'AUGMENTATION_TRAIN': (int, [0, 1]),
+    'DEBUG': (int, None),
+
+    'PATH': (str, None),
+    'RESULTS': (str, None),
+    'TRAIN_INPAINT_IMAGE_FLIST': (str, None),
+    'TRAIN_MASK_FLIST': (str, None),
+    'TEST_INPAINT_IMAGE_FLIST': (str, None),
+    'TEST_MASK_FLIST': (str, None),
+
+    'LR': (float, (0, None)),
+    'D2G_LR': (float, (0, None)),
+    'BETA1': (float, (0, 1)),
+    'BETA2': (float, (0, 1)),
+    'BATCH_SIZE': (int, (1, None)),
+    'INPUT_SIZE': (int, (0, None)),
+    'MAX_ITERS': (int, (1, None)),
+    'NUM_WORKERS': (int, (0, None)),
+    'NUM_THREADS': (int, (0, None)),
+    'NUM_INTEROP_THREADS': (int, (0, None)),
+    'CV2_THREADS': (int, (0, None)),
+    'INFER_BATCH_SIZE': (int, (1, None)),
+    'MEMORY_BUDGET_MB': (int, (0, None)),
+
+    'L1_LOSS_WEIGHT': (float, (0, None)),
+    'STYLE_LOSS_WEIGHT': (float, (0, None)),
+    'CONTENT_LOSS_WEIGHT': (float, (0, None)),
+    'INPAINT_ADV_LOSS_WEIGHT': (float, (0, None)),
+    'TV_LOSS_WEIGHT': (float, (0, None)),
+
+    'GAN_LOSS': (str, ['nsgan', 'lsgan', 'hinge']),
+    'GAN_POOL_SIZE': (int, (0, None)),
+
+    'SAVE_INTERVAL': (int, (0, None)),
+    'CHECKPOINT_KEEP': (int, (0, None)),
+    'CHECKPOINT_ASYNC': (int, [0, 1]),
+    'SAMPLE_INTERVAL': (int, (0, None)),
+    'SAMPLE_SIZE': (int, (1, None)),
+    'EVAL_INTERVAL': (int, (0, None)),
+    'LOG_INTERVAL': (int, (0, None)),
+    'LOG_BUFFER_SIZE': (int, (1, None)),
+    'TRAIN_METRICS': (list, None),
+    'SSIM_GAUSSIAN': (int, [0, 1]),
+    'VERBOSE': (bool, None),
+
+    'TELEMETRY': (str, ['none', 'local', 'wandb']),
+    'TELEMETRY_MODE': (str, ['online', 'offline']),
+    'TELEMETRY_PROJECT': (str, None),
+    'TELEMETRY_FORMAT': (str, ['jsonl', 'csv']),
+    'TELEMETRY_SCALAR_INTERVAL': (int, (0, None)),
+    'TELEMETRY_HISTOGRAM_INTERVAL': (int, (0, None)),
+    'TELEMETRY_IMAGE_INTERVAL': (int, (0, None)),
+    'TELEMETRY_FLUSH_INTERVAL': (float, (0, None)),
+
+    'PROFILE_STAGES': (int, [0, 1]),
+    'PROFILE_INTERVAL': (int, (1, None)),
+    'PROFILE_SYNC': (int, [0, 1]),
+    'TRACE_START': (int, (0, None)),
+    'TRACE_STEPS': (int, (1, None)),
+    'TRACE_MEMORY': (int, [0, 1]),
+    'TRACE_SHAPES': (int, [0, 1]),
+    'TRACE_SIGNAL': (int, [0, 1]),
 }
 
+# keys that may also be 'auto', resolved at launch (see src/memory.py)
+AUTO_KEYS = {'BATCH_SIZE'}
+
+
+def _coerce(value, kind):
+    if kind is int:
+        if isinstance(value, str):
+            value = float(value)
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise ValueError
+        return value
+
+    if kind is float:
+        if isinstance(value, bool):
+            raise ValueError
+        return float(value)
+
+    if kind is bool:
+        if isinstance(value, str) and value.lower() in ('true', 'yes', 'on', '1', 'false', 'no', 'off', '0'):
+            return value.lower() in ('true', 'yes', 'on', '1')
+        if value in (0, 1):
+            return bool(value)
+        raise ValueError
+
+    if kind is list:
+        if isinstance(value, str):
+            value = yaml.safe_load(value)
+        return list(value) if isinstance(value, (list, tuple)) else [value]
+
+    if not isinstance(value, kind):
+        raise ValueError
+    return value
+
+
+def validate(values):
+    """Coerces the known keys to their type and checks their range.
+
+    Numbers given as strings or integral floats (e.g. MAX_ITERS: "2e6") are
+    converted, anything that cannot be converted or is out of range raises
+    a ValueError naming the key. Unknown keys are kept as they are, keys of
+    AUTO_KEYS may be 'auto'.
+    """
+    values = dict(values)
+    for key, (kind, valid) in CONFIG_TYPES.items():
+        value = values.get(key)
+        if key in AUTO_KEYS and value == 'auto':
+            continue
+        if value is None:
+            if kind is not str:
+                raise ValueError("config key '%s' is required" % key)
+            continue
+
+        try:
+            value = _coerce(value, kind)
+        except (TypeError, ValueError):
+            raise ValueError("config key '%s' must be %s, got %r" % (key, kind.__name__, value))
+
+        if isinstance(valid, list) and value not in valid:
+            raise ValueError("config key '%s' must be one of %s, got %r" % (key, valid, value))
+        if isinstance(valid, tuple):
+            low, high = valid
+            if (low is not None and value < low) or (high is not None and value > high):
+                raise ValueError("config key '%s' must be in [%s, %s], got %r" % (key, low, high, value))
+
+        values[key] = value
+    return values
+
+
+def parse_overrides(overrides):
+    # ['KEY=VALUE', ...] => {KEY: VALUE}, values are parsed as yaml scalars / lists
+    parsed = {}
+    for override in overrides or []:
+        if '=' not in override:
+            raise ValueError("override '%s' is not of the form KEY=VALUE" % override)
+        key, value = override.split('=', 1)
+        parsed[key.strip()] = yaml.safe_load(value)
+    return parsed
+
+
+def update_config_file(path, values):
+    """Sets `values` in a yaml config file in place.
+
+    Existing `KEY: value` lines keep their position and trailing comment,
+    missing keys are appended.
+    """
+    with open(path, 'r', encoding='utf-8') as file:
+        lines = file.read().splitlines()
+
+    remaining = dict(values)
+    for index, line in enumerate(lines):
+        match = re.match(r'^([A-Za-z_][A-Za-z0-9_]*)(\s*:\s*)([^#]*?)(\s*#.*)?$', line)
+        if match and match.group(1) in remaining:
+            value = yaml.safe_dump(remaining.pop(match.group(1)), default_flow_style=True).strip()
+            value = value[:-4].strip() if value.endswith('...') else value
+            lines[index] = match.group(1) + match.group(2) + value + (match.group(4) or '')
+
+    for key, value in remaining.items():
+        value = yaml.safe_dump(value, default_flow_style=True).strip()
+        lines.append('%s: %s' % (key, value[:-4].strip() if value.endswith('...') else value))
+
+    tmp_path = '%s.tmp.%d' % (path, os.getpid())
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        file.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, path)
+
 
 class Config:
-    def __init__(self, config_path):
-        self._dict = DEFAULT_CONFIG.copy()  # Start with default config
-        self._dict.update(self.load_config(config_path))  # Update with file contents
-    def __getattr__(self, name):
-        print(f"Accessing attribute: {name}")
-        _dict = self.__dict__.get('_dict', {})
-        if name in _dict:
-            return _dict[name]
-        raise AttributeError(f"'Config' object has no attribute '{name}'")
+    """Typed, read-only model configuration.
+
+    Values come from DEFAULT_CONFIG, then the yaml file, then `overrides`
+    (a list of 'KEY=VALUE' strings, e.g. from `--set`), then keyword
+    arguments. Settings are plain instance attributes, so reading them costs
+    nothing; use `replace` to derive a modified config.
+    """
+
+    def __init__(self, config_path=None, overrides=None, **values):
+        data = DEFAULT_CONFIG.copy()  # Start with default config
+        if config_path is not None:
+            data.update(self.load_config(config_path) or {})  # Update with file contents
+
+        for key, value in parse_overrides(overrides).items():
+            if key not in data:
+                raise KeyError("unknown config key '%s'" % key)
+            data[key] = value
+
+        data.update(values)
+        data = validate(data)
+
+        self.__dict__.update(data)
+        self.__dict__['_dict'] = data
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Config is read-only, use config.replace(%s=...)" % name)
+
+    def __delattr__(self, name):
+        raise AttributeError("Config is read-only")
+
+    def replace(self, **values):
+        return Config(None, **dict(self._dict, **values))
+
+    def to_dict(self):
+        return dict(self._dict)
 
     def load_config(self, path):
         with open(path, 'r', encoding='utf-8') as file:
@@ -60,8 +308,8 @@ class Config:
 
 
 if __name__ == "__main__":
-    config_path = "XXX.config.yml"
+    config_path = sys.argv[1] if len(sys.argv) > 1 else "./config.yml"
 
 
-    config = Config(config_path)
+    config = Config(config_path, sys.argv[2:])
     config.print()
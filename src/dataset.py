@@ -1,18 +1,12 @@
 import os
 import glob
-import scipy
 import torch
 import random
 import numpy as np
-import torchvision.transforms.functional as F
-from torchvision import transforms
 from torch.utils.data import DataLoader
 from PIL import Image
 from imageio import imread
-from skimage.color import rgb2gray
 from .utils import create_mask
-import cv2
-from skimage.feature import canny
 
 class Dataset(torch.utils.data.Dataset):
     def __init__(self, config, flist, mask_flist, augment=True, training=True):
@@ -115,6 +109,8 @@ class Dataset(torch.utils.data.Dataset):
 
         # test mode: load mask non random
         if mask_type == 6:
+            from skimage.color import rgb2gray
+
             mask = imread(self.mask_data[index%len(self.mask_data)])
             mask = self.resize(mask, imgh, imgw, centerCrop=False)
             mask = rgb2gray(mask)
@@ -125,6 +121,8 @@ class Dataset(torch.utils.data.Dataset):
 
 
     def to_tensor(self, img):
+        import torchvision.transforms.functional as F
+
         img = Image.fromarray(img)
         img_t = F.to_tensor(img).float()
         return img_t
@@ -176,8 +174,45 @@ class Dataset(torch.utils.data.Dataset):
 
 
 
+class ResumableSampler(torch.utils.data.Sampler):
+    """Shuffling sampler whose position can be saved and restored mid-epoch.
+
+    The order of an epoch only depends on `seed` and the epoch number, so
+    skipping the first `start` samples reproduces the remainder of the epoch.
+    """
+
+    def __init__(self, data_source, seed=0):
+        self.data_source = data_source
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        order = torch.randperm(len(self.data_source), generator=generator).tolist()
+
+        start, self.start = self.start, 0
+        return iter(order[start:])
+
+    def __len__(self):
+        return len(self.data_source) - self.start
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def state_dict(self, consumed):
+        return {'epoch': self.epoch, 'start': consumed}
+
+    def load_state_dict(self, state):
+        self.epoch = state['epoch']
+        self.start = state['start']
+
+
+
 
 def image_transforms(load_size):
+    from torchvision import transforms
 
     return transforms.Compose([
 
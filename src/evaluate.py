@@ -0,0 +1,250 @@
+import os
+import csv
+import sys
+import json
+import argparse
+import numpy as np
+import torch
+
+'''
+Offline evaluation of saved results:
+
+    python -m src.evaluate GT_DIR RESULT_DIR [--masks MASK_DIR] [--workers 8] [--batch-size 32]
+
+Results are paired with ground-truth (and mask) files by file name without
+extension. Images are decoded by a process pool while the metrics of
+`EvalMetrics` (PSNR, SSIM, L1, LPIPS and, with masks, the hole-only
+variants) run batched on the main process device. One row per image is
+appended to the CSV (default: RESULT_DIR/metrics.csv), images already in the
+CSV are skipped, so an interrupted run continues where it stopped (a row cut
+off by the interruption is dropped and scored again; a CSV written with
+other columns, e.g. without `--masks`, is refused). Images whose result or
+mask size differs from the ground truth are listed as failed. The means
+over the whole CSV are written to the summary JSON.
+'''
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.webp')
+
+
+def list_images(path):
+    # file name without extension -> path
+    files = {}
+    for name in sorted(os.listdir(path)):
+        stem, extension = os.path.splitext(name)
+        if extension.lower() in IMAGE_EXTENSIONS:
+            files[stem] = os.path.join(path, name)
+    return files
+
+
+def _read_rgb(path):
+    from imageio import imread
+
+    img = imread(path)
+    if img.ndim == 2:
+        img = np.stack([img] * 3, axis=-1)
+    return np.ascontiguousarray(img[:, :, :3])
+
+
+def _load(job):
+    # runs in the worker processes, returns uint8 arrays
+    name, gt_path, result_path, mask_path = job
+    from imageio import imread
+
+    gt = _read_rgb(gt_path)
+    result = _read_rgb(result_path)
+    mask = None
+    if mask_path is not None:
+        mask = imread(mask_path)
+        mask = (mask.max(axis=2) if mask.ndim == 3 else mask) > 0
+    return name, gt, result, mask
+
+
+def csv_columns(use_lpips=True, has_masks=False):
+    columns = ['name', 'psnr', 'ssim', 'l1'] + (['lpips'] if use_lpips else [])
+    if has_masks:
+        columns += ['psnr_hole', 'ssim_hole', 'l1_hole']
+    return columns
+
+
+def read_done(csv_path, columns):
+    """Names already scored in `csv_path`, whose header must be `columns`.
+
+    A last row cut off by an interrupted run is removed from the file, so its
+    image is scored again.
+    """
+    if not os.path.exists(csv_path):
+        return set()
+    with open(csv_path, newline='') as f:
+        lines = f.readlines()
+
+    rows = list(csv.reader(lines))
+    if rows and (not lines[-1].endswith('\n') or len(rows[-1]) != len(rows[0])):
+        print('dropping the incomplete last row of %s' % csv_path)
+        lines, rows = lines[:-1], rows[:-1]
+        with open(csv_path, 'w', newline='') as f:
+            f.writelines(lines)
+
+    if rows and rows[0] != columns:
+        raise ValueError('%s has columns %s, this run writes %s (other --masks / --no-lpips settings); '
+                         'use another --csv' % (csv_path, ', '.join(rows[0]), ', '.join(columns)))
+    return {row[0] for row in rows[1:]}
+
+
+def summarize(csv_path):
+    with open(csv_path, newline='') as f:
+        rows = list(csv.DictReader(f))
+
+    means = {}
+    if rows:
+        for column in rows[0]:
+            if column != 'name':
+                values = [float(row[column]) for row in rows if row[column] not in ('', None)]
+                means[column] = float(np.mean(values)) if values else None
+    return {'count': len(rows), 'means': means}
+
+
+class Evaluator():
+    """Scores batches of decoded images and appends the rows to a CSV."""
+
+    def __init__(self, csv_path, device, batch_size=32, use_lpips=True, gaussian=False, has_masks=False):
+        from .metrics import EvalMetrics
+
+        self.device = torch.device(device)
+        self.batch_size = batch_size
+
+        lpips_fn = None
+        if use_lpips:
+            import lpips
+            lpips_fn = lpips.LPIPS(net='vgg', verbose=False)
+        self.metrics = EvalMetrics(lpips_fn, gaussian=gaussian).to(self.device).eval()
+
+        self.columns = csv_columns(use_lpips, has_masks)
+
+        new_file = not os.path.exists(csv_path) or os.path.getsize(csv_path) == 0
+        self._file = open(csv_path, 'a', newline='')
+        self._writer = csv.writer(self._file)
+        if new_file:
+            self._writer.writerow(self.columns)
+
+        self._pending = []
+        self.count = 0
+        self.failed = {}
+
+    def add(self, name, gt, result, mask):
+        if result.shape != gt.shape or (mask is not None and mask.shape != gt.shape[:2]):
+            self.failed[name] = 'size mismatch: ground truth %s, result %s%s' % (
+                gt.shape, result.shape, '' if mask is None else ', mask %s' % (mask.shape,))
+            print('failed %s: %s' % (name, self.failed[name]))
+            return
+
+        # equally sized images share a batch
+        if self._pending and (self._pending[0][1].shape != gt.shape or len(self._pending) >= self.batch_size):
+            self.flush()
+        self._pending.append((name, gt, result, mask))
+
+    def flush(self):
+        if not self._pending:
+            return
+
+        names = [item[0] for item in self._pending]
+        gt = torch.from_numpy(np.stack([item[1] for item in self._pending])).to(self.device).permute(0, 3, 1, 2)
+        result = torch.from_numpy(np.stack([item[2] for item in self._pending])).to(self.device).permute(0, 3, 1, 2)
+        masks = None
+        if self._pending[0][3] is not None:
+            masks = torch.from_numpy(np.stack([item[3] for item in self._pending]))[:, None].to(self.device)
+
+        with torch.no_grad():
+            values = self.metrics(result, gt, masks)
+
+        columns = self.columns[1:]
+        table = torch.stack([values[column].double() for column in columns], dim=1).tolist()
+        for name, row in zip(names, table):
+            self._writer.writerow([name] + row)
+        self._file.flush()
+
+        self.count += len(names)
+        self._pending = []
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+def evaluate(gt_dir, result_dir, mask_dir=None, csv_path=None, summary_path=None, workers=4, batch_size=32,
+             device=None, use_lpips=True, gaussian=False):
+    from multiprocessing import Pool
+
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    csv_path = csv_path or os.path.join(result_dir, 'metrics.csv')
+    summary_path = summary_path or os.path.splitext(csv_path)[0] + '.json'
+
+    gt_files = list_images(gt_dir)
+    result_files = list_images(result_dir)
+    mask_files = list_images(mask_dir) if mask_dir else {}
+
+    done = read_done(csv_path, csv_columns(use_lpips, bool(mask_dir)))
+    jobs = []
+    for name, result_path in result_files.items():
+        if name in done:
+            continue
+        if name not in gt_files or (mask_dir and name not in mask_files):
+            print('skipping %s: no ground truth%s' % (name, ' or mask' if mask_dir else ''))
+            continue
+        jobs.append((name, gt_files[name], result_path, mask_files.get(name)))
+
+    print('%d images to score, %d already in %s' % (len(jobs), len(done), csv_path))
+
+    evaluator = Evaluator(csv_path, device, batch_size=batch_size, use_lpips=use_lpips, gaussian=gaussian,
+                          has_masks=bool(mask_dir))
+    try:
+        if workers > 0:
+            with Pool(workers) as pool:
+                for item in pool.imap(_load, jobs, chunksize=max(1, min(16, len(jobs) // (workers * 4)))):
+                    evaluator.add(*item)
+        else:
+            for job in jobs:
+                evaluator.add(*_load(job))
+    finally:
+        evaluator.close()
+
+    summary = summarize(csv_path)
+    summary.update({'gt': gt_dir, 'results': result_dir, 'masks': mask_dir, 'failed': evaluator.failed})
+    with open(summary_path, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    print('scored %d images, summary of %d written to %s' % (evaluator.count, summary['count'], summary_path))
+    if evaluator.failed:
+        print('%d images failed, listed in the summary' % len(evaluator.failed))
+    for name, value in summary['means'].items():
+        print('    %-10s %s' % (name, value))
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='score saved results against ground truth')
+    parser.add_argument('gt', type=str, help='ground-truth image directory')
+    parser.add_argument('results', type=str, help='result image directory')
+    parser.add_argument('--masks', type=str, default=None, help='mask directory, adds hole-only metrics')
+    parser.add_argument('--csv', type=str, default=None, help='per-image CSV (default: <results>/metrics.csv)')
+    parser.add_argument('--summary', type=str, default=None, help='summary JSON (default: next to the CSV)')
+    parser.add_argument('--workers', type=int, default=4, help='decoding processes, 0 decodes in this process')
+    parser.add_argument('--batch-size', type=int, default=32, help='images per metrics batch')
+    parser.add_argument('--device', type=str, default=None)
+    parser.add_argument('--no-lpips', action='store_true', help='skip LPIPS')
+    parser.add_argument('--gaussian', action='store_true', help='Gaussian SSIM window instead of 3x3 uniform')
+    parser.add_argument('--pretrained', type=str, default=None, help='local pretrained weight cache (PRETRAINED_PATH)')
+    args = parser.parse_args(argv)
+
+    from .pretrained import set_pretrained_path
+    set_pretrained_path(args.pretrained)
+
+    summary = evaluate(args.gt, args.results, args.masks, csv_path=args.csv, summary_path=args.summary,
+                       workers=args.workers, batch_size=args.batch_size, device=args.device,
+                       use_lpips=not args.no_lpips, gaussian=args.gaussian)
+    if summary['failed']:
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
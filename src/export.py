@@ -0,0 +1,232 @@
+import os
+import sys
+import json
+import argparse
+import torch
+import torch.nn as nn
+
+'''
+Release export of the generator with a parity check:
+
+    python -m src.export --config config.yml --format onnx torchscript --sizes 256 512 --output XXX/export
+
+The exported graph takes `images` (N, 3, H, W) in [0, 1] and `masks`
+(N, 3, H, W), 1 marking the hole, and returns the generator output, i.e. the
+masking and the mask pyramid of `InpaintingModel.forward` are folded inside.
+One artifact is written per size bucket (`--sizes`, multiples of 64); with
+`--dynamic` the batch axis is dynamic and, for ONNX, a single file with
+dynamic height and width is written instead. `--fp16` stores half precision
+weights, inputs and outputs stay float32; it needs a cuda device, the FFT
+in `Upsample` has no half precision CPU kernels. ONNX goes through the
+dynamo exporter (onnxscript), the TorchScript-based one cannot lower the
+complex FFT ops.
+
+Every artifact is run on real test samples (`--samples` images of the
+config's test set) and compared with the eager fp32 `InpaintingModel.forward`;
+the differences are written to `export.json` and the command exits with 1
+when one exceeds `--atol`, an export fails, or an artifact cannot be run
+(e.g. onnxruntime missing) unless `--no-verify` is given.
+'''
+
+EXTENSIONS = {'onnx': '.onnx', 'torchscript': '.ts', 'export': '.pt2'}
+
+
+class ExportModule(nn.Module):
+    """`InpaintingModel.forward` as a standalone module with float32 inputs and outputs."""
+
+    def __init__(self, generator, dtype=torch.float32):
+        super(ExportModule, self).__init__()
+        self.generator = generator
+        self.dtype = dtype
+
+    def forward(self, images, masks):
+        from .models import inpaint_forward
+
+        outputs = inpaint_forward(self.generator, images.to(self.dtype), masks.to(self.dtype))
+        return outputs.float()
+
+
+def export_onnx(module, inputs, path, dynamic):
+    # the TorchScript-based exporter has no lowering for the complex FFT ops of `Upsample`,
+    # the dynamo exporter maps them to ONNX DFT
+    if not hasattr(torch.onnx, 'dynamo_export'):
+        raise RuntimeError('ONNX export of the generator needs the dynamo exporter (torch >= 2.1 with onnxscript)')
+    options = torch.onnx.ExportOptions(dynamic_shapes=dynamic)
+    torch.onnx.dynamo_export(module, *inputs, export_options=options).save(path)
+
+
+def export_torchscript(module, inputs, path, dynamic):
+    # traced graphs keep the sizes computed from the input shape, one file per bucket
+    traced = torch.jit.trace(module, inputs, check_trace=False)
+    torch.jit.save(traced, path)
+
+
+def export_program(module, inputs, path, dynamic):
+    dynamic_shapes = None
+    if dynamic:
+        batch = torch.export.Dim('batch', min=1, max=64)
+        dynamic_shapes = {'images': {0: batch}, 'masks': {0: batch}}
+    program = torch.export.export(module, inputs, dynamic_shapes=dynamic_shapes)
+    torch.export.save(program, path)
+
+
+EXPORTERS = {'onnx': export_onnx, 'torchscript': export_torchscript, 'export': export_program}
+
+
+def load_runner(fmt, path, device):
+    # returns f(images, masks) -> output tensor on `device`
+    if fmt == 'onnx':
+        import onnxruntime
+
+        providers = ['CUDAExecutionProvider', 'CPUExecutionProvider'] if device.type == 'cuda' else \
+            ['CPUExecutionProvider']
+        session = onnxruntime.InferenceSession(path, providers=providers)
+
+        def run(images, masks):
+            output, = session.run(None, {'images': images.cpu().numpy(), 'masks': masks.cpu().numpy()})
+            return torch.from_numpy(output).to(device)
+        return run
+
+    if fmt == 'torchscript':
+        module = torch.jit.load(path, map_location=device)
+    else:
+        module = torch.export.load(path).module()
+    return lambda images, masks: module(images, masks)
+
+
+def load_samples(config, count, size):
+    from .dataset import Dataset
+
+    dataset = Dataset(config.replace(INPUT_SIZE=size), config.TEST_INPAINT_IMAGE_FLIST, config.TEST_MASK_FLIST,
+                      augment=False, training=False)
+    images, masks = zip(*[dataset[i] for i in range(min(count, len(dataset)))])
+    images, masks = torch.stack(images), torch.stack(masks)
+    if masks.shape[1] == 1:
+        masks = masks.repeat(1, 3, 1, 1)
+    return images, masks
+
+
+def check_parity(run, reference, images, masks, batch=None):
+    # the eager reference is fp32 InpaintingModel.forward on the same samples,
+    # static artifacts are run `batch` samples at a time
+    with torch.no_grad():
+        expected = reference(images, masks)
+        if batch is None:
+            actual = run(images, masks).float()
+        else:
+            actual = torch.cat([run(images[i:i + batch], masks[i:i + batch]).float()
+                                for i in range(0, len(images), batch)])
+    diff = (actual - expected).abs()
+    return {'max_abs_diff': diff.max().item(), 'mean_abs_diff': diff.mean().item(), 'samples': len(images)}
+
+
+def main(argv=None):
+    from .config import Config
+    from .models import inpaint_forward
+    from .pipeline import InpaintPipeline
+
+    parser = argparse.ArgumentParser(description='export the generator and verify it against eager pytorch')
+    parser.add_argument('--config', type=str, default='./config.yml', help='path to config.yml (weights, test set)')
+    parser.add_argument('--set', dest='overrides', metavar='KEY=VALUE', action='append', default=[],
+                        help='override a config value, can be repeated')
+    parser.add_argument('--weights', type=str, default=None, help='generator weights (default: found in PATH)')
+    parser.add_argument('--format', type=str, nargs='+', default=['onnx'], choices=list(EXPORTERS))
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256], help='size buckets, multiples of 64')
+    parser.add_argument('--dynamic', action='store_true', help='dynamic batch (and onnx height/width) axes')
+    parser.add_argument('--fp16', action='store_true', help='half precision weights and compute')
+    parser.add_argument('--device', type=str, default=None)
+    parser.add_argument('--samples', type=int, default=4, help='test images used for the parity check')
+    parser.add_argument('--atol', type=float, default=None,
+                        help='allowed max abs difference (default: 1e-3, 5e-2 with --fp16)')
+    parser.add_argument('--no-verify', action='store_true', help='skip the parity check')
+    parser.add_argument('--output', type=str, default=None, help='output directory (default: <PATH>/export)')
+    args = parser.parse_args(argv)
+
+    config = Config(args.config, args.overrides, MODE=2)
+    device = torch.device(args.device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+    output = args.output or os.path.join(config.PATH, 'export')
+    atol = args.atol if args.atol is not None else (5e-2 if args.fp16 else 1e-3)
+    if args.fp16 and device.type != 'cuda':
+        parser.error('--fp16 needs a cuda device, the FFT in Upsample has no half precision CPU kernels')
+    os.makedirs(output, exist_ok=True)
+
+    if args.weights:
+        pipeline = InpaintPipeline(args.weights, device=device)
+    else:
+        pipeline = InpaintPipeline.from_config(config, device=device)
+    reference = lambda images, masks: inpaint_forward(pipeline.generator, images, masks)
+
+    generator = pipeline.generator
+    if args.fp16:
+        generator = InpaintPipeline(None, device=device).generator
+        generator.load_state_dict(pipeline.generator.state_dict())
+        generator.half()
+    module = ExportModule(generator, torch.float16 if args.fp16 else torch.float32).eval()
+
+    report = {'iteration': pipeline.iteration, 'fp16': args.fp16, 'dynamic': args.dynamic, 'atol': atol,
+              'artifacts': []}
+    failed = False
+    for fmt in args.format:
+        sizes = args.sizes[:1] if args.dynamic and fmt == 'onnx' else args.sizes
+        for size in sizes:
+            name = 'InpaintingModel' + ('_fp16' if args.fp16 else '') + ('' if fmt == 'onnx' and args.dynamic
+                                                                         else '_%d' % size)
+            path = os.path.join(output, name + EXTENSIONS[fmt])
+
+            # torch.export specializes dimensions of size 1, a dynamic batch needs a larger example
+            example_batch = 2 if args.dynamic else 1
+            example = (torch.rand(example_batch, 3, size, size, device=device),
+                       torch.zeros(example_batch, 3, size, size, device=device))
+            entry = {'format': fmt, 'path': path, 'size': size}
+            try:
+                with torch.no_grad():
+                    EXPORTERS[fmt](module, example, path, args.dynamic)
+            except Exception as e:
+                entry['error'] = '%s: %s' % (type(e).__name__, e)
+                failed = True
+                print('%s export at %d failed: %s' % (fmt, size, entry['error']))
+                report['artifacts'].append(entry)
+                continue
+            print('exported %s' % path)
+
+            if not args.no_verify:
+                try:
+                    run = load_runner(fmt, path, device)
+                except ImportError as e:
+                    # an unverified artifact must not pass as verified
+                    entry['parity'] = 'not verified: %s' % e
+                    failed = True
+                    print('    cannot verify: %s (use --no-verify to export without the check)' % e)
+                else:
+                    # dynamic onnx is checked on every bucket
+                    # dynamic artifacts are checked at a batch other than the example's
+                    samples = args.samples + 1 if args.dynamic and args.samples == example_batch else args.samples
+                    for check_size in (args.sizes if fmt == 'onnx' and args.dynamic else [size]):
+                        images, masks = load_samples(config, samples, check_size)
+                        try:
+                            parity = check_parity(run, reference, images.to(device), masks.to(device),
+                                                  None if args.dynamic else example_batch)
+                        except Exception as e:
+                            parity = {'error': '%s: %s' % (type(e).__name__, e), 'passed': False}
+                            failed = True
+                            entry.setdefault('parity', {})[check_size] = parity
+                            print('    %d: running the artifact failed: %s' % (check_size, parity['error']))
+                            continue
+                        parity['passed'] = parity['max_abs_diff'] <= atol
+                        failed = failed or not parity['passed']
+                        entry.setdefault('parity', {})[check_size] = parity
+                        print('    %d: max abs diff %.2e, mean %.2e %s' % (
+                            check_size, parity['max_abs_diff'], parity['mean_abs_diff'],
+                            'ok' if parity['passed'] else 'FAILED (atol %.0e)' % atol))
+            report['artifacts'].append(entry)
+
+    with open(os.path.join(output, 'export.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+
+    if failed:
+        print('export or parity check failed, see %s' % os.path.join(output, 'export.json'))
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
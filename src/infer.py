@@ -0,0 +1,245 @@
+import os
+import sys
+import json
+import time
+import zlib
+import argparse
+import numpy as np
+
+'''
+Sharded, resumable batch inference over an image directory or flist:
+
+    python -m src.infer INPUT MASKS OUTPUT --weights XXX/InpaintingModel_gen.tensors --shard 3/16 --workers 4 --threads 2
+
+Images are assigned to shards by a hash of their file name, so every node
+running `--shard i/n` gets a fixed, disjoint part of the job independent of
+listing order. Masks are paired by file name when MASKS has a file of the
+same name, otherwise they are cycled in sorted order.
+
+Each of the `--workers` processes runs its own pipeline with `--threads`
+torch threads (pinned to its own block of cores when the platform allows).
+Results are written atomically as OUTPUT/<name>.png. Finished names are
+appended to OUTPUT/.manifest/shard-<i>-of-<n>.txt after every batch; a
+restarted run skips them (`--resume manifest`, default) or skips every
+name whose output file exists (`--resume exists`). A completed shard writes
+OUTPUT/.manifest/shard-<i>-of-<n>.done.json with counts and failures.
+'''
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.webp')
+
+_pipeline = None
+
+
+def list_files(path):
+    # image directory, text file with one path per line, or a single image
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, name) for name in os.listdir(path)
+                      if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS)
+    if os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS:
+        return [path]
+    with open(path, encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def parse_shard(shard):
+    index, count = (int(part) for part in shard.split('/'))
+    if not 0 <= index < count:
+        raise ValueError('shard must be i/n with 0 <= i < n, got %s' % shard)
+    return index, count
+
+
+def in_shard(name, index, count):
+    return zlib.crc32(name.encode('utf-8')) % count == index
+
+
+def output_name(path):
+    return os.path.splitext(os.path.basename(path))[0] + '.png'
+
+
+def _init_worker(weights, device, threads, batch_size, counter, placement=None, interop_threads=1,
+                 local_weights=False):
+    global _pipeline
+    import torch
+    from .pipeline import InpaintPipeline
+
+    with counter.get_lock():
+        worker = counter.value
+        counter.value += 1
+
+    # each worker owns `threads` cores, so workers do not oversubscribe the node
+    if placement is not None:
+        from .launch import bind
+        node, block = placement[worker]
+        bind(node, block)
+        threads = len(block)
+    elif hasattr(os, 'sched_setaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+        block = cores[worker * threads:(worker + 1) * threads]
+        if len(block) == threads:
+            os.sched_setaffinity(0, block)
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(interop_threads)
+
+    _pipeline = InpaintPipeline(weights, device=device, batch_size=batch_size)
+    if local_weights:
+        # the generator maps the shared weights file, copy it into memory of this worker's node
+        state = {name: tensor.clone() for name, tensor in _pipeline.generator.state_dict().items()}
+        _pipeline.generator.load_state_dict(state, assign=True)
+
+
+def _save_atomic(array, path):
+    from PIL import Image
+
+    tmp_path = '%s.tmp.%d.png' % (path[:-4], os.getpid())
+    try:
+        Image.fromarray(array).save(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _run_batch(job):
+    # runs in a worker: decode, inpaint and save one batch, returns (done, failed)
+    from imageio import imread
+
+    pairs, output = job
+    names, images, masks, failed = [], [], [], []
+    for image_path, mask_path in pairs:
+        try:
+            images.append(np.asarray(imread(image_path)))
+            masks.append(np.asarray(imread(mask_path)))
+            names.append(output_name(image_path))
+        except Exception as e:
+            failed.append((image_path, str(e)))
+            if len(images) > len(masks):
+                images.pop()
+
+    done = []
+    if names:
+        try:
+            results = _pipeline.predict_batch(images, masks)
+        except Exception as e:
+            return done, failed + [(name, str(e)) for name in names]
+        for name, result in zip(names, results):
+            # a failed write (full disk, permissions) fails that image only
+            try:
+                _save_atomic(result, os.path.join(output, name))
+            except Exception as e:
+                failed.append((name, str(e)))
+                continue
+            done.append(name)
+    return done, failed
+
+
+def infer(inputs, masks, output, weights=None, shard='0/1', workers=1, threads=1, batch_size=4, device='cpu',
+          resume='manifest', placement=None, interop_threads=1, local_weights=False):
+    """Runs one shard of the job, see the module docstring.
+
+    `placement` is a list of (NUMA node, cores) per worker (see
+    `src.launch.placements`) and replaces `workers` and `threads`.
+    """
+    import multiprocessing
+
+    if placement is not None:
+        workers = len(placement)
+
+    index, count = parse_shard(shard)
+    manifest_dir = os.path.join(output, '.manifest')
+    os.makedirs(manifest_dir, exist_ok=True)
+    manifest_path = os.path.join(manifest_dir, 'shard-%d-of-%d.txt' % (index, count))
+
+    all_files = list_files(inputs)
+    image_files = [path for path in all_files if in_shard(os.path.basename(path), index, count)]
+    mask_files = list_files(masks)
+    if not mask_files:
+        raise FileNotFoundError('no masks found in %s' % masks)
+    mask_by_name = {os.path.splitext(os.path.basename(path))[0]: path for path in mask_files}
+    # masks are cycled by the position in the full listing, so pairs do not depend on the shard count
+    positions = {path: position for position, path in enumerate(all_files)}
+
+    if resume == 'manifest' and os.path.exists(manifest_path):
+        with open(manifest_path, encoding='utf-8') as f:
+            finished = {line.strip() for line in f if line.strip()}
+    elif resume == 'exists':
+        finished = {name for name in os.listdir(output) if name.endswith('.png')}
+    else:
+        finished = set()
+
+    pairs = []
+    for path in image_files:
+        if output_name(path) in finished:
+            continue
+        stem = os.path.splitext(os.path.basename(path))[0]
+        pairs.append((path, mask_by_name.get(stem, mask_files[positions[path] % len(mask_files)])))
+
+    print('shard %d/%d: %d images, %d already done, %d to run' % (index, count, len(image_files),
+                                                                  len(image_files) - len(pairs), len(pairs)))
+
+    jobs = [(pairs[i:i + batch_size], output) for i in range(0, len(pairs), batch_size)]
+    start = time.perf_counter()
+    processed, failures = 0, []
+    # the first batch also pays for process start and weight loading, the steady rate leaves it out
+    first, first_processed = None, 0
+
+    context = multiprocessing.get_context('spawn')
+    counter = context.Value('i', 0)
+    initargs = (weights, device, threads, batch_size, counter, placement, interop_threads, local_weights)
+    with context.Pool(workers, initializer=_init_worker, initargs=initargs) \
+            as pool, open(manifest_path, 'a', encoding='utf-8') as manifest:
+        for done, failed in pool.imap_unordered(_run_batch, jobs):
+            if done:
+                manifest.write(''.join(name + '\n' for name in done))
+                manifest.flush()
+            processed += len(done)
+            if first is None:
+                first, first_processed = time.perf_counter(), processed
+            failures += failed
+            elapsed = time.perf_counter() - start
+            print('\r%d/%d images, %.1f images/s, %d failed' % (processed, len(pairs), processed / elapsed,
+                                                               len(failures)), end='', flush=True)
+    print()
+    end = time.perf_counter()
+
+    summary = {
+        'shard': '%d/%d' % (index, count),
+        'images': len(image_files),
+        'skipped': len(image_files) - len(pairs),
+        'processed': processed,
+        'failed': [{'path': path, 'error': error} for path, error in failures],
+        'elapsed_s': end - start,
+        'startup_s': (first or end) - start,
+        'images_per_s': (processed - first_processed) / (end - first) if first and end > first else 0.0,
+        'workers': workers,
+        'weights': weights,
+        'finished': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    with open(os.path.join(manifest_dir, 'shard-%d-of-%d.done.json' % (index, count)), 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='sharded, resumable batch inference')
+    parser.add_argument('inputs', type=str, help='input image directory or flist')
+    parser.add_argument('masks', type=str, help='mask directory or flist')
+    parser.add_argument('output', type=str, help='output directory')
+    parser.add_argument('--weights', type=str, default=None, help='generator weights (*.tensors / *_gen.pth)')
+    parser.add_argument('--shard', type=str, default='0/1', help='i/n, run the i-th of n shards')
+    parser.add_argument('--workers', type=int, default=1, help='inference processes')
+    parser.add_argument('--threads', type=int, default=1, help='torch threads per process')
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--resume', type=str, default='manifest', choices=['manifest', 'exists', 'none'],
+                        help='skip images listed in the shard manifest, with an existing output, or none')
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.output, exist_ok=True)
+    summary = infer(args.inputs, args.masks, args.output, weights=args.weights, shard=args.shard,
+                    workers=args.workers, threads=args.threads, batch_size=args.batch_size, device=args.device,
+                    resume=args.resume)
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,221 @@
+import os
+import sys
+import json
+import glob
+import tempfile
+import argparse
+
+'''
+NUMA-aware multi-instance CPU inference:
+
+    python -m src.launch INPUT MASKS OUTPUT --weights XXX/InpaintingModel_gen.tensors --instances 8 --threads 6
+    python -m src.launch INPUT MASKS OUTPUT --weights XXX/InpaintingModel_gen.tensors --tune
+
+Runs `src.infer` with one process per instance. Instances are spread round
+robin over the NUMA nodes; each is pinned to `--threads` cores of its node
+(one hardware thread per physical core first, SMT siblings last), prefers
+memory of that node (libnuma when present, first-touch otherwise) and runs
+`--threads` intra-op and `--interop-threads` inter-op torch threads. All
+instances pull batches from one shared task queue. With `*.tensors` weights
+every instance maps the same file, so the weights are read once into the
+page cache; `--local-weights` copies them into node-local memory instead.
+
+`--tune` first runs `--tune-samples` images for every instance count (and
+threads per instance, by default all cores divided evenly) and then runs
+the job with the fastest combination; `--tune-only` stops after the search.
+The sample is raised to four batches per instance of the largest count, and
+counts the input cannot give two batches per instance are skipped, so every
+instance has batches after its first to measure a steady rate.
+The table is written to OUTPUT/.manifest/tune.json.
+'''
+
+
+def _parse_list(text):
+    # sysfs cpu list, e.g. '0-3,8-11'
+    cpus = []
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def cpu_topology():
+    """Dict of NUMA node -> usable cores, one thread of every physical core first, then their siblings."""
+    allowed = set(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else set(range(os.cpu_count()))
+
+    nodes = {}
+    for path in sorted(glob.glob('/sys/devices/system/node/node[0-9]*/cpulist')):
+        node = int(os.path.basename(os.path.dirname(path))[4:])
+        cpus = [cpu for cpu in _parse_list(_read(path)) if cpu in allowed]
+        if cpus:
+            nodes[node] = cpus
+    if not nodes:
+        nodes = {0: sorted(allowed)}
+
+    topology = {}
+    for node, cpus in nodes.items():
+        primary, siblings = [], []
+        for cpu in cpus:
+            try:
+                first = _parse_list(_read('/sys/devices/system/cpu/cpu%d/topology/thread_siblings_list' % cpu))[0]
+            except (OSError, IndexError, ValueError):
+                first = cpu
+            (primary if first == cpu or first not in cpus else siblings).append(cpu)
+        topology[node] = primary + siblings
+    return topology
+
+
+def placements(instances, threads, topology=None):
+    """List of (node, cores) for `instances` instances of `threads` cores, spread round robin over the nodes."""
+    topology = topology or cpu_topology()
+    nodes = sorted(topology)
+    used = {node: 0 for node in nodes}
+
+    result = []
+    for instance in range(instances):
+        node = nodes[instance % len(nodes)]
+        cores = topology[node][used[node]:used[node] + threads]
+        if len(cores) < threads:
+            raise ValueError('%d instances of %d threads do not fit on %d NUMA node(s) with %s cores'
+                             % (instances, threads, len(nodes), '/'.join(str(len(topology[n])) for n in nodes)))
+        used[node] += threads
+        result.append((node, cores))
+    return result
+
+
+def bind(node, cores):
+    """Pins the calling process to `cores` and prefers memory of `node`, returns True when memory is bound."""
+    import ctypes
+    import ctypes.util
+
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+
+    # without libnuma, first-touch places what the pinned process allocates on its own node anyway
+    library = ctypes.util.find_library('numa')
+    if library is None:
+        return False
+    try:
+        numa = ctypes.CDLL(library)
+        if numa.numa_available() < 0:
+            return False
+        numa.numa_set_preferred(node)
+    except (OSError, AttributeError):
+        return False
+    return True
+
+
+def search_grid(topology, instances=None, threads=None):
+    # (instances, threads) pairs that fit, by default powers of two instances sharing all cores evenly
+    cores = sum(len(cpus) for cpus in topology.values())
+    instances = instances or [2 ** i for i in range(cores.bit_length()) if 2 ** i <= cores]
+
+    grid = []
+    for count in instances:
+        for per_instance in (threads or [cores // count]):
+            try:
+                placements(count, per_instance, topology)
+            except ValueError:
+                continue
+            grid.append((count, per_instance))
+    return grid
+
+
+def tune(inputs, masks, weights=None, grid=None, samples=64, batch_size=4, interop_threads=1, local_weights=False):
+    """Runs the first `samples` images with every (instances, threads) of `grid`, returns results, fastest first.
+
+    `samples` is raised to 4 batches per instance of the largest instance count; combinations with fewer
+    than 2 batches per instance (a small input) are skipped.
+    """
+    from .infer import infer, list_files
+
+    topology = cpu_topology()
+    grid = grid or search_grid(topology)
+    samples = max(samples, max(instances for instances, _ in grid) * batch_size * 4)
+    images = list_files(inputs)[:samples]
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        flist = os.path.join(tmp, 'tune.flist')
+        with open(flist, 'w', encoding='utf-8') as f:
+            f.write(''.join(path + '\n' for path in images))
+
+        for instances, threads in grid:
+            # the steady rate leaves out each instance's first batch
+            if len(images) < instances * batch_size * 2:
+                print('skipping %d instance(s) x %d thread(s): %d images are less than 2 batches per instance'
+                      % (instances, threads, len(images)))
+                continue
+            output = os.path.join(tmp, '%dx%d' % (instances, threads))
+            os.makedirs(output)
+            print('tuning %d instance(s) x %d thread(s)' % (instances, threads))
+            summary = infer(flist, masks, output, weights=weights, batch_size=batch_size, resume='none',
+                            placement=placements(instances, threads, topology), interop_threads=interop_threads,
+                            local_weights=local_weights)
+            results.append({'instances': instances, 'threads': threads, 'images_per_s': summary['images_per_s'],
+                            'elapsed_s': summary['elapsed_s'], 'failed': len(summary['failed'])})
+
+    return sorted(results, key=lambda result: -result['images_per_s'])
+
+
+def main(argv=None):
+    from .infer import infer
+
+    parser = argparse.ArgumentParser(description='NUMA-aware multi-instance CPU inference')
+    parser.add_argument('inputs', type=str, help='input image directory or flist')
+    parser.add_argument('masks', type=str, help='mask directory or flist')
+    parser.add_argument('output', type=str, help='output directory')
+    parser.add_argument('--weights', type=str, default=None, help='generator weights (*.tensors / *_gen.pth)')
+    parser.add_argument('--instances', type=int, default=None, help='inference processes (default: one per node)')
+    parser.add_argument('--threads', type=int, default=None, help='cores per instance (default: all cores split)')
+    parser.add_argument('--interop-threads', type=int, default=1)
+    parser.add_argument('--local-weights', action='store_true', help='copy the weights into node-local memory')
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--shard', type=str, default='0/1', help='i/n, run the i-th of n shards')
+    parser.add_argument('--resume', type=str, default='manifest', choices=['manifest', 'exists', 'none'])
+    parser.add_argument('--tune', action='store_true', help='search instances x threads first, run the best')
+    parser.add_argument('--tune-only', action='store_true', help='only search instances x threads')
+    parser.add_argument('--tune-samples', type=int, default=64, help='images per tuning run')
+    parser.add_argument('--tune-instances', type=int, nargs='+', default=None)
+    parser.add_argument('--tune-threads', type=int, nargs='+', default=None)
+    args = parser.parse_args(argv)
+
+    topology = cpu_topology()
+    print('NUMA nodes: %s' % ', '.join('%d (%d cores)' % (node, len(cpus)) for node, cpus in topology.items()))
+    os.makedirs(os.path.join(args.output, '.manifest'), exist_ok=True)
+
+    instances = args.instances or len(topology)
+    threads = args.threads or sum(len(cpus) for cpus in topology.values()) // instances
+
+    if args.tune or args.tune_only:
+        grid = search_grid(topology, args.tune_instances, args.tune_threads)
+        results = tune(args.inputs, args.masks, weights=args.weights, grid=grid, samples=args.tune_samples,
+                       batch_size=args.batch_size, interop_threads=args.interop_threads,
+                       local_weights=args.local_weights)
+        with open(os.path.join(args.output, '.manifest', 'tune.json'), 'w') as f:
+            json.dump(results, f, indent=2)
+        for result in results:
+            print('%(instances)3d x %(threads)3d threads: %(images_per_s)8.2f images/s' % result)
+        if not results:
+            print('no combination could be tuned, use more inputs or a smaller --batch-size')
+            return 1
+        if args.tune_only:
+            return 0
+        instances, threads = results[0]['instances'], results[0]['threads']
+
+    print('running %d instance(s) x %d thread(s)' % (instances, threads))
+    summary = infer(args.inputs, args.masks, args.output, weights=args.weights, shard=args.shard,
+                    batch_size=args.batch_size, resume=args.resume, placement=placements(instances, threads, topology),
+                    interop_threads=args.interop_threads, local_weights=args.local_weights)
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
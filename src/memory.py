@@ -0,0 +1,279 @@
+import os
+import sys
+import json
+import argparse
+
+'''
+Peak memory of the training step and of inference, and the largest batch
+that fits a memory budget:
+
+    python -m src.memory --config config.yml --budget-mb 16000 --sizes 256 512
+    BATCH_SIZE: auto     # in config.yml, resolved when training starts, kept on resume
+
+Every measurement runs a (batch, size) step in a fresh spawned process. On
+cuda the peak comes from the caching allocator statistics of a second step,
+after one untimed step so optimizer state and lazily built buffers count as
+fixed memory. On CPU it is the process' peak resident set (VmHWM, reset
+through /proc/self/clear_refs) over both steps above the resident set
+before the first one, since torch's CPU tensors bypass the Python allocator
+that tracemalloc sees and glibc keeps freed activations mapped; optimizer
+state and gradients, created by the first step, are counted as fixed memory
+from their tensor sizes. The child runs with small malloc trim / mmap
+thresholds so freed buffers go back to the system. The activation peak is fitted
+as `a + b * batch * size^2`: every SCSAF block works on windows of the
+full-resolution feature maps, so it grows with the number of pixels in the
+batch. Fitted models are kept in PATH/memory_model.json.
+'''
+
+# share of the budget the predicted peak may use, the rest absorbs fragmentation and measurement noise
+HEADROOM = 0.9
+
+# (batch, size scale) points measured for a fit, relative to INPUT_SIZE
+FIT_POINTS = [(1, 0.5), (2, 0.5), (1, 1.0), (2, 1.0)]
+
+# glibc settings of the measurement process: large buffers are mmapped and trimmed on free
+MALLOC_ENV = {'MALLOC_MMAP_THRESHOLD_': '65536', 'MALLOC_TRIM_THRESHOLD_': '0'}
+
+
+def _status(field):
+    # kB value of a field of /proc/self/status, in bytes
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError('%s missing from /proc/self/status' % field)
+
+
+def _reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError as e:
+        raise RuntimeError('cannot reset the peak RSS (%s), CPU measurements need Linux >= 4.0' % e)
+
+
+def available_memory(device):
+    """Bytes free for a new job on `device`: free device memory on cuda, MemAvailable on CPU."""
+    import torch
+
+    device = torch.device(device)
+    if device.type == 'cuda':
+        return torch.cuda.mem_get_info(device)[0]
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError('MemAvailable missing from /proc/meminfo')
+
+
+def _build_step(kind, config, batch, size):
+    import torch
+
+    device = config.DEVICE
+    images = torch.rand(batch, 3, size, size, device=device)
+    masks = torch.zeros(batch, 3, size, size, device=device)
+    masks[:, :, size // 4:size * 3 // 4, size // 4:size * 3 // 4] = 1
+
+    if kind == 'train':
+        from .models import InpaintingModel
+
+        model = InpaintingModel(config).to(device)
+        model.train()
+
+        def step():
+            outputs = model.process(images, masks)
+            model.backward(outputs[1], outputs[2])
+
+        def state_bytes():
+            # Adam moments and gradients, kept from one step to the next
+            tensors = [value for optimizer in (model.gen_optimizer, model.dis_optimizer)
+                       for state in optimizer.state.values() for value in state.values() if torch.is_tensor(value)]
+            tensors += [param.grad for param in model.parameters() if param.grad is not None]
+            return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+        return step, state_bytes
+
+    from .pipeline import InpaintPipeline
+    pipeline = InpaintPipeline(None, device=device, batch_size=batch)
+    return lambda: pipeline.run(images, masks[:, :1]), lambda: 0
+
+
+def _measure(job, connection):
+    # runs in a fresh process, sends {'fixed': bytes, 'peak': bytes} above the fixed memory
+    from .config import Config
+
+    kind, values, batch, size = job
+    try:
+        import torch
+
+        config = Config(None, **values)
+        step, state_bytes = _build_step(kind, config, batch, size)
+
+        if config.DEVICE.type == 'cuda':
+            step()
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            fixed = torch.cuda.memory_allocated()
+            step()
+            torch.cuda.synchronize()
+            peak = torch.cuda.max_memory_allocated() - fixed
+        else:
+            # the RSS after a step also holds heap glibc has not returned, the baseline is taken before any
+            _reset_peak_rss()
+            baseline = _status('VmRSS')
+            step()
+            step()
+            fixed = baseline + state_bytes()
+            peak = max(_status('VmHWM') - fixed, 0)
+        connection.send({'fixed': fixed, 'peak': peak})
+    except Exception as e:
+        connection.send({'error': '%s: %s' % (type(e).__name__, e)})
+
+
+def measure_peak(kind, config, batch, size):
+    """(fixed bytes, activation peak bytes) of one `kind` ('train' / 'inference') step of `batch` x `size`^2."""
+    import multiprocessing
+
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    values = dict(config.to_dict(), BATCH_SIZE=batch, INPUT_SIZE=size)
+    process = context.Process(target=_measure, args=((kind, values, batch, size), sender))
+    # the spawned interpreter reads the malloc settings from the environment it starts with
+    saved = {key: os.environ.get(key) for key in MALLOC_ENV}
+    os.environ.update(MALLOC_ENV)
+    try:
+        process.start()
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key)
+            else:
+                os.environ[key] = value
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        # an out-of-memory kill on CPU ends the process without a reply
+        result = {'error': 'measurement process exited with code %s' % process.exitcode}
+    process.join()
+
+    if 'error' in result:
+        raise RuntimeError('%s step of %d x %d: %s' % (kind, batch, size, result['error']))
+    return result['fixed'], result['peak']
+
+
+class MemoryModel():
+    """Predicted peak memory `fixed + a + b * batch * size^2` in bytes of a training or inference step."""
+
+    def __init__(self, fixed, a, b, points=None):
+        self.fixed = fixed
+        self.a = a
+        self.b = b
+        self.points = points or []
+
+    @classmethod
+    def fit(cls, kind, config, points=None):
+        import numpy as np
+
+        base = config.INPUT_SIZE or 256
+        measured = []
+        for batch, scale in points or FIT_POINTS:
+            size = max(64, int(base * scale) // 64 * 64)
+            fixed, peak = measure_peak(kind, config, batch, size)
+            print('%s: batch %d, %dx%d: fixed %.1f MB, peak %.1f MB' % (kind, batch, size, size, fixed / 2 ** 20,
+                                                                         peak / 2 ** 20))
+            measured.append({'batch': batch, 'size': size, 'fixed': fixed, 'peak': peak})
+
+        pixels = np.array([point['batch'] * point['size'] ** 2 for point in measured], dtype=np.float64)
+        peaks = np.array([point['peak'] for point in measured], dtype=np.float64)
+        (a, b), *_ = np.linalg.lstsq(np.stack([np.ones_like(pixels), pixels], axis=1), peaks, rcond=None)
+        if b <= 0:
+            raise RuntimeError('peak memory does not grow with the batch, measurements: %s' % measured)
+        return cls(max(point['fixed'] for point in measured), float(max(a, 0.0)), float(b), measured)
+
+    def predict(self, batch, size):
+        return self.fixed + self.a + self.b * batch * size * size
+
+    def largest_batch(self, budget, size):
+        # 0 when not even a single image of `size` fits
+        usable = budget * HEADROOM - self.fixed - self.a
+        return max(int(usable // (self.b * size * size)), 0)
+
+    def largest_size(self, budget, batch, multiple=64):
+        usable = budget * HEADROOM - self.fixed - self.a
+        if usable <= 0:
+            return 0
+        return int((usable / (self.b * batch)) ** 0.5) // multiple * multiple
+
+    def to_dict(self):
+        return {'fixed': self.fixed, 'a': self.a, 'b': self.b, 'points': self.points}
+
+
+def load_model(kind, config, refresh=False):
+    """Fitted `MemoryModel` of `kind` for the config's device, cached in PATH/memory_model.json."""
+    path = os.path.join(config.PATH, 'memory_model.json')
+    key = '%s:%s:%d' % (kind, config.DEVICE, len(config.GPU))
+
+    models = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            models = json.load(f)
+    if key in models and not refresh:
+        return MemoryModel(**models[key])
+
+    model = MemoryModel.fit(kind, config)
+    models[key] = model.to_dict()
+    os.makedirs(config.PATH, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(models, f, indent=2)
+    return model
+
+
+def auto_batch_size(config, kind='train'):
+    """Largest batch of INPUT_SIZE images whose step fits MEMORY_BUDGET_MB (0: memory available now)."""
+    budget = config.MEMORY_BUDGET_MB * 2 ** 20 or available_memory(config.DEVICE)
+    size = config.INPUT_SIZE or 256
+    model = load_model(kind, config)
+    batch = model.largest_batch(budget, size)
+    if batch < 1:
+        raise RuntimeError('a single %dx%d %s step needs %.0f MB, the budget is %.0f MB'
+                           % (size, size, kind, model.predict(1, size) / 2 ** 20, budget / 2 ** 20))
+    print('BATCH_SIZE auto: %d (%s, %dx%d, predicted peak %.0f MB of %.0f MB)'
+          % (batch, kind, size, size, model.predict(batch, size) / 2 ** 20, budget / 2 ** 20))
+    return batch
+
+
+def main(argv=None):
+    import torch
+    from .config import Config
+
+    parser = argparse.ArgumentParser(description='peak memory model and the largest batch / size for a budget')
+    parser.add_argument('--config', type=str, default='./config.yml')
+    parser.add_argument('--set', dest='overrides', metavar='KEY=VALUE', action='append', default=[])
+    parser.add_argument('--kind', type=str, nargs='+', default=['train', 'inference'], choices=['train', 'inference'])
+    parser.add_argument('--budget-mb', type=int, default=None, help='default: MEMORY_BUDGET_MB, or available memory')
+    parser.add_argument('--sizes', type=int, nargs='+', default=None, help='sizes to report (default: INPUT_SIZE)')
+    parser.add_argument('--batches', type=int, nargs='+', default=[1, 8, 32], help='batches to report the size for')
+    parser.add_argument('--refresh', action='store_true', help='measure again instead of using the stored model')
+    args = parser.parse_args(argv)
+
+    config = Config(args.config, args.overrides)
+    config = config.replace(DEVICE=torch.device('cuda' if torch.cuda.is_available() else 'cpu'))
+    if args.budget_mb is not None:
+        config = config.replace(MEMORY_BUDGET_MB=args.budget_mb)
+    budget = config.MEMORY_BUDGET_MB * 2 ** 20 or available_memory(config.DEVICE)
+    print('budget: %.0f MB (%.0f%% usable)' % (budget / 2 ** 20, HEADROOM * 100))
+
+    for kind in args.kind:
+        model = load_model(kind, config, refresh=args.refresh)
+        print('\n%s: fixed %.1f MB, activations %.1f MB + %.3f kB per pixel' % (
+            kind, model.fixed / 2 ** 20, model.a / 2 ** 20, model.b / 1024))
+        for size in args.sizes or [config.INPUT_SIZE or 256]:
+            batch = model.largest_batch(budget, size)
+            print('  %5dx%-5d largest batch %4d (predicted peak %.0f MB)' % (
+                size, size, batch, model.predict(max(batch, 1), size) / 2 ** 20))
+        for batch in args.batches:
+            print('  batch %4d   largest size %5d' % (batch, model.largest_size(budget, batch)))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
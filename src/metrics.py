@@ -1,5 +1,7 @@
+import json
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 
 class PSNR(nn.Module):
@@ -14,9 +16,241 @@ class PSNR(nn.Module):
 
     def __call__(self, a, b):
         mse = torch.mean((a.float() - b.float()) ** 2)
-    
-        if mse == 0:
-            return 0
 
-        return self.max_val - 10 * torch.log(mse) / self.base10
+        # 0 for identical inputs, selected on the device to avoid a host sync
+        psnr = self.max_val - 10 * torch.log(mse) / self.base10
+        return torch.where(mse == 0, torch.zeros_like(psnr), psnr)
 
+
+class MetricsAccumulator():
+    """Keeps running sums of scalar metrics on the device.
+
+    `update` never synchronizes with the host, `flush` copies all the means
+    to the host at once and queues them as one log record. Records are
+    written to the log files `buffer_size` at a time.
+
+    Arguments:
+        log_file: Space separated text log, one line per record, or None.
+        jsonl_file: JSON lines log, one object per record, or None.
+        buffer_size: Number of records kept in memory before writing.
+    """
+
+    def __init__(self, log_file=None, jsonl_file=None, buffer_size=10):
+        self.log_file = log_file
+        self.jsonl_file = jsonl_file
+        self.buffer_size = buffer_size
+
+        self._sums = {}
+        self._count = 0
+        self._records = []
+
+    def update(self, values):
+        """Adds one step of `(name, value)` pairs, values may be tensors or numbers."""
+        for name, value in values:
+            if torch.is_tensor(value):
+                value = value.detach().float()
+            self._sums[name] = self._sums[name] + value if name in self._sums else value
+        self._count += 1
+
+    def flush(self, stateful=None):
+        """Returns the `(name, mean)` pairs since the last flush and logs them.
+
+        `stateful` pairs (e.g. epoch, iteration) are logged in front of the means.
+        """
+        if self._count == 0:
+            return []
+
+        names = list(self._sums)
+        tensors = [name for name in names if torch.is_tensor(self._sums[name])]
+        host = dict(zip(tensors, torch.stack([self._sums[name] for name in tensors]).tolist())) if tensors else {}
+
+        means = [(name, host.get(name, self._sums[name]) / self._count) for name in names]
+        self._records.append(list(stateful or []) + means)
+        if len(self._records) >= self.buffer_size:
+            self.write()
+
+        self._sums = {}
+        self._count = 0
+        return means
+
+    def write(self):
+        if not self._records:
+            return
+
+        if self.log_file is not None:
+            with open(self.log_file, 'a') as f:
+                for record in self._records:
+                    f.write('%s\n' % ' '.join([str(item[1]) for item in record]))
+
+        if self.jsonl_file is not None:
+            with open(self.jsonl_file, 'a') as f:
+                for record in self._records:
+                    f.write(json.dumps(dict(record)) + '\n')
+
+        self._records = []
+
+    def close(self):
+        self.write()
+
+
+def _gaussian_window(size, sigma):
+    coords = torch.arange(size, dtype=torch.float64) - (size - 1) / 2
+    kernel = torch.exp(-coords ** 2 / (2 * sigma ** 2))
+    kernel = kernel / kernel.sum()
+    return kernel[:, None] * kernel[None, :]
+
+
+class EvalMetrics(nn.Module):
+    """Batched evaluation metrics on tensors.
+
+    Computes per-image PSNR, SSIM, L1 and (when an LPIPS module is given)
+    LPIPS for a whole batch on the device of the inputs, and with `masks`
+    the hole-only `*_hole` variants of PSNR, SSIM and L1 (LPIPS is always
+    computed on the whole image). `update` adds a batch to running sums kept
+    on the device, `means` copies them to the host once.
+
+    PSNR and SSIM follow the skimage calls used by the original test loop:
+    images are clamped and truncated to uint8 levels, PSNR is capped at 100
+    and SSIM averages the per-channel maps over the image without the border
+    the window does not cover. The default 3x3 uniform window matches
+    `structural_similarity(..., win_size=3)`, `gaussian=True` matches
+    `gaussian_weights=True, sigma=1.5, use_sample_covariance=False`.
+
+    Arguments:
+        lpips: `lpips.LPIPS` module or None to skip LPIPS.
+        gaussian: Gaussian (sigma 1.5, 11x11) instead of uniform SSIM window.
+        win_size: Size of the uniform SSIM window.
+        quantize: Round inputs down to uint8 levels before PSNR / SSIM.
+        dtype: Compute dtype of PSNR / SSIM, float64 like skimage.
+    """
+
+    def __init__(self, lpips=None, gaussian=False, win_size=3, quantize=True, dtype=torch.float64):
+        super(EvalMetrics, self).__init__()
+        self.lpips = lpips
+        self.quantize = quantize
+        self.dtype = dtype
+
+        if gaussian:
+            window = _gaussian_window(11, 1.5)
+            self.cov_norm = 1.0
+        else:
+            window = torch.full((win_size, win_size), 1.0 / win_size ** 2, dtype=torch.float64)
+            self.cov_norm = win_size ** 2 / (win_size ** 2 - 1.0)
+        self.register_buffer('window', window[None, None].to(dtype))
+
+        self._sums = {}
+        self._count = 0
+
+    def _levels(self, x):
+        if x.dtype == torch.uint8:
+            return x.to(self.dtype)
+        x = x.to(self.dtype).clamp(0, 1) * 255.0
+        return x.floor() if self.quantize else x
+
+    def _filter(self, x):
+        channels = x.shape[1]
+        return F.conv2d(x, self.window.expand(channels, 1, -1, -1), groups=channels)
+
+    def ssim_map(self, x, y):
+        # x, y: (B, C, H, W) in [0, 255], valid-only filtering drops the border like skimage's crop
+        c1 = (0.01 * 255.0) ** 2
+        c2 = (0.03 * 255.0) ** 2
+
+        ux, uy = self._filter(x), self._filter(y)
+        vx = self.cov_norm * (self._filter(x * x) - ux * ux)
+        vy = self.cov_norm * (self._filter(y * y) - uy * uy)
+        vxy = self.cov_norm * (self._filter(x * y) - ux * uy)
+
+        return ((2 * ux * uy + c1) * (2 * vxy + c2)) / ((ux * ux + uy * uy + c1) * (vx + vy + c2))
+
+    @staticmethod
+    def _psnr(mse):
+        return (10 * torch.log10(255.0 ** 2 / mse)).clamp(max=100)
+
+    def lpips_features(self, images):
+        """Normalized LPIPS backbone features of (B, 3, H, W) images in [0, 1].
+
+        The features of fixed targets can be computed once and passed to
+        `forward` as `target_features` for every set of outputs compared with them.
+        """
+        lpips = self.lpips
+        if images.dtype == torch.uint8:
+            images = images.float() / 255.0
+        images = images.clamp(0, 1) * 2 - 1
+        if lpips.version == '0.1':
+            images = lpips.scaling_layer(images)
+        return [feature / (feature.pow(2).sum(dim=1, keepdim=True).sqrt() + 1e-10)
+                for feature in lpips.net.forward(images)]
+
+    def lpips_distance(self, features0, features1):
+        # same as lpips.LPIPS.forward on the normalized features, (B,)
+        lpips = self.lpips
+        distance = 0
+        for layer, (feature0, feature1) in enumerate(zip(features0, features1)):
+            diff = (feature0 - feature1) ** 2
+            if lpips.lpips:
+                distance = distance + lpips.lins[layer](diff).mean((2, 3))
+            else:
+                distance = distance + diff.sum(dim=1, keepdim=True).mean((2, 3))
+        return distance.view(-1)
+
+    def forward(self, outputs, targets, masks=None, target_features=None):
+        """Returns a dict of (B,) tensors, `masks` (1 = hole) adds the hole-only variants.
+
+        Images are float tensors in [0, 1] or uint8 tensors, which are used as
+        is. `target_features` are the `lpips_features` of `targets`, computed
+        here when not given.
+        """
+        x, y = self._levels(outputs), self._levels(targets)
+        if outputs.dtype == torch.uint8:
+            outputs = outputs.float() / 255.0
+        if targets.dtype == torch.uint8:
+            targets = targets.float() / 255.0
+        squared = (x - y) ** 2
+        ssim = self.ssim_map(x, y)
+
+        values = {
+            'psnr': self._psnr(squared.mean((1, 2, 3))),
+            'ssim': ssim.mean((1, 2, 3)),
+            'l1': (outputs.clamp(0, 1) - targets).abs().float().mean((1, 2, 3)),
+        }
+
+        if self.lpips is not None:
+            if target_features is None:
+                target_features = self.lpips_features(targets)
+            values['lpips'] = self.lpips_distance(self.lpips_features(outputs), target_features).to(values['l1'].dtype)
+
+        if masks is not None:
+            masks = masks.expand_as(outputs).to(self.dtype)
+            area = masks.sum((1, 2, 3)).clamp(min=1)
+            pad = (masks.shape[-1] - ssim.shape[-1]) // 2
+            ssim_masks = masks[:, :, pad:masks.shape[-2] - pad, pad:masks.shape[-1] - pad]
+
+            values['psnr_hole'] = self._psnr((squared * masks).sum((1, 2, 3)) / area)
+            values['ssim_hole'] = (ssim * ssim_masks).sum((1, 2, 3)) / ssim_masks.sum((1, 2, 3)).clamp(min=1)
+            values['l1_hole'] = ((outputs.clamp(0, 1) - targets).abs() * masks).sum((1, 2, 3)).float() / area.float()
+
+        return values
+
+    def update(self, values):
+        """Adds the per-image values of a batch to the running sums, no host sync."""
+        for name, value in values.items():
+            value = value.detach().sum()
+            self._sums[name] = self._sums[name] + value if name in self._sums else value
+        self._count += len(next(iter(values.values())))
+
+    def means(self):
+        """Running means over all images since the last `reset`, one host copy."""
+        if self._count == 0:
+            return {}
+        names = list(self._sums)
+        sums = torch.stack([self._sums[name].double() for name in names]).tolist()
+        return {name: value / self._count for name, value in zip(names, sums)}
+
+    @property
+    def count(self):
+        return self._count
+
+    def reset(self):
+        self._sums = {}
+        self._count = 0
@@ -5,6 +5,11 @@ import torch.optim as optim
 import torch.nn.functional as F
 from .networks import SCSAF, Discriminator
 from .loss import AdversarialLoss, PerceptualLoss, StyleLoss
+from .checkpoint import CheckpointManager, snapshot, get_rng_state, set_rng_state
+from .tensorfile import load_into
+from .profiler import StageTimer
+
+
 class BaseModel(nn.Module):
     def __init__(self, name, config):
         super(BaseModel, self).__init__()
@@ -12,12 +17,31 @@ class BaseModel(nn.Module):
         self.name = name
         self.config = config
         self.iteration = 0
+        self.resume_state = {}
 
         self.gen_weights_path = os.path.join(config.PATH, name + '_gen.pth')
         self.dis_weights_path = os.path.join(config.PATH, name + '_dis.pth')
+        self.gen_tensors_path = os.path.join(config.PATH, name + '_gen.tensors')
+
+        self.checkpoints = CheckpointManager(os.path.join(config.PATH, 'checkpoints'), name,
+                                             keep=config.CHECKPOINT_KEEP,
+                                             async_save=bool(config.CHECKPOINT_ASYNC))
 
     def load(self):
-        if os.path.exists(self.gen_weights_path):
+        # resume the full training state when a rotated checkpoint exists
+        if self.config.MODE == 1:
+            checkpoint_path = self.checkpoints.latest()
+            if checkpoint_path is not None:
+                self.resume(checkpoint_path)
+                return
+
+        # inference prefers the memory-mapped weights-only file when present
+        if self.config.MODE != 1 and os.path.exists(self.gen_tensors_path):
+            print('Loading %s generator from %s...' % (self.name, self.gen_tensors_path))
+            metadata = load_into(self.generator, self.gen_tensors_path)
+            self.iteration = metadata.get('iteration', 0)
+
+        elif os.path.exists(self.gen_weights_path):
             print('Loading %s generator...' % self.name)
 
             if torch.cuda.is_available():
@@ -39,16 +63,39 @@ class BaseModel(nn.Module):
 
             self.discriminator.load_state_dict(data['discriminator'])
 
-    def save(self):
+    def resume(self, path):
+        print('Resuming %s from %s...' % (self.name, path))
+        data = torch.load(path, map_location='cpu', weights_only=False)
+
+        self.generator.load_state_dict(data['generator'])
+        self.discriminator.load_state_dict(data['discriminator'])
+        self.gen_optimizer.load_state_dict(data['gen_optimizer'])
+        self.dis_optimizer.load_state_dict(data['dis_optimizer'])
+        set_rng_state(data['rng'])
+
+        self.iteration = data['iteration']
+        self.resume_state = data['extra']
+
+    def save(self, extra=None):
         print('\nsaving %s...\n' % self.name)
-        torch.save({
+
+        # snapshot on the calling thread, serialization happens in the background
+        generator = snapshot(self.generator.state_dict())
+        discriminator = snapshot(self.discriminator.state_dict())
+        state = {
             'iteration': self.iteration,
-            'generator': self.generator.state_dict()
-        }, self.gen_weights_path)
+            'generator': generator,
+            'discriminator': discriminator,
+            'gen_optimizer': snapshot(self.gen_optimizer.state_dict()),
+            'dis_optimizer': snapshot(self.dis_optimizer.state_dict()),
+            'rng': get_rng_state(),
+            'extra': extra or {},
+        }
 
-        torch.save({
-            'discriminator': self.discriminator.state_dict()
-        }, self.dis_weights_path)
+        self.checkpoints.save(state, self.iteration, extra_files=[
+            (self.gen_weights_path, {'iteration': self.iteration, 'generator': generator}),
+            (self.dis_weights_path, {'discriminator': discriminator}),
+        ])
 
 
 class InpaintingModel(BaseModel):
@@ -86,8 +133,12 @@ class InpaintingModel(BaseModel):
             betas=(config.BETA1, config.BETA2)
         )
 
+        # per-stage timings, replaced by SCSAF.train when PROFILE_STAGES is set
+        self.timer = StageTimer(enabled=False)
+
     def process(self, images, masks):
         self.iteration += 1
+        timer = self.timer
 
         # zero optimizers
         self.gen_optimizer.zero_grad()
@@ -95,7 +146,8 @@ class InpaintingModel(BaseModel):
 
         # process outputs
 
-        outputs_img = self(images, masks)
+        with timer.stage('generator'):
+            outputs_img = self(images, masks)
 
         gen_loss = 0
         dis_loss = 0
@@ -104,61 +156,60 @@ class InpaintingModel(BaseModel):
         dis_input_real = images
         dis_input_fake = outputs_img.detach()
 
-        dis_real, _ = self.discriminator(dis_input_real)
-        dis_fake, _ = self.discriminator(dis_input_fake)
+        with timer.stage('dis_forward'):
+            dis_real, _ = self.discriminator(dis_input_real)
+            dis_fake, _ = self.discriminator(dis_input_fake)
 
-        dis_real_loss = self.adversarial_loss(dis_real, True, True)
-        dis_fake_loss = self.adversarial_loss(dis_fake, False, True)
-        dis_loss += (dis_real_loss + dis_fake_loss) / 2
+            dis_real_loss = self.adversarial_loss(dis_real, True, True)
+            dis_fake_loss = self.adversarial_loss(dis_fake, False, True)
+            dis_loss += (dis_real_loss + dis_fake_loss) / 2
 
         # generator adversarial loss
-        gen_input_fake = outputs_img
-        gen_fake, _ = self.discriminator(gen_input_fake)
-        gen_gan_loss = self.adversarial_loss(gen_fake, True, False) * self.config.INPAINT_ADV_LOSS_WEIGHT
-        gen_loss += gen_gan_loss
+        with timer.stage('gen_adv_loss'):
+            gen_input_fake = outputs_img
+            gen_fake, _ = self.discriminator(gen_input_fake)
+            gen_gan_loss = self.adversarial_loss(gen_fake, True, False) * self.config.INPAINT_ADV_LOSS_WEIGHT
+            gen_loss += gen_gan_loss
 
-        gen_l1_loss = self.l1_loss(outputs_img, images) * self.config.L1_LOSS_WEIGHT / torch.mean(masks)
-        gen_loss += gen_l1_loss
+        with timer.stage('l1_loss'):
+            gen_l1_loss = self.l1_loss(outputs_img, images) * self.config.L1_LOSS_WEIGHT / torch.mean(masks)
+            gen_loss += gen_l1_loss
 
         # generator perceptual loss
-        gen_content_loss = self.perceptual_loss(outputs_img, images)
-        gen_content_loss = gen_content_loss * self.config.CONTENT_LOSS_WEIGHT
-        gen_loss += gen_content_loss
+        with timer.stage('perceptual_loss'):
+            gen_content_loss = self.perceptual_loss(outputs_img, images)
+            gen_content_loss = gen_content_loss * self.config.CONTENT_LOSS_WEIGHT
+            gen_loss += gen_content_loss
 
         # generator style loss
-        gen_style_loss = self.style_loss(outputs_img * masks, images * masks)
-        gen_style_loss = gen_style_loss * self.config.STYLE_LOSS_WEIGHT
-        gen_loss += gen_style_loss
+        with timer.stage('style_loss'):
+            gen_style_loss = self.style_loss(outputs_img * masks, images * masks)
+            gen_style_loss = gen_style_loss * self.config.STYLE_LOSS_WEIGHT
+            gen_loss += gen_style_loss
 
         #############################
 
         # create logs
+        # kept as device tensors, the caller decides when to sync
         logs = [
-            ("gLoss", gen_loss.item()),
-            ("dLoss", dis_loss.item())
+            ("gLoss", gen_loss.detach()),
+            ("dLoss", dis_loss.detach())
         ]
 
         return outputs_img, gen_loss, dis_loss, logs, gen_gan_loss, gen_l1_loss, gen_content_loss, gen_style_loss
 
     def forward(self, images, masks):
-        images_masked = (images * (1 - masks).float()) + masks
-
-        # inputs = images_masked
-        height, width = masks.shape[2], masks.shape[3]
-
-        scaled_masks_tiny = F.interpolate(masks, size=[height // 8, width // 8], mode='nearest')
-        scaled_masks_quarter = F.interpolate(masks, size=[height // 4, width // 4], mode='nearest')
-        scaled_masks_half = F.interpolate(masks, size=[height // 2, width // 2], mode='nearest')
-
-        outputs_img = self.generator(images_masked, masks, scaled_masks_half, scaled_masks_quarter, scaled_masks_tiny)
-        return outputs_img
+        return inpaint_forward(self.generator, images, masks)
 
     def backward(self, gen_loss=None, dis_loss=None):
-        dis_loss.backward(retain_graph=True)
-        gen_loss.backward()
-        self.dis_optimizer.step()
+        with self.timer.stage('backward'):
+            dis_loss.backward(retain_graph=True)
+            gen_loss.backward()
 
-        self.gen_optimizer.step()
+        with self.timer.stage('optimizer'):
+            self.dis_optimizer.step()
+
+            self.gen_optimizer.step()
 
     def backward_joint(self, gen_loss=None, dis_loss=None):
         dis_loss.backward()
@@ -168,6 +219,26 @@ class InpaintingModel(BaseModel):
         self.gen_optimizer.step()
 
 
+def mask_pyramid(masks):
+    # nearest-neighbour masks at 1/2, 1/4 and 1/8 resolution for the generator levels
+    height, width = masks.shape[2], masks.shape[3]
+
+    scaled_masks_half = F.interpolate(masks, size=[height // 2, width // 2], mode='nearest')
+    scaled_masks_quarter = F.interpolate(masks, size=[height // 4, width // 4], mode='nearest')
+    scaled_masks_tiny = F.interpolate(masks, size=[height // 8, width // 8], mode='nearest')
+    return scaled_masks_half, scaled_masks_quarter, scaled_masks_tiny
+
+
+def inpaint_forward(generator, images, masks):
+    # masked input and mask pyramid around the generator, shared with the exported graphs
+    images_masked = (images * (1 - masks)) + masks
+
+    scaled_masks_half, scaled_masks_quarter, scaled_masks_tiny = mask_pyramid(masks)
+
+    outputs_img = generator(images_masked, masks, scaled_masks_half, scaled_masks_quarter, scaled_masks_tiny)
+    return outputs_img
+
+
 def abs_smooth(x):
     absx = torch.abs(x)
     minx = torch.min(absx, other=torch.ones(absx.shape).cuda())
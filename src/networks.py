@@ -1,10 +1,8 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from pdb import set_trace as stx
 import numbers
 from einops import rearrange
-from torchvision.transforms import GaussianBlur
 
 class BaseNetwork(nn.Module):
     def __init__(self):
@@ -260,7 +258,7 @@ class Oreo(nn.Module):
         self.norm1 = LayerNorm(dim, LayerNorm_type)
 
         # self.attn = Attention(dim, num_heads, bias)
-        self.attn = Oreo(dim)
+        self.attn = SCSA(dim)
 
         self.norm2 = LayerNorm(dim, LayerNorm_type)
 
@@ -307,7 +305,7 @@ class Downsample(nn.Module):
         out = self.body(x)
         out_mask = self.body2(mask)
         b, n, h, w = out.shape
-        t = torch.zeros((b, 2 * n, h, w)).cuda()
+        t = torch.zeros((b, 2 * n, h, w), dtype=out.dtype, device=out.device)
         for i in range(n):
             t[:, 2 * i, :, :] = out[:, i, :, :]
         for i in range(n):
@@ -339,6 +337,8 @@ class LaplacianFilter(nn.Module):
 class GaussianBlurLayer(nn.Module):
     def __init__(self, kernel_size=5, sigma=2.0):
         super(GaussianBlurLayer, self).__init__()
+        from torchvision.transforms import GaussianBlur
+
         self.blur = GaussianBlur(kernel_size, sigma=sigma)
 
     def forward(self, x):
@@ -0,0 +1,242 @@
+import os
+import re
+import pickle
+import numpy as np
+import torch
+import torch.nn.functional as F
+from .networks import SCSAF
+from .models import mask_pyramid
+from .tensorfile import load_into, load_tensors
+from .cache import ResultCache, array_digest, state_digest
+
+
+def read_generator_state(weights_path):
+    """Reads the generator state dict of a `*.tensors`, `*_gen.pth` or training checkpoint file.
+
+    Returns:
+        (state dict, iteration)
+    """
+    if weights_path.endswith('.tensors'):
+        state, metadata = load_tensors(weights_path)
+        return state, metadata.get('iteration', 0)
+
+    try:
+        data = torch.load(weights_path, map_location='cpu', weights_only=True)
+    except pickle.UnpicklingError:
+        # rotated training checkpoints (CheckpointManager's `<name>_<iteration>.pth`) also hold the
+        # numpy RNG state, which the restricted unpickler rejects; only those are read like BaseModel.resume
+        if not re.search(r'_\d+\.pth$', os.path.basename(weights_path)):
+            raise
+        data = torch.load(weights_path, map_location='cpu', weights_only=False)
+    state = data['generator'] if 'generator' in data else data
+    state = {(key[7:] if key.startswith('module.') else key): value for key, value in state.items()}
+    return state, data.get('iteration', 0)
+
+
+class InpaintPipeline():
+    """Inference-only inpainting pipeline.
+
+    Builds only the SCSAF generator and loads only generator weights, none of
+    the discriminator, VGG losses, optimizers or LPIPS are created.
+
+    Arguments:
+        weights_path: `*_gen.tensors` or `*_gen.pth` file, None keeps the
+            randomly initialized generator.
+        device: torch device to run on (default: cuda if available).
+        batch_size: Maximum number of images per generator call.
+        pad_to: Inputs are padded to a multiple of this size (the generator
+            needs 64 for its three downsamplings and 8x8 attention windows).
+        cache: `ResultCache` consulted by `predict_batch` before running the
+            generator, keyed by the input bytes and the weights, or None.
+    """
+
+    def __init__(self, weights_path=None, device=None, batch_size=8, pad_to=64, cache=None):
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+        self.device = torch.device(device)
+        self.batch_size = batch_size
+        self.pad_to = pad_to
+        self.cache = cache
+        self.iteration = 0
+        self._weights_digest = None
+
+        self.generator = SCSAF()
+        self.generator.requires_grad_(False)
+        self.generator.eval()
+
+        if weights_path is not None:
+            self.load(weights_path)
+
+        self.generator.to(self.device)
+
+    @classmethod
+    def from_config(cls, config, **kwargs):
+        # same lookup as BaseModel.load, weights-only file first
+        kwargs.setdefault('batch_size', config.INFER_BATCH_SIZE)
+        for suffix in ['_gen.tensors', '_gen.pth']:
+            path = os.path.join(config.PATH, 'InpaintingModel' + suffix)
+            if os.path.exists(path):
+                return cls(path, device=kwargs.pop('device', config.DEVICE), **kwargs)
+
+        return cls(None, device=kwargs.pop('device', config.DEVICE), **kwargs)
+
+    def load(self, weights_path):
+        print('Loading generator from %s...' % weights_path)
+        self._weights_digest = None
+
+        if weights_path.endswith('.tensors'):
+            metadata = load_into(self.generator, weights_path)
+            self.iteration = metadata.get('iteration', 0)
+        else:
+            state, self.iteration = read_generator_state(weights_path)
+            self.generator.load_state_dict(state, strict=False)
+
+    def swap(self, state, digest=None, iteration=0):
+        """Points the generator at the tensors of `state` without copying them.
+
+        The tensors must already have the dtype and device of the generator
+        and cover all of its keys, so nothing stays aliased to the previous
+        weights; `digest` is the weights digest used for cache keys (computed
+        on demand when None).
+        """
+        self.generator.load_state_dict(state, strict=True, assign=True)
+        self._weights_digest = digest
+        self.iteration = iteration
+
+    def run(self, images, masks, pyramid=None):
+        """Inpaints a batch of tensors.
+
+        Arguments:
+            images: (N, 3, H, W) float tensor in [0, 1] on the pipeline device.
+            masks: (N or 1, 1 or 3, H, W) float tensor, 1 marks the missing region,
+                a single mask is shared by the whole batch.
+            pyramid: Precomputed `mask_pyramid` of the padded masks, see `static_mask`.
+
+        Returns:
+            (N, 3, H, W) tensor with the generator output composited into the hole.
+        """
+        if masks.shape[1] == 1:
+            masks = masks.repeat(1, 3, 1, 1)
+
+        height, width = images.shape[2:]
+        pad_h = -height % self.pad_to
+        pad_w = -width % self.pad_to
+        if pad_h or pad_w:
+            images = F.pad(images, (0, pad_w, 0, pad_h), mode='replicate')
+        if masks.shape[2:] != images.shape[2:]:
+            masks = F.pad(masks, (0, pad_w, 0, pad_h), value=0)
+
+        with torch.inference_mode():
+            if pyramid is None:
+                pyramid = mask_pyramid(masks)
+            batch = images.shape[0]
+            masks = masks.expand(batch, -1, -1, -1)
+            pyramid = [scaled.expand(batch, -1, -1, -1) for scaled in pyramid]
+
+            images_masked = (images * (1 - masks)) + masks
+            outputs_img = self.generator(images_masked, masks, *pyramid)
+            outputs_merged = (outputs_img * masks) + (images * (1 - masks))
+
+        return outputs_merged[:, :, :height, :width]
+
+    def static_mask(self, mask, height, width):
+        """Padded (1, 3, H, W) mask tensor and its pyramid for a mask reused across many `run` calls."""
+        mask = self.mask_to_tensor(mask, (height, width))[None].repeat(1, 3, 1, 1)
+        mask = F.pad(mask, (0, -width % self.pad_to, 0, -height % self.pad_to), value=0)
+        return mask, mask_pyramid(mask)
+
+    def predict_batch(self, images, masks):
+        """Inpaints a list (or stacked batch) of images.
+
+        Images may be HxWx3 numpy arrays (uint8, or float in [0, 1]) or
+        3xHxW / Nx3xHxW float tensors in [0, 1]. Masks may be HxW, HxWx1,
+        HxWx3 arrays or HxW / 1xHxW / 3xHxW tensors, any non-zero value is a
+        hole; a mask of another size than its image is resized to it (nearest).
+        Stacked arrays / tensors are split along their first dimension.
+        Results are returned in the type of the inputs: uint8 HxWx3 arrays
+        for numpy inputs, 3xHxW float tensors on the pipeline device otherwise.
+        """
+        # stacked arrays / tensors carry a leading batch dimension
+        images = list(images)
+        masks = list(masks)
+
+        assert len(images) == len(masks), 'got %d images and %d masks' % (len(images), len(masks))
+
+        results = [None] * len(images)
+        keys = [None] * len(images)
+        if self.cache is not None:
+            for i in range(len(images)):
+                keys[i] = self.cache_key(images[i], masks[i])
+                cached = self.cache.get(keys[i])
+                if cached is not None:
+                    # copies, so callers may modify results without changing the cached entry; tensors
+                    # come back float32 on the pipeline device like a miss
+                    results[i] = cached.copy() if isinstance(images[i], np.ndarray) else \
+                        torch.from_numpy(cached).to(self.device, torch.float32, copy=True)
+
+        pending = [i for i in range(len(images)) if results[i] is None]
+        image_tensors = {i: self.image_to_tensor(images[i]) for i in pending}
+        mask_tensors = {i: self.mask_to_tensor(masks[i], image_tensors[i].shape[-2:]) for i in pending}
+
+        # group equally sized inputs so they can share a generator call
+        groups = {}
+        for index in pending:
+            groups.setdefault(tuple(image_tensors[index].shape), []).append(index)
+
+        for indices in groups.values():
+            for start in range(0, len(indices), self.batch_size):
+                chunk = indices[start:start + self.batch_size]
+                outputs = self.run(torch.stack([image_tensors[i] for i in chunk]),
+                                   torch.stack([mask_tensors[i] for i in chunk]))
+                for i, output in zip(chunk, outputs):
+                    results[i] = self.postprocess(output) if isinstance(images[i], np.ndarray) else output
+                    if self.cache is not None:
+                        self.cache.put(keys[i], results[i].copy() if isinstance(images[i], np.ndarray)
+                                       else output.float().cpu().numpy().copy())
+
+        return results
+
+    def weights_digest(self):
+        # computed on first use, a cache key component identifying the loaded weights
+        if self._weights_digest is None:
+            self._weights_digest = state_digest(self.generator.state_dict())
+        return self._weights_digest
+
+    def cache_key(self, image, mask):
+        kind = 'numpy' if isinstance(image, np.ndarray) else 'tensor'
+        return ResultCache.key(array_digest(image), array_digest(mask),
+                               '%s:%d:%s' % (self.weights_digest(), self.pad_to, kind))
+
+    def __call__(self, image, mask):
+        return self.predict_batch([image], [mask])[0]
+
+    def image_to_tensor(self, image):
+        if isinstance(image, np.ndarray):
+            if image.ndim == 2:
+                image = np.stack([image] * 3, axis=-1)
+            image = image[:, :, :3]
+            scale = 255.0 if image.dtype == np.uint8 else 1.0
+            image = torch.from_numpy(np.ascontiguousarray(image)).permute(2, 0, 1).float() / scale
+
+        return image.to(self.device, torch.float32)
+
+    def mask_to_tensor(self, mask, size=None):
+        # (1, H, W) binary float mask, resized to `size` (H, W) with nearest interpolation like Dataset.load_mask
+        if isinstance(mask, np.ndarray):
+            if mask.ndim == 3:
+                mask = mask.max(axis=2)
+            mask = torch.from_numpy(np.ascontiguousarray(mask))
+
+        if mask.dim() == 2:
+            mask = mask[None]
+        mask = mask.to(self.device)
+        mask = (mask > 0).any(dim=0, keepdim=True).float()
+        if size is not None and tuple(mask.shape[1:]) != tuple(size):
+            mask = F.interpolate(mask[None], size=tuple(size), mode='nearest')[0]
+        return mask
+
+    def postprocess(self, img):
+        # [0, 1] => [0, 255] HxWx3 uint8
+        img = (img.clamp(0, 1) * 255.0).round()
+        return img.permute(1, 2, 0).byte().cpu().numpy()
@@ -0,0 +1,70 @@
+import os
+import sys
+import argparse
+import torch
+
+'''
+Local cache for the ImageNet backbones used by the VGG losses and LPIPS.
+
+torchvision looks up pretrained weights in `<hub dir>/checkpoints` before it
+tries to download them, so pointing the hub dir at a pre-populated folder
+(`PRETRAINED_PATH` in config.yml) makes startup work without network access.
+Populate the folder once on a machine with network access:
+
+    python -m src.pretrained XXX/pretrained
+'''
+
+_vgg19_features_state = None
+
+
+def set_pretrained_path(path):
+    if path:
+        torch.hub.set_dir(os.path.expanduser(path))
+
+
+def _get_state_dict(weights):
+    try:
+        return weights.get_state_dict(progress=False)
+    except OSError as e:
+        raise RuntimeError('pretrained weights %s are not in the local cache %s and could not be downloaded (%s), '
+                           'run `python -m src.pretrained <PRETRAINED_PATH>` on a machine with network access'
+                           % (weights, os.path.join(torch.hub.get_dir(), 'checkpoints'), e))
+
+
+def vgg19_features():
+    # only the convolutional part of VGG19 is built, the ImageNet checkpoint is
+    # read from the cache once per process and shared by every VGG19 instance
+    global _vgg19_features_state
+    from torchvision.models import VGG19_Weights
+    from torchvision.models.vgg import make_layers, cfgs
+
+    if _vgg19_features_state is None:
+        state = _get_state_dict(VGG19_Weights.IMAGENET1K_V1)
+        _vgg19_features_state = {key[len('features.'):]: value for key, value in state.items()
+                                 if key.startswith('features.')}
+
+    features = make_layers(cfgs['E'])
+    features.load_state_dict(_vgg19_features_state)
+    return features
+
+
+def prefetch(path):
+    from torchvision.models import VGG16_Weights, VGG19_Weights
+
+    set_pretrained_path(path)
+    # VGG19: perceptual and style losses, VGG16: LPIPS backbone
+    for weights in [VGG19_Weights.IMAGENET1K_V1, VGG16_Weights.IMAGENET1K_V1]:
+        print('fetching %s...' % weights)
+        _get_state_dict(weights)
+    print('pretrained weights cached in %s' % os.path.join(torch.hub.get_dir(), 'checkpoints'))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='download the pretrained backbones into a local cache')
+    parser.add_argument('path', type=str, help='cache directory, use it as PRETRAINED_PATH in config.yml')
+    args = parser.parse_args(argv)
+    prefetch(args.path)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,274 @@
+import os
+import json
+import time
+import contextlib
+import numpy as np
+import torch
+
+_NULL_STAGE = contextlib.nullcontext()
+
+
+class _Stage():
+    __slots__ = ['timer', 'name', 'start']
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        if self.timer.sync:
+            torch.cuda.synchronize()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        if self.timer.sync:
+            torch.cuda.synchronize()
+        self.timer.record(self.name, time.perf_counter() - self.start)
+
+
+class StageTimer():
+    """Records per-stage wall times of the training step.
+
+    Stages are timed with `with timer.stage(name):`, the data loader with
+    `for items in timer.iterate('loader', loader):`. Every `interval` calls
+    of `step` the percentiles of every stage are appended to a JSONL file.
+    A disabled timer hands out a shared no-op context, so the
+    instrumentation can stay in place at negligible cost.
+
+    Arguments:
+        path: JSONL output file.
+        interval: Number of steps aggregated per record.
+        sync: Synchronize cuda around every stage so asynchronous kernels
+            are attributed to the stage that launched them.
+        enabled: False turns every call into a no-op.
+    """
+
+    def __init__(self, path=None, interval=100, sync=True, enabled=True):
+        self.path = path
+        self.interval = interval
+        self.sync = sync and enabled and torch.cuda.is_available()
+        self.enabled = enabled
+
+        self._samples = {}
+        self._steps = 0
+        self._last_step = None
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def iterate(self, name, iterable):
+        if not self.enabled:
+            return iterable
+        return self._iterate(name, iterable)
+
+    def _iterate(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.record(name, time.perf_counter() - start)
+            yield item
+
+    def record(self, name, seconds):
+        self._samples.setdefault(name, []).append(seconds)
+
+    def step(self, step):
+        if not self.enabled:
+            return
+
+        now = time.perf_counter()
+        if self._last_step is not None:
+            self.record('step', now - self._last_step)
+        self._last_step = now
+
+        self._steps += 1
+        if self._steps % self.interval == 0:
+            self.flush(step)
+
+    def summary(self):
+        summary = {}
+        for name, samples in self._samples.items():
+            samples = np.array(samples) * 1e3
+            p50, p90, p99 = np.percentile(samples, [50, 90, 99])
+            summary[name] = {
+                'count': len(samples),
+                'mean_ms': float(samples.mean()),
+                'p50_ms': float(p50),
+                'p90_ms': float(p90),
+                'p99_ms': float(p99),
+                'total_ms': float(samples.sum()),
+            }
+        return summary
+
+    def flush(self, step):
+        if not self._samples:
+            return
+
+        record = {'step': step, 'steps': self._steps, 'stages': self.summary()}
+        if self.path is not None:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        self._samples = {}
+        return record
+
+
+def _device_time(event):
+    # us; `device_time_total` since torch 2.4, only `cuda_time_total` before (e.g. 2.1)
+    return getattr(event, 'device_time_total', 0) or getattr(event, 'cuda_time_total', 0)
+
+
+class TraceWindow():
+    """Captures an operator-level torch.profiler trace of a few steps.
+
+    The window opens before step `start` (0: never) or, when `signal` is set,
+    after the process receives SIGUSR1 (`kill -USR1 <pid>`), so long runs
+    can be profiled without restarting them. After `steps` steps the Chrome
+    trace (`trace_<name>_<first>-<last>.json`, open in chrome://tracing or
+    Perfetto) and a table aggregated per module class
+    (`trace_<name>_<first>-<last>.txt`) are written to `path`.
+
+    While the window is open every submodule of `modules` runs under a
+    `record_function` labelled `module::<class name>` (e.g. module::Oreo,
+    module::SCSA, module::Upsample), so the trace and the table keep the
+    network structure.
+
+    Arguments:
+        path: Output directory.
+        name: Prefix of the output files.
+        modules: Modules whose submodules are labelled in the trace.
+        start: First traced step (0: only on signal).
+        steps: Number of traced steps.
+        memory: Record tensor allocations.
+        shapes: Record input shapes, the table is then also grouped by shape.
+        signal: Open a window on SIGUSR1.
+    """
+
+    def __init__(self, path, name, modules=(), start=0, steps=5, memory=False, shapes=False, signal=True):
+        self.path = path
+        self.name = name
+        self.modules = list(modules)
+        self.start = start
+        self.steps = steps
+        self.memory = memory
+        self.shapes = shapes
+
+        self._requested = False
+        self._profiler = None
+        self._hooks = []
+        self._first = None
+        self._count = 0
+
+        if signal:
+            self._install_signal()
+
+    def _install_signal(self):
+        import signal
+        import threading
+
+        if not hasattr(signal, 'SIGUSR1') or threading.current_thread() is not threading.main_thread():
+            return
+        signal.signal(signal.SIGUSR1, self._on_signal)
+
+    def _on_signal(self, signum, frame):
+        self._requested = True
+
+    @property
+    def active(self):
+        return self._profiler is not None
+
+    def step(self, step):
+        """Called after every step, `step` is the number of the finished step."""
+        if self.active:
+            self._count += 1
+            self._profiler.step()
+            if self._count >= self.steps:
+                self.stop(step)
+            return
+
+        if self._requested or (self.start and step + 1 == self.start):
+            self._requested = False
+            self.begin(step + 1)
+
+    def begin(self, first):
+        from torch.profiler import profile, ProfilerActivity
+
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+
+        os.makedirs(self.path, exist_ok=True)
+        print('\ntracing %d %s steps from step %d...' % (self.steps, self.name, first))
+
+        self._first = first
+        self._count = 0
+        self._add_hooks()
+        self._profiler = profile(activities=activities, record_shapes=self.shapes, profile_memory=self.memory)
+        self._profiler.start()
+
+    def stop(self, last):
+        if not self.active:
+            return
+
+        profiler = self._profiler
+        profiler.stop()
+        self._profiler = None
+        self._remove_hooks()
+
+        prefix = os.path.join(self.path, 'trace_%s_%08d-%08d' % (self.name, self._first, last))
+        profiler.export_chrome_trace(prefix + '.json')
+        with open(prefix + '.txt', 'w') as f:
+            f.write(self.table(profiler))
+        print('\ntrace written to %s.json / .txt\n' % prefix)
+
+    def close(self, step):
+        # flush a window that is still open when the loop ends
+        self.stop(step)
+
+    def table(self, profiler):
+        cuda = torch.cuda.is_available()
+        sort_by = 'self_cuda_time_total' if cuda else 'self_cpu_time_total'
+        events = profiler.key_averages()
+
+        # record_function ranges are inclusive, nested modules are counted in their parents too
+        rows = sorted([event for event in events if event.key.startswith('module::')],
+                      key=lambda event: event.cpu_time_total, reverse=True)
+        lines = ['per module class (inclusive, summed over all instances)',
+                 '%-32s %8s %14s %14s %14s' % ('module', 'calls', 'cpu total ms', 'cpu avg ms',
+                                               'cuda total ms' if cuda else 'cpu mem MB')]
+        for event in rows:
+            last = (_device_time(event) / 1e3 if cuda else event.cpu_memory_usage / 2 ** 20)
+            lines.append('%-32s %8d %14.3f %14.3f %14.3f' % (event.key[len('module::'):], event.count,
+                                                             event.cpu_time_total / 1e3,
+                                                             event.cpu_time_total / 1e3 / max(event.count, 1), last))
+
+        lines += ['', 'top operators', events.table(sort_by=sort_by, row_limit=50)]
+        if self.shapes:
+            lines += ['top operators by input shape',
+                      profiler.key_averages(group_by_input_shape=True).table(sort_by=sort_by, row_limit=50)]
+        return '\n'.join(lines)
+
+    def _add_hooks(self):
+        from torch.autograd.profiler import record_function
+
+        def pre_hook(module, inputs):
+            scope = record_function('module::' + module.__class__.__name__)
+            scope.__enter__()
+            module._trace_scopes = getattr(module, '_trace_scopes', []) + [scope]
+
+        def post_hook(module, inputs, outputs):
+            module._trace_scopes.pop().__exit__(None, None, None)
+
+        for root in self.modules:
+            for module in root.modules():
+                self._hooks.append(module.register_forward_pre_hook(pre_hook))
+                self._hooks.append(module.register_forward_hook(post_hook))
+
+    def _remove_hooks(self):
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
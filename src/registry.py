@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import threading
+import contextlib
+import collections
+import numpy as np
+from .pipeline import InpaintPipeline, read_generator_state
+from .cache import ResultCache, array_digest, state_digest
+
+
+def _nbytes(state):
+    return sum(tensor.numel() * tensor.element_size() for tensor in state.values())
+
+
+def _nbytes_total(tier):
+    return sum(_nbytes(state) for state in tier.values())
+
+
+class ModelRegistry():
+    """Serves several generator checkpoints from one `InpaintPipeline`.
+
+    All models share the pipeline's single SCSAF instance: `use(name)` points
+    its parameters at the model's resident tensors (no copy), so switching a
+    resident model takes well under a millisecond. Weights are loaded on
+    demand and kept in two LRU tiers, on the pipeline device up to
+    `device_bytes` and in (pinned) host memory up to `host_bytes`; models
+    evicted from both are read from disk again on their next use. Use counts
+    are kept so `prewarm` can load the most used models ahead of traffic,
+    and persisted to `usage_path` when given.
+
+    The pipeline's parameters alias the resident tensors of the current
+    model, so it must only be used inside `use` and never `load`ed.
+
+    Arguments:
+        models: Dict of name -> weights path (*.tensors, *_gen.pth or checkpoint).
+        device: Device of the pipeline.
+        device_bytes: Budget of the device tier.
+        host_bytes: Budget of the host tier.
+        usage_path: JSON file with use counts, read at startup, written by `save_usage`.
+        **kwargs: Passed to `InpaintPipeline` (batch_size, pad_to, cache).
+    """
+
+    def __init__(self, models=None, device=None, device_bytes=2 * 2 ** 30, host_bytes=8 * 2 ** 30, usage_path=None,
+                 **kwargs):
+        self.pipeline = InpaintPipeline(None, device=device, **kwargs)
+        self.device_bytes = device_bytes
+        self.host_bytes = host_bytes
+        self.usage_path = usage_path
+
+        self._paths = dict(models or {})
+        self._dtypes = {name: tensor.dtype for name, tensor in self.pipeline.generator.state_dict().items()}
+        self._device = collections.OrderedDict()
+        self._host = collections.OrderedDict()
+        self._iterations = {}
+        self._digests = {}
+        self._current = None
+        self._lock = threading.RLock()
+
+        self._usage = collections.Counter()
+        if usage_path is not None and os.path.exists(usage_path):
+            with open(usage_path) as f:
+                self._usage.update(json.load(f))
+        self._stats = collections.Counter()
+        self._switch_ms = collections.deque(maxlen=1000)
+
+    def register(self, name, path):
+        with self._lock:
+            self._paths[name] = path
+            self._forget(name)
+
+    def names(self):
+        return list(self._paths)
+
+    def _forget(self, name):
+        self._device.pop(name, None)
+        self._host.pop(name, None)
+        self._digests.pop(name, None)
+        if self._current == name:
+            self._current = None
+
+    def _fetch(self, name):
+        # resident device state of `name`, moving it up the tiers as needed
+        if name in self._device:
+            self._device.move_to_end(name)
+            self._stats['device_hits'] += 1
+            return self._device[name]
+
+        device = self.pipeline.device
+        if name in self._host:
+            state = {key: value.to(device, non_blocking=True) for key, value in self._host.pop(name).items()}
+            self._stats['host_hits'] += 1
+        else:
+            if name not in self._paths:
+                raise KeyError("unknown model '%s', registered: %s" % (name, ', '.join(self._paths)))
+            state, self._iterations[name] = read_generator_state(self._paths[name])
+            missing = sorted(self._dtypes.keys() - state.keys())
+            if missing:
+                raise KeyError("model '%s' lacks %d generator tensors: %s" % (name, len(missing),
+                                                                              ', '.join(missing[:5])))
+            state = {key: value.to(device, self._dtypes[key]) for key, value in state.items() if key in self._dtypes}
+            if self.pipeline.cache is not None and name not in self._digests:
+                self._digests[name] = state_digest(state)
+            self._stats['disk_loads'] += 1
+
+        self._device[name] = state
+        self._evict(name)
+        return state
+
+    def _evict(self, keep):
+        pin = self.pipeline.device.type == 'cuda'
+        while _nbytes_total(self._device) > self.device_bytes:
+            # least recently used first, the model being fetched and the one in the generator stay
+            victims = [name for name in self._device if name not in (keep, self._current)]
+            if not victims:
+                break
+            name = victims[0]
+            state = self._device.pop(name)
+            self._host[name] = {key: value.to('cpu').pin_memory() if pin else value.to('cpu', copy=True)
+                                for key, value in state.items()}
+            self._stats['device_evictions'] += 1
+
+        while _nbytes_total(self._host) > self.host_bytes and self._host:
+            self._host.popitem(last=False)
+            self._stats['host_evictions'] += 1
+
+    @contextlib.contextmanager
+    def use(self, name):
+        """Context in which `self.pipeline` runs model `name`; uses of the shared pipeline are serialized."""
+        with self._lock:
+            self._usage[name] += 1
+            if self._current != name:
+                start = time.perf_counter()
+                state = self._fetch(name)
+                self.pipeline.swap(state, self._digests.get(name), self._iterations.get(name, 0))
+                self._current = name
+                self._switch_ms.append((time.perf_counter() - start) * 1e3)
+                self._stats['switches'] += 1
+            else:
+                self._device.move_to_end(name)
+            yield self.pipeline
+
+    def digest(self, name):
+        # weights digest of `name`, hashed once on its first load; known digests are read without
+        # the lock, which `use` holds for a whole generator batch
+        digest = self._digests.get(name)
+        if digest is None:
+            with self._lock:
+                if name not in self._digests:
+                    self._digests[name] = state_digest(self._fetch(name))
+                digest = self._digests[name]
+        return digest
+
+    def cache_key(self, name, image, mask):
+        # same key `InpaintPipeline.cache_key` gives while `name` is in the generator
+        kind = 'numpy' if isinstance(image, np.ndarray) else 'tensor'
+        return ResultCache.key(array_digest(image), array_digest(mask),
+                               '%s:%d:%s' % (self.digest(name), self.pipeline.pad_to, kind))
+
+    def prewarm(self, names=None, count=None):
+        """Loads `names`, or the `count` most used (then registered) models, into the device tier."""
+        if names is None:
+            ranked = sorted(self._paths, key=lambda name: -self._usage.get(name, 0))
+            names = ranked[:count] if count is not None else ranked
+        with self._lock:
+            for name in names:
+                self._fetch(name)
+
+    def save_usage(self):
+        if self.usage_path is not None:
+            with open(self.usage_path, 'w') as f:
+                json.dump(dict(self._usage), f, indent=2)
+
+    def __contains__(self, name):
+        return name in self._paths
+
+    def stats(self):
+        with self._lock:
+            switch_ms = sorted(self._switch_ms)
+            return dict({name: self._stats[name] for name in
+                         ['switches', 'device_hits', 'host_hits', 'disk_loads', 'device_evictions', 'host_evictions']},
+                        current=self._current, device_models=list(self._device), host_models=list(self._host),
+                        device_bytes=_nbytes_total(self._device), host_bytes=_nbytes_total(self._host),
+                        switch_p50_ms=switch_ms[len(switch_ms) // 2] if switch_ms else None,
+                        usage=dict(self._usage))
+
@@ -0,0 +1,341 @@
+import io
+import sys
+import json
+import time
+import base64
+import argparse
+import threading
+import contextlib
+import collections
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import torch
+
+'''
+Local inference server with dynamic batching, stdlib only:
+
+    python -m src.server --weights XXX/InpaintingModel_gen.tensors --port 8080 --max-batch 8 --max-wait-ms 10
+
+Endpoints:
+
+    POST /inpaint   application/json          {"image": <base64 PNG>, "mask": <base64 PNG>} -> {"image": <base64 PNG>}
+                    application/octet-stream  headers X-Height, X-Width; body = HxWx3 uint8 image + HxW uint8
+                                              mask -> HxWx3 uint8 result
+    GET  /metrics   queue depth, batch size histogram, latency percentiles
+    GET  /health
+
+Several checkpoints can be served at once with repeated `--model NAME=PATH`
+options; requests pick one with an X-Model header or a "model" JSON field
+(default: the first). The models share one generator through a
+`ModelRegistry`, batches never mix models.
+
+Requests are decoded on the HTTP threads and queued per image shape. A
+worker thread takes up to `max_batch` requests of one shape as soon as the
+batch is full or the oldest request has waited `max_wait` seconds and runs
+them as one generator call. `python -m benchmarks.server_load` is the
+matching load generator.
+'''
+
+
+def decode_png(data):
+    from PIL import Image
+    return np.array(Image.open(io.BytesIO(data)))
+
+
+def encode_png(array):
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.fromarray(array).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def _percentiles(samples):
+    if not samples:
+        return None
+    samples = np.array(samples) * 1e3
+    p50, p90, p99 = np.percentile(samples, [50, 90, 99])
+    return {'count': len(samples), 'mean_ms': float(samples.mean()), 'p50_ms': float(p50), 'p90_ms': float(p90),
+            'p99_ms': float(p99)}
+
+
+class MicroBatcher():
+    """Groups concurrent requests of the same shape into generator batches.
+
+    Arguments:
+        pipeline: `InpaintPipeline` running the batches.
+        max_batch: Maximum number of requests per generator call.
+        max_wait: Seconds the oldest request of a shape may wait for more.
+        workers: Number of inference threads.
+        history: Number of latency samples kept for the metrics.
+        registry: `ModelRegistry` serving several models with its pipeline,
+            `pipeline` is ignored when given.
+    """
+
+    def __init__(self, pipeline, max_batch=8, max_wait=0.01, workers=1, history=10000, registry=None):
+        self.registry = registry
+        self.pipeline = registry.pipeline if registry is not None else pipeline
+        self.default_model = registry.names()[0] if registry is not None else None
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+
+        self._queues = collections.OrderedDict()
+        self._condition = threading.Condition()
+        self._closed = False
+
+        self._lock = threading.Lock()
+        self._batch_sizes = collections.Counter()
+        self._queue_wait = collections.deque(maxlen=history)
+        self._inference = collections.deque(maxlen=history)
+        self._total = collections.deque(maxlen=history)
+        self._requests = 0
+        self._errors = 0
+
+        self._threads = [threading.Thread(target=self._work, name='inference-%d' % i, daemon=True)
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, image, mask, model=None):
+        """Queues one HxWx3 uint8 image and HxW mask, returns a Future of the HxWx3 uint8 result."""
+        if self.registry is not None:
+            model = model or self.default_model
+            if model not in self.registry:
+                raise KeyError('unknown model %s' % model)
+
+        future = Future()
+        key = None
+        cache = self.pipeline.cache
+        if cache is not None:
+            key = (self.registry.cache_key(model, image, mask) if self.registry is not None
+                   else self.pipeline.cache_key(image, mask))
+            cached = cache.get(key)
+            if cached is not None:
+                future.set_result(cached)
+                return future
+
+        with self._condition:
+            self._queues.setdefault((model, image.shape), collections.deque()).append(
+                (image, mask, future, time.perf_counter(), key, model))
+            self._condition.notify()
+        return future
+
+    def queue_depth(self):
+        with self._condition:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def _take(self):
+        # blocks until a batch is ready, returns a list of queued requests or None when closed
+        with self._condition:
+            while not self._closed:
+                now = time.perf_counter()
+                oldest_shape, oldest = None, None
+                for shape, queue in self._queues.items():
+                    if len(queue) >= self.max_batch:
+                        oldest_shape = shape
+                        break
+                    if oldest is None or queue[0][3] < oldest:
+                        oldest_shape, oldest = shape, queue[0][3]
+
+                if oldest_shape is not None:
+                    queue = self._queues[oldest_shape]
+                    if len(queue) >= self.max_batch or now - queue[0][3] >= self.max_wait:
+                        batch = [queue.popleft() for _ in range(min(self.max_batch, len(queue)))]
+                        if not queue:
+                            del self._queues[oldest_shape]
+                        return batch
+                    self._condition.wait(self.max_wait - (now - queue[0][3]))
+                else:
+                    self._condition.wait()
+            return None
+
+    def _work(self):
+        while True:
+            batch = self._take()
+            if batch is None:
+                return
+
+            start = time.perf_counter()
+            try:
+                model = batch[0][5]
+                with self.registry.use(model) if model is not None else contextlib.nullcontext(self.pipeline) \
+                        as pipeline:
+                    images = torch.stack([pipeline.image_to_tensor(item[0]) for item in batch])
+                    masks = torch.stack([pipeline.mask_to_tensor(item[1]) for item in batch])
+                    results = [pipeline.postprocess(output) for output in pipeline.run(images, masks)]
+            except Exception as e:
+                for item in batch:
+                    item[2].set_exception(e)
+                with self._lock:
+                    self._errors += len(batch)
+                continue
+
+            end = time.perf_counter()
+            for item, result in zip(batch, results):
+                if item[4] is not None:
+                    self.pipeline.cache.put(item[4], result)
+                item[2].set_result(result)
+
+            with self._lock:
+                self._batch_sizes[len(batch)] += 1
+                self._inference.append(end - start)
+                self._requests += len(batch)
+                for item in batch:
+                    self._queue_wait.append(start - item[3])
+                    self._total.append(end - item[3])
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'queue_depth': self.queue_depth(),
+                'requests': self._requests,
+                'errors': self._errors,
+                'batches': sum(self._batch_sizes.values()),
+                'batch_size_histogram': {str(size): count for size, count in sorted(self._batch_sizes.items())},
+                'queue_wait': _percentiles(list(self._queue_wait)),
+                'inference': _percentiles(list(self._inference)),
+                'latency': _percentiles(list(self._total)),
+                'cache': self.pipeline.cache.stats() if self.pipeline.cache is not None else None,
+                'models': self.registry.stats() if self.registry is not None else None,
+            }
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+
+def make_handler(batcher, timeout=60.0):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _send(self, status, body, content_type='application/json', headers=None):
+            if isinstance(body, (dict, list)):
+                body = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self._send(200, batcher.metrics())
+            elif self.path == '/health':
+                self._send(200, {'status': 'ok'})
+            else:
+                self._send(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/inpaint':
+                self._send(404, {'error': 'not found'})
+                return
+
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            content_type = self.headers.get('Content-Type', 'application/json').split(';')[0].strip()
+            try:
+                if content_type == 'application/octet-stream':
+                    height, width = int(self.headers['X-Height']), int(self.headers['X-Width'])
+                    data = np.frombuffer(body, np.uint8)
+                    if data.size != height * width * 4:
+                        raise ValueError('expected %d bytes, got %d' % (height * width * 4, data.size))
+                    image = data[:height * width * 3].reshape(height, width, 3)
+                    mask = data[height * width * 3:].reshape(height, width)
+                    model = self.headers.get('X-Model')
+                else:
+                    request = json.loads(body)
+                    image = decode_png(base64.b64decode(request['image']))
+                    mask = decode_png(base64.b64decode(request['mask']))
+                    if image.ndim == 2:
+                        image = np.stack([image] * 3, axis=-1)
+                    image = np.ascontiguousarray(image[:, :, :3])
+                    model = request.get('model', self.headers.get('X-Model'))
+                # a mismatched mask would fail the whole micro-batch it lands in
+                if mask.shape[:2] != image.shape[:2]:
+                    raise ValueError('mask is %dx%d, image is %dx%d' % (mask.shape[:2] + image.shape[:2]))
+                future = batcher.submit(image, mask, model)
+            except (KeyError, ValueError, TypeError, OSError) as e:
+                self._send(400, {'error': str(e)})
+                return
+
+            try:
+                result = future.result(timeout)
+            except Exception as e:
+                self._send(500, {'error': str(e)})
+                return
+
+            if content_type == 'application/octet-stream':
+                self._send(200, result.tobytes(), 'application/octet-stream',
+                           {'X-Height': str(result.shape[0]), 'X-Width': str(result.shape[1])})
+            else:
+                self._send(200, {'image': base64.b64encode(encode_png(result)).decode('ascii')})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main(argv=None):
+    from .pipeline import InpaintPipeline
+    from .cache import ResultCache
+    from .registry import ModelRegistry
+
+    parser = argparse.ArgumentParser(description='local inpainting server with dynamic batching')
+    parser.add_argument('--weights', type=str, default=None, help='generator weights, random when omitted')
+    parser.add_argument('--model', type=str, action='append', default=[], metavar='NAME=PATH',
+                        help='serve several models, repeat for each (replaces --weights)')
+    parser.add_argument('--models-device-mb', type=int, default=2048, help='device memory for resident models')
+    parser.add_argument('--models-host-mb', type=int, default=8192, help='host memory for evicted models')
+    parser.add_argument('--prewarm', type=int, default=None, help='models loaded at startup, most used first '
+                                                                  '(default: all)')
+    parser.add_argument('--usage', type=str, default=None, help='JSON file with model use counts for --prewarm')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--device', type=str, default=None)
+    parser.add_argument('--max-batch', type=int, default=8, help='maximum requests per generator call')
+    parser.add_argument('--max-wait-ms', type=float, default=10.0, help='maximum wait for a batch to fill')
+    parser.add_argument('--workers', type=int, default=1, help='inference threads')
+    parser.add_argument('--cache', action='store_true', help='cache results by image, mask and weights')
+    parser.add_argument('--cache-dir', type=str, default=None, help='on-disk cache tier, memory only when omitted')
+    parser.add_argument('--cache-memory-mb', type=int, default=256)
+    parser.add_argument('--cache-disk-mb', type=int, default=10240)
+    args = parser.parse_args(argv)
+
+    cache = None
+    if args.cache or args.cache_dir:
+        cache = ResultCache(args.cache_dir, memory_bytes=args.cache_memory_mb * 2 ** 20,
+                            disk_bytes=args.cache_disk_mb * 2 ** 20)
+    registry = pipeline = None
+    if args.model:
+        models = dict(model.split('=', 1) for model in args.model)
+        registry = ModelRegistry(models, device=args.device, device_bytes=args.models_device_mb * 2 ** 20,
+                                 host_bytes=args.models_host_mb * 2 ** 20, usage_path=args.usage,
+                                 batch_size=args.max_batch, cache=cache)
+        registry.prewarm(count=args.prewarm)
+    else:
+        pipeline = InpaintPipeline(args.weights, device=args.device, batch_size=args.max_batch, cache=cache)
+    batcher = MicroBatcher(pipeline, max_batch=args.max_batch, max_wait=args.max_wait_ms / 1e3, workers=args.workers,
+                           registry=registry)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(batcher))
+    server.daemon_threads = True
+
+    print('serving on http://%s:%d (max batch %d, max wait %.1fms)' % (args.host, args.port, args.max_batch,
+                                                                       args.max_wait_ms))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        if registry is not None:
+            registry.save_usage()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+import os
+import queue
+import threading
+import numpy as np
+import torch
+from PIL import Image
+
+
+def stitch_tensors(*panels):
+    # [(N, C, H, W), ...] => (C, N * H, len(panels) * W), one row per image
+    grid = torch.cat(panels, dim=3)
+    return torch.cat(list(grid), dim=1)
+
+
+class SnapshotWriter():
+    """Saves training samples without stalling the training loop.
+
+    The joint grid (ground truth | masked input | output | merged output, one
+    row per image) and the masked / result images are assembled and
+    quantized on the device and copied to the host in a single transfer.
+    PNG encoding and writing happen on a background thread. If the worker
+    falls more than `max_pending` snapshots behind, new snapshots are dropped
+    instead of blocking.
+
+    Arguments:
+        path: Root directory, images go to `joint/`, `masked/` and `result/`.
+        sample_size: Number of images of the batch in the joint grid.
+        max_pending: Maximum number of snapshots waiting to be written.
+    """
+
+    def __init__(self, path, sample_size=1, max_pending=2):
+        self.sample_size = sample_size
+        self.dropped = 0
+
+        self.path_masked = os.path.join(path, 'masked')
+        self.path_result = os.path.join(path, 'result')
+        self.path_joint = os.path.join(path, 'joint')
+        for path in [self.path_masked, self.path_result, self.path_joint]:
+            os.makedirs(path, exist_ok=True)
+
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, name='snapshot-writer', daemon=True)
+        self._thread.start()
+
+    def save(self, name, images, masks, outputs_img, outputs_merged):
+        if self._queue.full():
+            self.dropped += 1
+            return
+
+        n = min(self.sample_size, len(images))
+        with torch.no_grad():
+            images, masks = images[:n].detach(), masks[:n].detach()
+            outputs_img, outputs_merged = outputs_img[:n].detach(), outputs_merged[:n].detach()
+
+            joint = stitch_tensors(images, images * (1 - masks), outputs_img, outputs_merged)
+            masked = images[0] * (1 - masks[0]) + masks[0]
+            result = outputs_merged[0]
+
+            shapes = [joint.shape, masked.shape, result.shape]
+            packed = torch.cat([joint.flatten(), masked.flatten(), result.flatten()])
+            packed = (packed.clamp(0, 1) * 255.0).to(torch.uint8)
+
+        # single device-to-host copy, asynchronous on cuda
+        event = None
+        if packed.is_cuda:
+            host = torch.empty(packed.shape, dtype=torch.uint8, pin_memory=True)
+            host.copy_(packed, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+        else:
+            host = packed
+
+        self._queue.put((name, host, shapes, event))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            name, host, shapes, event = item
+            try:
+                if event is not None:
+                    event.synchronize()
+
+                arrays = []
+                offset = 0
+                for shape in shapes:
+                    size = int(np.prod(shape))
+                    arrays.append(np.ascontiguousarray(host[offset:offset + size].view(shape).permute(1, 2, 0).numpy()))
+                    offset += size
+
+                for path, array in zip([self.path_joint, self.path_masked, self.path_result], arrays):
+                    Image.fromarray(array.squeeze()).save(os.path.join(path, name))
+            except Exception as e:
+                print('snapshot: failed to write %s: %s' % (name, e))
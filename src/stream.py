@@ -0,0 +1,220 @@
+import io
+import sys
+import glob
+import time
+import queue
+import tarfile
+import argparse
+import contextlib
+import threading
+import numpy as np
+
+'''
+Streaming inference over tar shards:
+
+    python -m src.stream 'XXX/in-*.tar' --output 'XXX/out-%06d.tar' --weights XXX/InpaintingModel_gen.tensors
+    cat shard.tar | python -m src.stream - --output - > result.tar
+
+Input tars hold one image and one mask per sample, named by a common key
+(`<key>.png` or `<key>.image.png`, and `<key>.mask.png`; any image
+extension PIL reads), with the members of a sample next to each other as
+in WebDataset shards. Tars are read sequentially (stdin with `-`), samples
+are decoded on a background thread into a bounded queue, inpainted in
+batches and written as `<key>.png` members into output shards of at most
+`--shard-size` samples (stdout with `-`). Nothing is written to disk per
+sample and memory does not depend on the shard size. Samples that do not
+decode are skipped with their key on stderr, and the exit status is 1.
+'''
+
+
+def _split_name(name):
+    # 'dir/0001.mask.png' -> ('dir/0001', 'mask'), 'dir/0001.png' -> ('dir/0001', 'image')
+    base, _, extension = name.rpartition('.')
+    key, dot, field = base.rpartition('.')
+    if dot and field in ('image', 'mask'):
+        return key, field
+    return base, 'image'
+
+
+def _open_inputs(inputs):
+    for pattern in inputs:
+        if pattern == '-':
+            yield tarfile.open(fileobj=sys.stdin.buffer, mode='r|*')
+            continue
+        paths = sorted(glob.glob(pattern))
+        if not paths:
+            raise FileNotFoundError('no tar shard matches %s' % pattern)
+        for path in paths:
+            yield tarfile.open(path, mode='r|*')
+
+
+def read_samples(inputs, max_pending=64):
+    """Yields (key, image bytes, mask bytes) from tar shards read front to back."""
+    for tar in _open_inputs(inputs):
+        with tar:
+            pending = {}
+            for member in tar:
+                if not member.isfile():
+                    continue
+                key, field = _split_name(member.name)
+                sample = pending.setdefault(key, {})
+                sample[field] = tar.extractfile(member).read()
+
+                if 'image' in sample and 'mask' in sample:
+                    del pending[key]
+                    yield key, sample['image'], sample['mask']
+                elif len(pending) > max_pending:
+                    raise ValueError('more than %d incomplete samples in %s, the image and mask of a sample '
+                                     'must be adjacent' % (max_pending, tar.name))
+            for key in pending:
+                print('skipping %s: image or mask missing' % key, file=sys.stderr)
+
+
+def decode(samples, failed=None):
+    # a sample that does not decode is skipped, its key is logged and appended to `failed`
+    from PIL import Image
+
+    for key, image, mask in samples:
+        try:
+            image = np.array(Image.open(io.BytesIO(image)).convert('RGB'))
+            mask = np.array(Image.open(io.BytesIO(mask)))
+        except Exception as e:
+            print('skipping %s: cannot decode (%s: %s)' % (key, type(e).__name__, e), file=sys.stderr)
+            if failed is not None:
+                failed.append(key)
+            continue
+        yield key, image, mask
+
+
+def prefetch(iterable, size):
+    # runs `iterable` on a background thread, at most `size` items are buffered
+    buffer = queue.Queue(maxsize=size)
+    done = object()
+
+    def fill():
+        try:
+            for item in iterable:
+                buffer.put(item)
+        except Exception as e:
+            buffer.put(e)
+        buffer.put(done)
+
+    threading.Thread(target=fill, name='stream-prefetch', daemon=True).start()
+    while True:
+        item = buffer.get()
+        if item is done:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+def batched(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def inpaint(pipeline, batches):
+    for batch in batches:
+        keys, images, masks = zip(*batch)
+        for key, result in zip(keys, pipeline.predict_batch(images, masks)):
+            yield key, result
+
+
+class ShardWriter():
+    """Writes `<key>.png` members into tar shards of at most `shard_size` samples.
+
+    `pattern` is a file name with a `%d` style field for the shard number,
+    or `-` to write a single stream to stdout.
+    """
+
+    def __init__(self, pattern, shard_size=10000):
+        self.pattern = pattern
+        self.shard_size = shard_size
+        self.shards = 0
+        self.count = 0
+
+        self._tar = None
+        self._in_shard = 0
+
+    def _next_shard(self):
+        self.close()
+        if self.pattern == '-':
+            self._tar = tarfile.open(fileobj=sys.stdout.buffer, mode='w|')
+        else:
+            self._tar = tarfile.open(self.pattern % self.shards, mode='w')
+        self.shards += 1
+        self._in_shard = 0
+
+    def write(self, key, data):
+        if self._tar is None or (self.pattern != '-' and self._in_shard >= self.shard_size):
+            self._next_shard()
+
+        info = tarfile.TarInfo(key + '.png')
+        info.size = len(data)
+        info.mtime = int(time.time())
+        self._tar.addfile(info, io.BytesIO(data))
+        self._in_shard += 1
+        self.count += 1
+
+    def close(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+
+
+def encode_png(array):
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.fromarray(array).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def main(argv=None):
+    from .pipeline import InpaintPipeline
+
+    parser = argparse.ArgumentParser(description='streaming inference over tar shards')
+    parser.add_argument('inputs', type=str, nargs='+', help='input tar shards or globs, - for stdin')
+    parser.add_argument('--output', type=str, required=True, help='output shard pattern, e.g. out-%%06d.tar, '
+                                                                   'or - for stdout')
+    parser.add_argument('--weights', type=str, default=None, help='generator weights (*.tensors / *_gen.pth)')
+    parser.add_argument('--device', type=str, default=None)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--prefetch', type=int, default=32, help='decoded samples buffered ahead of the generator')
+    parser.add_argument('--shard-size', type=int, default=10000, help='samples per output shard')
+    args = parser.parse_args(argv)
+
+    if args.output != '-' and '%' not in args.output:
+        parser.error('--output needs a %%d field for the shard number, e.g. out-%%06d.tar')
+
+    # stdout may be the output stream, keep the loading messages off it
+    with contextlib.redirect_stdout(sys.stderr):
+        pipeline = InpaintPipeline(args.weights, device=args.device, batch_size=args.batch_size)
+    writer = ShardWriter(args.output, shard_size=args.shard_size)
+
+    failed = []
+    samples = prefetch(decode(read_samples(args.inputs), failed), args.prefetch)
+    start = time.perf_counter()
+    try:
+        for key, result in inpaint(pipeline, batched(samples, args.batch_size)):
+            writer.write(key, encode_png(result))
+            if writer.count % 100 == 0:
+                print('\r%d samples, %.1f samples/s' % (writer.count, writer.count / (time.perf_counter() - start)),
+                      end='', file=sys.stderr, flush=True)
+    finally:
+        writer.close()
+    print('\n%d samples written to %d shard(s)' % (writer.count, writer.shards), file=sys.stderr)
+    if failed:
+        print('%d samples could not be decoded' % len(failed), file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
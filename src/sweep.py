@@ -0,0 +1,181 @@
+import os
+import csv
+import sys
+import json
+import argparse
+import torch
+
+'''
+Evaluation of several generator checkpoints in a single pass over the test set:
+
+    python -m src.sweep --config config.yml PATH/checkpoints/*.pth [--processes 2 --devices cuda:0 cuda:1]
+
+Every test batch is decoded, moved to the device and masked once, and the
+ground-truth side of LPIPS is computed once; then each checkpoint's weights
+are swapped into one generator in turn and scored against that batch. With
+`--processes P` the checkpoints are split over P processes (e.g. one per
+GPU), each doing its own single pass. The per-checkpoint means are printed
+as a table and written to `<output>.csv` / `<output>.json`.
+'''
+
+COLUMNS = ['psnr', 'ssim', 'l1', 'lpips', 'psnr_hole', 'ssim_hole', 'l1_hole']
+LOWER_IS_BETTER = ('l1', 'lpips', 'l1_hole')
+
+
+def sweep(config, checkpoints, device, batch_size=8, num_workers=4):
+    """Scores `checkpoints` on the test set of `config`, returns {checkpoint: {metric: mean}}."""
+    import lpips
+    from torch.utils.data import DataLoader
+    from .dataset import Dataset
+    from .networks import SCSAF
+    from .models import mask_pyramid
+    from .metrics import EvalMetrics
+    from .pipeline import read_generator_state
+
+    device = torch.device(device)
+    dataset = Dataset(config, config.TEST_INPAINT_IMAGE_FLIST, config.TEST_MASK_FLIST, augment=False, training=False)
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=device.type == 'cuda')
+
+    generator = SCSAF().to(device).eval().requires_grad_(False)
+
+    # all weights are kept on the device, swapping them is a device-side copy
+    states = []
+    for path in checkpoints:
+        state, iteration = read_generator_state(path)
+        states.append({key: value.to(device) for key, value in state.items()})
+        print('loaded %s (iteration %d)' % (path, iteration))
+
+    # a single checkpoint stays in the generator, several are swapped in per batch
+    if len(states) == 1:
+        generator.load_state_dict(states[0], strict=True)
+
+    lpips_fn = lpips.LPIPS(net='vgg', verbose=False).to(device).eval()
+    metrics = [EvalMetrics(lpips_fn, gaussian=bool(config.SSIM_GAUSSIAN)).to(device) for _ in checkpoints]
+
+    with torch.inference_mode():
+        for step, (images, masks) in enumerate(loader):
+            images = images.to(device, non_blocking=True)
+            masks = masks.to(device, non_blocking=True)
+            if masks.shape[1] == 1:
+                masks = masks.repeat(1, 3, 1, 1)
+
+            images_masked = (images * (1 - masks)) + masks
+            pyramid = mask_pyramid(masks)
+            target_features = metrics[0].lpips_features(images)
+
+            for state, metric in zip(states, metrics):
+                if len(states) > 1:
+                    generator.load_state_dict(state, strict=True)
+                outputs_img = generator(images_masked, masks, *pyramid)
+                outputs_merged = (outputs_img * masks) + (images * (1 - masks))
+                metric.update(metric(outputs_merged, images, masks, target_features=target_features))
+
+            print('\r%d/%d images' % (min((step + 1) * batch_size, len(dataset)), len(dataset)), end='', flush=True)
+    print()
+
+    return {path: metric.means() for path, metric in zip(checkpoints, metrics)}
+
+
+def _sweep_worker(job, connection):
+    # runs in its own (non-daemonic) process, so the sweep's DataLoader may start workers
+    from .config import Config
+
+    config_values, checkpoints, device, batch_size, num_workers = job
+    try:
+        connection.send({'results': sweep(Config(None, **config_values), checkpoints, device, batch_size,
+                                          num_workers)})
+    except Exception as e:
+        connection.send({'error': '%s: %s' % (type(e).__name__, e)})
+
+
+def sweep_parallel(config, checkpoints, devices, processes, batch_size=8, num_workers=4):
+    # round-robin split of the checkpoints, one single-pass sweep per process
+    import multiprocessing
+
+    context = multiprocessing.get_context('spawn')
+    processes = min(processes, len(checkpoints))
+    jobs = [(config.to_dict(), checkpoints[i::processes], devices[i % len(devices)], batch_size, num_workers)
+            for i in range(processes)]
+
+    # Pool workers are daemonic and cannot start DataLoader workers, so every job gets a plain Process
+    running = []
+    for job in jobs:
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=_sweep_worker, args=(job, sender))
+        process.start()
+        sender.close()
+        running.append((process, receiver))
+
+    results, errors = {}, []
+    for process, receiver in running:
+        try:
+            result = receiver.recv()
+        except EOFError:
+            result = {'error': 'sweep process exited with code %s' % process.exitcode}
+        process.join()
+        if 'error' in result:
+            errors.append(result['error'])
+        else:
+            results.update(result['results'])
+
+    if errors:
+        raise RuntimeError('sweep failed: %s' % '; '.join(errors))
+    return {path: results[path] for path in checkpoints}
+
+
+def report(results, output=None):
+    columns = [column for column in COLUMNS if any(column in means for means in results.values())]
+
+    best = {}
+    for column in columns:
+        values = {path: means[column] for path, means in results.items() if column in means}
+        pick = min if column in LOWER_IS_BETTER else max
+        best[column] = pick(values, key=values.get)
+
+    width = max(len(os.path.basename(path)) for path in results)
+    print('%-*s %s' % (width, 'checkpoint', ' '.join('%11s' % column for column in columns)))
+    for path, means in results.items():
+        cells = ['%10.4f%s' % (means[column], '*' if best[column] == path else ' ') for column in columns]
+        print('%-*s %s' % (width, os.path.basename(path), ' '.join(cells)))
+    print('* best per column')
+
+    if output:
+        with open(output + '.csv', 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['checkpoint'] + columns)
+            for path, means in results.items():
+                writer.writerow([path] + [means.get(column) for column in columns])
+        with open(output + '.json', 'w') as f:
+            json.dump({'results': results, 'best': best}, f, indent=2)
+
+
+def main(argv=None):
+    from .config import Config
+    from .pretrained import set_pretrained_path
+
+    parser = argparse.ArgumentParser(description='evaluate several generator checkpoints in one test set pass')
+    parser.add_argument('checkpoints', type=str, nargs='+', help='*.pth / *_gen.pth / *.tensors generator weights')
+    parser.add_argument('--config', type=str, default='./config.yml', help='path to config.yml (test set, mask mode)')
+    parser.add_argument('--set', dest='overrides', metavar='KEY=VALUE', action='append', default=[],
+                        help='override a config value, can be repeated')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=4, help='data loader workers per process')
+    parser.add_argument('--processes', type=int, default=1, help='split the checkpoints over this many processes')
+    parser.add_argument('--devices', type=str, nargs='+', default=None, help='devices assigned to the processes')
+    parser.add_argument('--output', type=str, default=None, help='table prefix (default: <PATH>/sweep)')
+    args = parser.parse_args(argv)
+
+    config = Config(args.config, args.overrides, MODE=2)
+    set_pretrained_path(config.PRETRAINED_PATH)
+    devices = args.devices or ['cuda' if torch.cuda.is_available() else 'cpu']
+
+    if args.processes > 1:
+        results = sweep_parallel(config, args.checkpoints, devices, args.processes, args.batch_size, args.workers)
+    else:
+        results = sweep(config, args.checkpoints, devices[0], args.batch_size, args.workers)
+
+    report(results, args.output or os.path.join(config.PATH, 'sweep'))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
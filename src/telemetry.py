@@ -0,0 +1,247 @@
+import os
+import csv
+import json
+import time
+import queue
+import shutil
+import threading
+import numpy as np
+import torch
+
+
+class Telemetry():
+    """No-op telemetry backend and base class of the real backends.
+
+    Scalars, histograms and images are sampled independently: `due(kind, step)`
+    tells the training loop whether to collect them at all, so nothing is
+    computed on steps that are not logged.
+
+    Arguments:
+        scalar_interval: Steps between scalar logs (0: never).
+        histogram_interval: Steps between parameter/gradient histograms (0: never).
+        image_interval: Steps between image logs (0: never).
+    """
+
+    def __init__(self, scalar_interval=0, histogram_interval=0, image_interval=0):
+        self.intervals = {
+            'scalars': scalar_interval,
+            'histograms': histogram_interval,
+            'images': image_interval,
+        }
+
+    def due(self, kind, step):
+        interval = self.intervals[kind]
+        return bool(interval) and step % interval == 0
+
+    def log_scalars(self, values, step):
+        pass
+
+    def log_histograms(self, module, step, bins=64):
+        pass
+
+    def log_images(self, images, step):
+        pass
+
+    def save(self, path):
+        pass
+
+    def close(self):
+        pass
+
+
+class AsyncTelemetry(Telemetry):
+    """Base class of the backends that write on a background thread.
+
+    The training thread only detaches tensors (and, for histograms, launches
+    the histogram kernels) and queues them; the host copies, formatting and
+    I/O happen on the flush thread. Subclasses implement `write`, which is
+    only ever called from that thread, and `flush`.
+    """
+
+    def __init__(self, scalar_interval=0, histogram_interval=0, image_interval=0,
+                 flush_interval=5.0, max_queue=1000):
+        super(AsyncTelemetry, self).__init__(scalar_interval, histogram_interval, image_interval)
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._run, name='telemetry-writer', daemon=True)
+        self._thread.start()
+
+    def log_scalars(self, values, step):
+        values = {name: value.detach() if torch.is_tensor(value) else value for name, value in values.items()}
+        self._queue.put(('scalars', values, step))
+
+    def log_histograms(self, module, step, bins=64):
+        histograms = {}
+        for name, param in module.named_parameters():
+            histograms['parameters/' + name] = self._histogram(param.detach(), bins)
+            if param.grad is not None:
+                histograms['gradients/' + name] = self._histogram(param.grad.detach(), bins)
+        self._queue.put(('histograms', histograms, step))
+
+    def log_images(self, images, step):
+        images = {name: image.detach().clamp(0, 1) for name, image in images.items()}
+        self._queue.put(('images', images, step))
+
+    def save(self, path):
+        self._queue.put(('file', path, None))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _histogram(self, tensor, bins):
+        tensor = tensor.float().flatten()
+        low, high = torch.aminmax(tensor)
+        return torch.histc(tensor, bins=bins, min=0, max=0), low, high
+
+    def _run(self):
+        last_flush = time.time()
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = ()
+
+            if item is None:
+                break
+            if item:
+                kind, payload, step = item
+                try:
+                    self.write(kind, self._to_host(kind, payload), step)
+                except Exception as e:
+                    # telemetry must never take the training run down
+                    print('telemetry: failed to write %s at step %s: %s' % (kind, step, e))
+
+            if time.time() - last_flush >= self.flush_interval:
+                self.flush()
+                last_flush = time.time()
+        self.flush()
+
+    def _to_host(self, kind, payload):
+        if kind == 'scalars':
+            return {name: value.item() if torch.is_tensor(value) else value for name, value in payload.items()}
+        if kind == 'histograms':
+            histograms = {}
+            for name, (counts, low, high) in payload.items():
+                low, high = low.item(), high.item()
+                histograms[name] = (counts.cpu().numpy(), np.linspace(low, high, len(counts) + 1))
+            return histograms
+        if kind == 'images':
+            # NCHW [0, 1] => list of HxWxC uint8
+            return {name: list((image * 255.0).round().byte().permute(0, 2, 3, 1).cpu().numpy())
+                    for name, image in payload.items()}
+        return payload
+
+    def write(self, kind, payload, step):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+
+class LocalTelemetry(AsyncTelemetry):
+    """Writes telemetry to local files, for nodes without network access.
+
+    Scalars go to `scalars.jsonl` (one object per step) or `scalars.csv`
+    (step, name, value rows), histograms to `histograms.jsonl` and images to
+    `images/<name>_<step>_<index>.png`.
+    """
+
+    def __init__(self, path, format='jsonl', **kwargs):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.format = format
+        self._files = {}
+        self._csv = None
+        super(LocalTelemetry, self).__init__(**kwargs)
+
+    def _file(self, name):
+        if name not in self._files:
+            self._files[name] = open(os.path.join(self.path, name), 'a', newline='')
+        return self._files[name]
+
+    def write(self, kind, payload, step):
+        if kind == 'scalars':
+            if self.format == 'csv':
+                if self._csv is None:
+                    self._csv = csv.writer(self._file('scalars.csv'))
+                for name, value in payload.items():
+                    self._csv.writerow([step, name, value])
+            else:
+                self._file('scalars.jsonl').write(json.dumps(dict(step=step, **payload)) + '\n')
+
+        elif kind == 'histograms':
+            f = self._file('histograms.jsonl')
+            for name, (counts, edges) in payload.items():
+                f.write(json.dumps({'step': step, 'name': name, 'min': float(edges[0]), 'max': float(edges[-1]),
+                                    'counts': counts.tolist()}) + '\n')
+
+        elif kind == 'images':
+            from PIL import Image
+
+            image_dir = os.path.join(self.path, 'images')
+            os.makedirs(image_dir, exist_ok=True)
+            for name, images in payload.items():
+                for index, image in enumerate(images):
+                    Image.fromarray(image.squeeze()).save(
+                        os.path.join(image_dir, '%s_%08d_%d.png' % (name, step, index)))
+
+        elif kind == 'file':
+            shutil.copy(payload, self.path)
+
+    def flush(self):
+        for f in self._files.values():
+            f.flush()
+
+    def close(self):
+        super(LocalTelemetry, self).close()
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+
+class WandbTelemetry(AsyncTelemetry):
+    """Logs to Weights & Biases, `mode` is 'online' or 'offline' (sync later with `wandb sync`)."""
+
+    def __init__(self, project, config=None, mode='online', **kwargs):
+        import wandb
+
+        self.wandb = wandb
+        self.run = wandb.init(project=project, config=config, mode=mode)
+        super(WandbTelemetry, self).__init__(**kwargs)
+
+    def write(self, kind, payload, step):
+        wandb = self.wandb
+        if kind == 'scalars':
+            wandb.log(payload, step=step)
+        elif kind == 'histograms':
+            wandb.log({name: wandb.Histogram(np_histogram=histogram) for name, histogram in payload.items()},
+                      step=step)
+        elif kind == 'images':
+            wandb.log({name: [wandb.Image(image) for image in images] for name, images in payload.items()},
+                      step=step)
+        elif kind == 'file':
+            wandb.save(payload)
+
+    def close(self):
+        super(WandbTelemetry, self).close()
+        self.run.finish()
+
+
+def create_telemetry(config):
+    kwargs = {
+        'scalar_interval': config.TELEMETRY_SCALAR_INTERVAL,
+        'histogram_interval': config.TELEMETRY_HISTOGRAM_INTERVAL,
+        'image_interval': config.TELEMETRY_IMAGE_INTERVAL,
+        'flush_interval': config.TELEMETRY_FLUSH_INTERVAL,
+    }
+
+    if config.TELEMETRY == 'local':
+        return LocalTelemetry(os.path.join(config.PATH, 'telemetry'), format=config.TELEMETRY_FORMAT, **kwargs)
+
+    if config.TELEMETRY == 'wandb':
+        run_config = {key: value if isinstance(value, (int, float, str, bool, list, type(None))) else str(value)
+                      for key, value in config.to_dict().items()}
+        return WandbTelemetry(config.TELEMETRY_PROJECT, config=run_config, mode=config.TELEMETRY_MODE, **kwargs)
+
+    return Telemetry()
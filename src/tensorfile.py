@@ -0,0 +1,198 @@
+import os
+import sys
+import json
+import mmap
+import struct
+import argparse
+import torch
+
+'''
+Flat weights-only tensor file:
+
+    8 bytes   magic
+    8 bytes   header length (little-endian uint64)
+    N bytes   JSON header, padded with spaces so the data section is aligned
+    ...       raw tensor buffers, each starting at an ALIGNMENT boundary
+
+The header maps every tensor name to its dtype, shape and byte offset inside
+the data section. Loading never unpickles anything and can memory-map the
+file, so several processes share the same page-cached weights.
+'''
+
+MAGIC = b'SCSAFT01'
+ALIGNMENT = 64
+
+DTYPES = {str(dtype).replace('torch.', ''): dtype for dtype in [
+    torch.float64, torch.float32, torch.float16, torch.bfloat16,
+    torch.int64, torch.int32, torch.int16, torch.int8, torch.uint8, torch.bool,
+]}
+
+STORAGE_DTYPES = {
+    'fp32': torch.float32,
+    'fp16': torch.float16,
+    'bf16': torch.bfloat16,
+}
+
+
+def _align(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save_tensors(path, tensors, dtype=None, metadata=None):
+    """Writes a flat tensor file.
+
+    Arguments:
+        path: Output file path, written atomically.
+        tensors: Dict of name -> tensor, e.g. a state dict.
+        dtype: Optional storage dtype ('fp32', 'fp16', 'bf16') for floating
+            point tensors, integer tensors are always kept as they are.
+        metadata: Optional JSON serializable dict stored in the header.
+    """
+    storage_dtype = STORAGE_DTYPES[dtype] if dtype else None
+
+    entries = {}
+    buffers = []
+    offset = 0
+    for name, tensor in tensors.items():
+        tensor = tensor.detach().cpu()
+        if storage_dtype is not None and tensor.is_floating_point():
+            tensor = tensor.to(storage_dtype)
+        tensor = tensor.contiguous()
+
+        nbytes = tensor.numel() * tensor.element_size()
+        entries[name] = {
+            'dtype': str(tensor.dtype).replace('torch.', ''),
+            'shape': list(tensor.shape),
+            'offset': offset,
+            'nbytes': nbytes,
+        }
+        buffers.append((offset, tensor))
+        offset = _align(offset + nbytes)
+
+    header = json.dumps({'tensors': entries, 'metadata': metadata or {}}).encode('utf-8')
+    header += b' ' * (_align(len(MAGIC) + 8 + len(header)) - len(MAGIC) - 8 - len(header))
+    data_start = len(MAGIC) + 8 + len(header)
+
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+
+    tmp_path = '%s.tmp.%d' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            for tensor_offset, tensor in buffers:
+                f.seek(data_start + tensor_offset)
+                if tensor.numel():
+                    f.write(tensor.reshape(-1).view(torch.uint8).numpy().data)
+            f.truncate(data_start + offset)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def read_header(f):
+    magic = f.read(len(MAGIC))
+    if magic != MAGIC:
+        raise ValueError('%s is not a flat tensor file' % getattr(f, 'name', f))
+
+    length, = struct.unpack('<Q', f.read(8))
+    header = json.loads(f.read(length).decode('utf-8'))
+    return header, len(MAGIC) + 8 + length
+
+
+def load_tensors(path, use_mmap=True):
+    """Loads a flat tensor file without unpickling.
+
+    With `use_mmap` the returned CPU tensors are views into a private
+    (copy-on-write) memory map of the file, so pages are only read on first
+    access and are shared with other processes mapping the same file.
+
+    Returns:
+        (tensors, metadata)
+    """
+    with open(path, 'rb') as f:
+        header, data_start = read_header(f)
+        if use_mmap:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        else:
+            f.seek(0)
+            buffer = bytearray(f.read())
+
+    tensors = {}
+    for name, entry in header['tensors'].items():
+        dtype = DTYPES[entry['dtype']]
+        numel = entry['nbytes'] // torch.empty((), dtype=dtype).element_size()
+        if numel == 0:
+            tensors[name] = torch.empty(entry['shape'], dtype=dtype)
+            continue
+        tensor = torch.frombuffer(buffer, dtype=dtype, count=numel, offset=data_start + entry['offset'])
+        tensors[name] = tensor.view(entry['shape'])
+
+    return tensors, header['metadata']
+
+
+def load_into(module, path, strict=True, use_mmap=True):
+    """Loads a flat tensor file straight into `module`.
+
+    Tensors are cast to the dtype and device of the module's own parameters
+    and buffers. When nothing needs to be cast (fp32 file, CPU module) the
+    module ends up holding the memory-mapped tensors themselves. With
+    `strict` a file that does not cover every key of the module (e.g. the
+    weights of another network) raises instead of leaving the rest at its
+    random initialization; `DataParallel` wrappers and `module.` prefixes
+    are ignored on both sides.
+
+    Returns:
+        metadata stored in the file
+    """
+    tensors, metadata = load_tensors(path, use_mmap=use_mmap)
+    if isinstance(module, (torch.nn.DataParallel, torch.nn.parallel.DistributedDataParallel)):
+        module = module.module
+    current = module.state_dict()
+
+    state = {}
+    for name, tensor in tensors.items():
+        if name.startswith('module.'):
+            name = name[7:]
+        if name in current:
+            tensor = tensor.to(dtype=current[name].dtype, device=current[name].device)
+        state[name] = tensor
+
+    module.load_state_dict(state, strict=strict, assign=True)
+    return metadata
+
+
+def convert_checkpoint(src_path, dst_path, dtype=None, key='generator'):
+    """Converts a pickled `*_gen.pth` checkpoint into a flat tensor file."""
+    data = torch.load(src_path, map_location='cpu')
+    state = data[key] if key in data else data
+
+    metadata = {'source': os.path.basename(src_path)}
+    if 'iteration' in data:
+        metadata['iteration'] = int(data['iteration'])
+
+    save_tensors(dst_path, state, dtype=dtype, metadata=metadata)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='convert a *_gen.pth checkpoint into a flat tensor file')
+    parser.add_argument('src', type=str, help='path to the *_gen.pth checkpoint')
+    parser.add_argument('dst', type=str, nargs='?', help='output path (default: <src>.tensors)')
+    parser.add_argument('--dtype', type=str, default=None, choices=sorted(STORAGE_DTYPES),
+                        help='storage dtype of floating point tensors (default: keep)')
+    parser.add_argument('--key', type=str, default='generator', help='state dict entry of the checkpoint')
+    args = parser.parse_args(argv)
+
+    dst = args.dst or os.path.splitext(args.src)[0] + '.tensors'
+    convert_checkpoint(args.src, dst, dtype=args.dtype, key=args.key)
+    print('%s -> %s' % (args.src, dst))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
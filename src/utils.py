@@ -1,11 +1,9 @@
 import torch
 import os
-import cv2
 import sys
 import time
 import random
 import numpy as np
-import matplotlib.pyplot as plt
 from PIL import Image
 
 
@@ -14,6 +12,17 @@ def create_dir(dir):
         os.makedirs(dir)
 
 
+def set_threads(config):
+    # thread pools sized by NUM_THREADS / NUM_INTEROP_THREADS / CV2_THREADS, before any parallel work runs
+    import cv2
+
+    cv2.setNumThreads(config.CV2_THREADS)
+    if config.NUM_THREADS:
+        torch.set_num_threads(config.NUM_THREADS)
+    if config.NUM_INTEROP_THREADS:
+        torch.set_num_interop_threads(config.NUM_INTEROP_THREADS)
+
+
 def create_mask(width, height, mask_width, mask_height, x=None, y=None):
     mask = np.zeros((height, width))
     mask_x = x if x is not None else random.randint(0, width - mask_width)
@@ -43,6 +52,8 @@ def stitch_images(inputs, *outputs, img_per_row=2):
 
 
 def imshow(img, title=''):
+    import matplotlib.pyplot as plt
+
     fig = plt.gcf()
     fig.canvas.set_window_title(title)
     plt.axis('off')
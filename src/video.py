@@ -0,0 +1,222 @@
+import sys
+import time
+import queue
+import hashlib
+import argparse
+import threading
+import collections
+import numpy as np
+
+'''
+Video inpainting with a static mask (logo / watermark removal):
+
+    python -m src.video input.mp4 mask.png output.mp4 --weights XXX/InpaintingModel_gen.tensors --batch-size 8
+
+Frames are decoded with cv2 on a reader thread and encoded on a writer
+thread, both through bounded queues, so decoding, inference and encoding
+overlap. The mask is resized to the frame size, padded and its pyramid is
+computed once. Frames go through the generator in batches; a frame whose
+pixels around the hole (the mask's bounding box grown by `--context`) hash
+to a value seen in the last `--reuse` computed frames reuses that frame's
+hole content instead of running the generator again.
+'''
+
+_END = object()
+
+
+def _reader(capture, frames, stop):
+    while not stop.is_set():
+        ok, frame = capture.read()
+        if not ok:
+            break
+        frames.put(frame)
+    frames.put(_END)
+
+
+def _writer(writer, frames, failure):
+    # after an error the remaining frames are drained, so the main loop never blocks on a full queue;
+    # the error is passed back in `failure`
+    while True:
+        frame = frames.get()
+        if frame is _END:
+            return
+        if failure:
+            continue
+        try:
+            writer.write(frame)
+        except Exception as e:
+            failure.append(e)
+
+
+def _context_box(mask, margin):
+    # bounding box of the hole grown by `margin`, the pixels the fill depends on most
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if len(rows) == 0:
+        return None
+    height, width = mask.shape
+    return (slice(max(rows[0] - margin, 0), min(rows[-1] + margin + 1, height)),
+            slice(max(cols[0] - margin, 0), min(cols[-1] + margin + 1, width)))
+
+
+class VideoInpainter():
+    """Inpaints frames of one size with a fixed mask, reusing results of repeated frames.
+
+    Arguments:
+        pipeline: `InpaintPipeline`.
+        mask: HxW (or HxWx3) array, non-zero marks the hole, resized to the frames.
+        height, width: Frame size.
+        context: Margin in pixels around the hole included in the frame hash.
+        reuse: Number of recent computed frames whose hole content can be reused.
+    """
+
+    def __init__(self, pipeline, mask, height, width, context=32, reuse=64):
+        import cv2
+        import torch
+
+        self.pipeline = pipeline
+        if mask.ndim == 3:
+            mask = mask.max(axis=2)
+        mask = cv2.resize((mask > 0).astype(np.uint8), (width, height), interpolation=cv2.INTER_NEAREST) > 0
+        self.hole = mask
+        self.box = _context_box(mask, context)
+        self.masks, self.pyramid = pipeline.static_mask(torch.from_numpy(mask.astype(np.uint8)), height, width)
+
+        self._recent = collections.OrderedDict()
+        self.reuse = reuse
+        self.computed = 0
+        self.reused = 0
+
+    def _digest(self, frame):
+        return hashlib.blake2b(np.ascontiguousarray(frame[self.box]).tobytes(), digest_size=16).digest()
+
+    def process(self, frames):
+        """Inpaints a list of HxWx3 uint8 BGR frames, returns the list of result frames."""
+        import torch
+
+        if self.box is None:
+            return frames
+
+        digests = [self._digest(frame) for frame in frames]
+        fills = {digest: self._recent[digest] for digest in digests if digest in self._recent}
+        todo = {}
+        for index, digest in enumerate(digests):
+            if digest not in fills and digest not in todo:
+                todo[digest] = index
+
+        if todo:
+            pipeline = self.pipeline
+            indices = list(todo.values())
+            images = torch.stack([pipeline.image_to_tensor(np.ascontiguousarray(frames[i][:, :, ::-1]))
+                                  for i in indices])
+            outputs = pipeline.run(images, self.masks, self.pyramid)
+            for i, output in zip(indices, outputs):
+                # keep only the hole, the rest of every frame is its own
+                fills[digests[i]] = pipeline.postprocess(output)[:, :, ::-1][self.hole]
+            self.computed += len(indices)
+
+        results = []
+        for frame, digest in zip(frames, digests):
+            result = frame.copy()
+            result[self.hole] = fills[digest]
+            results.append(result)
+        self.reused += len(frames) - len(todo)
+
+        for digest in digests:
+            self._recent[digest] = fills[digest]
+            self._recent.move_to_end(digest)
+        while len(self._recent) > self.reuse:
+            self._recent.popitem(last=False)
+        return results
+
+
+def inpaint_video(pipeline, input_path, mask, output_path, batch_size=8, context=32, reuse=64, fourcc='mp4v',
+                  buffer=64):
+    import cv2
+
+    capture = cv2.VideoCapture(input_path)
+    if not capture.isOpened():
+        raise IOError('cannot open %s' % input_path)
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+    width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    total = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*fourcc), fps, (width, height))
+    if not writer.isOpened():
+        raise IOError('cannot write %s with codec %s' % (output_path, fourcc))
+
+    inpainter = VideoInpainter(pipeline, mask, height, width, context=context, reuse=reuse)
+
+    decoded = queue.Queue(maxsize=buffer)
+    encoded = queue.Queue(maxsize=buffer)
+    stop = threading.Event()
+    failure = []
+    threads = [threading.Thread(target=_reader, args=(capture, decoded, stop), name='video-reader', daemon=True),
+               threading.Thread(target=_writer, args=(writer, encoded, failure), name='video-writer', daemon=True)]
+    for thread in threads:
+        thread.start()
+
+    start = time.perf_counter()
+    count = 0
+    try:
+        finished = False
+        while not finished and not failure:
+            batch = []
+            while len(batch) < batch_size:
+                frame = decoded.get()
+                if frame is _END:
+                    finished = True
+                    break
+                batch.append(frame)
+
+            for result in inpainter.process(batch):
+                encoded.put(result)
+            count += len(batch)
+            print('\r%d/%d frames, %.1f fps, %d reused' % (count, total, count / (time.perf_counter() - start),
+                                                           inpainter.reused), end='', flush=True)
+    finally:
+        stop.set()
+        # unblock the reader if it waits on a full queue
+        while threads[0].is_alive():
+            try:
+                decoded.get_nowait()
+            except queue.Empty:
+                time.sleep(0.01)
+        encoded.put(_END)
+        threads[1].join()
+        capture.release()
+        writer.release()
+    print()
+    if failure:
+        raise IOError('writing %s failed: %s' % (output_path, failure[0])) from failure[0]
+
+    return {'frames': count, 'computed': inpainter.computed, 'reused': inpainter.reused,
+            'elapsed_s': time.perf_counter() - start}
+
+
+def main(argv=None):
+    from imageio import imread
+    from .pipeline import InpaintPipeline
+
+    parser = argparse.ArgumentParser(description='inpaint a video with a static mask')
+    parser.add_argument('input', type=str, help='input video (anything cv2 can read)')
+    parser.add_argument('mask', type=str, help='mask image, non-zero marks the region to inpaint')
+    parser.add_argument('output', type=str, help='output video')
+    parser.add_argument('--weights', type=str, default=None, help='generator weights (*.tensors / *_gen.pth)')
+    parser.add_argument('--device', type=str, default=None)
+    parser.add_argument('--batch-size', type=int, default=8, help='frames per generator call')
+    parser.add_argument('--context', type=int, default=32, help='margin around the hole used for the frame hash')
+    parser.add_argument('--reuse', type=int, default=64, help='recent results kept for unchanged frames, 0: off')
+    parser.add_argument('--fourcc', type=str, default='mp4v', help='output codec')
+    parser.add_argument('--buffer', type=int, default=64, help='frames buffered between the stages')
+    args = parser.parse_args(argv)
+
+    pipeline = InpaintPipeline(args.weights, device=args.device, batch_size=args.batch_size)
+    summary = inpaint_video(pipeline, args.input, imread(args.mask), args.output, batch_size=args.batch_size,
+                            context=args.context, reuse=args.reuse, fourcc=args.fourcc, buffer=args.buffer)
+    print('%(frames)d frames, %(computed)d through the generator, %(reused)d reused' % summary)
+
+
+if __name__ == "__main__":
+    sys.exit(main())